@@ -26,105 +26,230 @@ along with opensense. If not, see http://www.gnu.org/licenses.
 import os, sys, time, logging, glob, signal
 import threading
 import json
-import importlib
+
+startTime = time.time()
 
 from python.core.opensense import OpenSenseNetInstance
+from python.core.config_store import configStore
+from python.core.abstract_agent import loadAgent
 
 class TerminationSignalHandler:
     exitNow = False
     def __init__(self):
+        self.exitEvent = threading.Event() # wakes up the main loop right away
         signal.signal(signal.SIGTERM, self.initiateExit)
         signal.signal(signal.SIGINT, self.initiateExit)
 
     def initiateExit(self, var1, var2):
         self.exitNow = True
-
-sigHandler = TerminationSignalHandler()
-rootDir = os.path.dirname(sys.argv[0])
-configDir = os.path.join(rootDir, "config")
+        self.exitEvent.set()
 
 #logLevel = logging.DEBUG
 logLevel = logging.INFO
 #logLevel = logging.WARNING
 
-logFile = os.path.join(rootDir, "log", "opensensenet-donation.log")
-logging.basicConfig(filename=logFile, level=logLevel, format='%(asctime)s - %(name)s - %(message)s')
-logger = logging.getLogger("donationAgentRunner")
-
-osnInstance = OpenSenseNetInstance(rootDir)
-
-# config file for defining which agents are to be active
-configFile = os.path.join(rootDir, "config", "opensensenet-donation.config.json")
-
-# identify available agents based on filesystem
-agentDir = os.path.join(rootDir, "python", "agents", "")
-availableAgents = {}
-for file in glob.glob(os.path.join(agentDir, "*", "*.py")):
-    filename = os.path.basename(file)
-    if filename != "__init__.py":
-        fileRoot = os.path.splitext(filename)[0]
-        availableAgents[fileRoot] = file
-
-# read from config which of the available agents are to be activated
-# at the same time, also add default config for unconfigured agents
-configChanged = False
-with open(configFile) as dataFile:
-    configData = json.load(dataFile)
-    if "donation_agents_activation" not in configData:
-        configData["donation_agents_activation"] = {}
-        configChanged = True
-    for agent in availableAgents:
-        agent = agent.lower()
-        if agent not in configData["donation_agents_activation"]:
-            logger.info("adding %s to donation config" % agent)
-            configData["donation_agents_activation"][agent] = False
-            configChanged = True
-
-if configChanged:
-    with open(configFile, "w") as dataFile:
-        logger.info("Serializing config to %s" % configFile)
-        json.dump(configData, dataFile, sort_keys = False, indent = 4, ensure_ascii=False)
-
-#instantiate availableAgents - this is the magic we were striving for...
-logger.debug("Importing and instantiating all activated agents")
-activeAgents = []
-for agent in availableAgents:
-    if agent.lower() in configData["donation_agents_activation"] and configData["donation_agents_activation"][agent.lower()]:
+def agentDirSignature(agentDir):
+    """Modification times of the agent directory and its subdirectories - they change whenever agents are added or removed"""
+    signature = {"": os.path.getmtime(agentDir)}
+    for entry in os.listdir(agentDir):
+        if os.path.isdir(os.path.join(agentDir, entry)) and entry != "__pycache__":
+            signature[entry] = os.path.getmtime(os.path.join(agentDir, entry))
+    return signature
+
+def findAvailableAgents(agentDir, cacheFile):
+    """
+    identify available agents based on filesystem. Returns agent name -> [import name, class name].
+    The result is cached in cacheFile until the agent directories change.
+    """
+    signature = agentDirSignature(agentDir)
+    if os.path.isfile(cacheFile):
+        try:
+            with open(cacheFile) as cacheFileHandle:
+                cacheData = json.load(cacheFileHandle)
+            if cacheData["signature"] == signature:
+                return cacheData["agents"]
+        except BaseException as e:
+            logging.getLogger("donationAgentRunner").warning("Could not read agent cache from %s. Exception message: %s" % (cacheFile, e))
+    availableAgents = {}
+    for file in glob.glob(os.path.join(agentDir, "*", "*.py")):
+        filename = os.path.basename(file)
+        if filename != "__init__.py":
+            fileRoot = os.path.splitext(filename)[0]
+            importName = "python.agents." + os.path.split(os.path.dirname(file))[1] + "." + fileRoot
+            availableAgents[fileRoot] = [importName, fileRoot]
+    configStore.write(cacheFile, {"signature":signature, "agents":availableAgents})
+    return availableAgents
+
+def createAgents(activatedAgents, availableAgents, configDir, osnInstance, logger):
+    """
+    Imports the activated agents and creates an instance of each. This is done
+    concurrently, as agents may wait for hardware or network while initializing.
+    Returns the instances and the time needed for each agent.
+    """
+    instances = {}
+    durations = {}
+    def createAgent(agent):
+        agentStart = time.time()
         try:
-            agentDir = os.path.split(os.path.dirname(availableAgents[agent]))[1]
-            importName = "python.agents." + agentDir + "." + agent
             logger.debug("importing %s and creating an instance..." % agent)
-            agentModule = importlib.import_module(importName)
-            agentClass = getattr(agentModule, agent)
-            agentInstance = agentClass(configDir, osnInstance)
-            activeAgents.append(agentInstance)
+            importName, className = availableAgents[agent]
+            instances[agent] = loadAgent(importName, className, configDir, osnInstance)
         except BaseException as e:
             logger.warning("Could not import and instantiate Agent %s. Exception message: %s" % (agent, e))
+        durations[agent] = time.time() - agentStart
+    creators = [threading.Thread(target = createAgent, args = (agent,)) for agent in activatedAgents]
+    for creator in creators:
+        creator.start()
+    for creator in creators:
+        creator.join()
+    return [instances[agent] for agent in activatedAgents if agent in instances], durations
+
+def agentProcessGroups(activatedAgents, configuredGroups):
+    """Groups the activated agents for worker processes: as configured, the others one per process."""
+    groups = []
+    grouped = set()
+    for configuredGroup in configuredGroups:
+        group = [agent for agent in activatedAgents if agent.lower() in [name.lower() for name in configuredGroup]]
+        grouped.update(group)
+        groups.append(group)
+    groups.extend([agent] for agent in activatedAgents if agent not in grouped)
+    return [group for group in groups if group]
+
+def stopAgents(activeAgents, deadline, logger):
+    """Stops all agents concurrently, waiting for them till the deadline at most."""
+    def stopAgent(agent):
+        agent.stop()
+        agent.flushAggregation()
+        agent.stopProvisioning(max(0, deadline - time.time()))
+    stoppers = [threading.Thread(target = stopAgent, args = (agent,)) for agent in activeAgents]
+    for stopper in stoppers:
+        stopper.daemon = True
+        stopper.start()
+    for agent, stopper in zip(activeAgents, stoppers):
+        stopper.join(max(0, deadline - time.time()))
+        if stopper.is_alive():
+            logger.warning("agent %s did not stop in time" % agent)
+
+def main():
+    sigHandler = TerminationSignalHandler()
+    rootDir = os.path.dirname(sys.argv[0])
+    configDir = os.path.join(rootDir, "config")
+
+    logFile = os.path.join(rootDir, "log", "opensensenet-donation.log")
+    logging.basicConfig(filename=logFile, level=logLevel, format='%(asctime)s - %(name)s - %(message)s')
+    logger = logging.getLogger("donationAgentRunner")
+
+    phaseStart = time.time()
+    osnInstance = OpenSenseNetInstance(rootDir)
+    osnInstance.recordStartupPhase("imports", phaseStart - startTime)
+    osnInstance.recordStartupPhase("osn_init", time.time() - phaseStart)
+
+    # config file for defining which agents are to be active
+    configFile = os.path.join(rootDir, "config", "opensensenet-donation.config.json")
+
+    phaseStart = time.time()
+    agentCacheFile = os.path.join(rootDir, osnInstance.configData["cache_dir"], "agents.cache.json")
+    availableAgents = findAvailableAgents(os.path.join(rootDir, "python", "agents", ""), agentCacheFile)
+    osnInstance.recordStartupPhase("agent_discovery", time.time() - phaseStart)
+
+    # read from config which of the available agents are to be activated
+    # at the same time, also add default config for unconfigured agents
+    configChanged = False
+    with open(configFile) as dataFile:
+        configData = json.load(dataFile)
+        if "donation_agents_activation" not in configData:
+            configData["donation_agents_activation"] = {}
+            configChanged = True
+        for agent in availableAgents:
+            agent = agent.lower()
+            if agent not in configData["donation_agents_activation"]:
+                logger.info("adding %s to donation config" % agent)
+                configData["donation_agents_activation"][agent] = False
+                configChanged = True
+        # "threads" runs all agents in this process, "processes" runs them in worker processes feeding this one
+        if "runner_mode" not in configData:
+            configData["runner_mode"] = "threads"
+            configChanged = True
+        # in processes mode, lists of agent names to share a worker process. Agents not listed get a process of their own
+        if "agent_process_groups" not in configData:
+            configData["agent_process_groups"] = []
+            configChanged = True
+        # max. number of values sent from a worker process at once, and max. time a value waits for further ones
+        if "worker_batch_size" not in configData:
+            configData["worker_batch_size"] = 100
+            configChanged = True
+        if "worker_batch_linger_msec" not in configData:
+            configData["worker_batch_linger_msec"] = 100
+            configChanged = True
 
-logger.debug("Starting all activated agents")
-for agent in activeAgents:
-    if "--discover" in sys.argv:
-        logger.debug("starting agent instance %s in discovery mode..." % agent)
-        agent.discoverSensors()
-    else:
-        logger.debug("starting agent instance %s..." % agent)
-        agent.start()
-
-logger.debug("All activated agents started. Waiting for exit signal")
-while True:
-    time.sleep(1)
-    activeAgentExisting = False
+    if configChanged:
+        logger.info("Serializing config to %s" % configFile)
+        configStore.writeNow(configFile, configData)
+
+    activatedAgents = [agent for agent in availableAgents if configData["donation_agents_activation"].get(agent.lower(), False)]
+    discover = "--discover" in sys.argv
+
+    if configData["runner_mode"] == "processes":
+        from python.core.agent_process import AgentProcessSupervisor
+        logger.debug("Starting all activated agents in worker processes")
+        groups = agentProcessGroups(activatedAgents, configData["agent_process_groups"])
+        supervisor = AgentProcessSupervisor(osnInstance, configDir, [[availableAgents[agent] for agent in group] for group in groups], discover, \
+            configData["worker_batch_size"], configData["worker_batch_linger_msec"], logFile, logLevel, finishedEvent = sigHandler.exitEvent)
+        supervisor.start()
+        osnInstance.recordStartupPhase("total", time.time() - startTime)
+        while not sigHandler.exitEvent.is_set():
+            sigHandler.exitEvent.wait(60) # with a timeout, the wait is interruptible by signals on Python 2 as well
+        logger.debug("Got exit request or all agent workers are done. Stopping them...")
+        # workers get half of the shutdown budget, sending what they handed over gets the rest
+        shutdownBudget = osnInstance.configData["shutdown_timeout_msec"] / 1000.0
+        deadline = time.time() + shutdownBudget
+        osnInstance.beginShutdown()
+        supervisor.stop(shutdownBudget / 2)
+        osnInstance.stop(deadline)
+        logger.info("All agents stopped. Terminating.")
+        return
+
+    #instantiate availableAgents - this is the magic we were striving for...
+    logger.debug("Importing and instantiating all activated agents")
+    phaseStart = time.time()
+    activeAgents, durations = createAgents(activatedAgents, availableAgents, configDir, osnInstance, logger)
+    osnInstance.recordStartupPhase("agent_construction", time.time() - phaseStart)
+    for agent in sorted(durations):
+        logger.info("creating agent %s took %.3f sec" % (agent, durations[agent]))
+
+    logger.debug("Starting all activated agents")
+    phaseStart = time.time()
     for agent in activeAgents:
-        if agent.running():
-            activeAgentExisting = True # especially required for agents that finished discovery mode
-    if sigHandler.exitNow or not activeAgentExisting:
-        logger.debug("Got exit request or all agents are inactive. Stopping all activated agents...")
-        break
-
-for agent in activeAgents:
-    agent.stop()
-osnInstance.stop()
-logger.info("All agents stopped. Terminating.")
-
-# quit is only called after the stop()-sequence of each agent (cleanup etc) was completed
-quit()
+        if discover:
+            logger.debug("starting agent instance %s in discovery mode..." % agent)
+            agent.discoverSensors()
+        else:
+            logger.debug("starting agent instance %s..." % agent)
+            agent.start()
+    osnInstance.recordStartupPhase("agent_start", time.time() - phaseStart)
+    osnInstance.recordStartupPhase("total", time.time() - startTime)
+
+    logger.debug("All activated agents started. Waiting for exit signal")
+    while True:
+        # signals wake this up right away, agents that finished discovery mode are noticed within a second
+        sigHandler.exitEvent.wait(1)
+        activeAgentExisting = False
+        for agent in activeAgents:
+            if agent.running():
+                activeAgentExisting = True # especially required for agents that finished discovery mode
+        if sigHandler.exitNow or not activeAgentExisting:
+            logger.debug("Got exit request or all agents are inactive. Stopping all activated agents...")
+            break
+
+    # agents are stopped first so that no further values come in, the rest of the budget is for sending
+    deadline = time.time() + osnInstance.configData["shutdown_timeout_msec"] / 1000.0
+    osnInstance.beginShutdown()
+    stopAgents(activeAgents, deadline, logger)
+    osnInstance.stop(deadline)
+    logger.info("All agents stopped. Terminating.")
+
+# agent worker processes import this module, so everything is only done when run as script
+if __name__ == "__main__":
+    main()
+    # quit is only called after the stop()-sequence of each agent (cleanup etc) was completed
+    quit()
@@ -22,27 +22,387 @@ You should have received a copy of the GNU General Public License
 along with opensense. If not, see http://www.gnu.org/licenses.
 
 """
-import sched, time
+import time, socket, base64, heapq, collections
+from threading import Event
+import requests
+from ...core.json_stream import iterJsonArray
 from ...core.abstract_agent import *
 
 # eliminate urllib2 incopatibility between Python v2 and v3
 try:
     # For Python 3.0 and later
     from urllib import request
+    from urllib.parse import quote
 except ImportError:
     # Fall back to Python 2's urllib2
     import urllib2 as request
+    from urllib import quote
+
+class OpenHABConnection(Thread):
+    """
+    Fetches the item states of a single OpenHAB instance, either from its
+    event stream or by polling, and hands them to the agent. Every instance
+    has a thread, a connection pool and schedules of its own, so a slow or
+    unreachable instance doesn't delay the others.
+    """
+
+    def __init__(self, agent, name, settings):
+        Thread.__init__(self)
+        self.daemon = True
+        self.agent = agent
+        self.instanceName = name
+        self.settings = settings
+        self.logger = agent.logger
+        if name:
+            self.logger = logging.getLogger("%s.%s" % (agent.__class__.__name__, name))
+        self.isRunning = False
+        self.pollQueue = [] # heap of (due time, item name)
+        self.pollIntervals = {} # item name -> current poll interval in seconds
+        self.lastStates = {} # item name -> last polled state
+        # one keep-alive session for all requests to OpenHAB instead of a new connection per poll
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = 4))
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = 4))
+        if self.settings["openhab_username"] != "":
+            self.session.auth = (self.settings["openhab_username"], self.settings["openhab_password"])
+        # ETags of item list responses, per set of items fetched - a 304 only means that the items we
+        # are interested in did not change if the previous response was handled for the very same items
+        self.itemsETags = collections.OrderedDict()
+        self.stopEvent = Event()
+        self.pollWakeUp = Event() # set on stop and when items became active
+        self.newItemsPending = False
+        self.eventStream = None
+
+    def syncAllValues(self):
+        """Fetches the states of all configured items once and sends them."""
+        states = self.fetchStates(self.activeItemNames())
+        if states is not None:
+            for itemName, state in states.items():
+                # unchanged values are dropped by the value filter (see defaultValueFilter)
+                self.agent.sendValue(self.localId(itemName), state)
+
+    def fetchStates(self, itemNames):
+        """
+        Fetches the states of the given items. A few items are fetched one by
+        one, otherwise the item list is fetched, reduced to names and states on
+        the server side. Returns a dict of item name -> state, which lacks the
+        items whose state is unknown or didn't change since the last fetch of
+        the same items, or None if OpenHAB could not be reached.
+        """
+        states = {}
+        if len(itemNames) <= self.settings["max_single_item_requests"]:
+            for itemName in itemNames:
+                state = self.getItemStateFromOpenHAB(itemName)
+                if state is not None:
+                    states[itemName] = state
+            if itemNames and not states:
+                return None
+            return states
+        items = self.getJsonFromOpenHAB(fields = "name,state", eTagKey = frozenset(itemNames))
+        if items == False:
+            return None
+        wanted = set(itemNames)
+        for item in items:
+            if "name" in item and "state" in item and item["name"] in wanted:
+                states[item["name"]] = item["state"]
+        return states
+
+    def activeItemNames(self):
+        return [self.itemName(sensor["local_id"]) for sensor in self.agent.sensorRegistry if self.servesSensor(sensor.get("local_id"))]
+
+    def localId(self, itemName):
+        """Items of named instances are namespaced as <instance name>:<item name> in sensor_mappings."""
+        if self.instanceName:
+            return "%s:%s" % (self.instanceName, itemName)
+        return itemName
+
+    def itemName(self, localId):
+        if self.instanceName:
+            return localId[len(self.instanceName) + 1:]
+        return localId
+
+    def servesSensor(self, localId):
+        if not self.agent.sensorActive(localId):
+            return False
+        if self.instanceName:
+            return ("%s" % localId).startswith(self.instanceName + ":")
+        return True
+
+    def run(self):
+        self.isRunning = True
+        try:
+            # keep going whatever happens, this instance's problems must not affect other instances
+            while self.isRunning:
+                try:
+                    if self.settings["update_mode"] == "events":
+                        self.runEventStream()
+                    else:
+                        self.pollUntil(None)
+                except BaseException as e:
+                    self.logger.warning("Unexpected error while fetching from OpenHAB. Exception message: %s" % e)
+                    self.stopEvent.wait(1)
+        finally:
+            # closed by this thread only, so that stop() can't pull the session from under a pending request
+            self.session.close()
+
+    def runEventStream(self):
+        """
+        Receives item state changes from OpenHAB's server-sent events stream
+        until stopped. All items are synced once whenever the
+        stream is (re)connected, as changes might have been missed meanwhile.
+        If the stream can't be opened, items are polled instead and the
+        stream is retried after event_stream_retry_msec.
+        """
+        while self.isRunning:
+            try:
+                self.eventStream = self.openEventStream()
+            except BaseException as e:
+                self.logger.info("Could not subscribe to OpenHAB event stream - polling instead. Exception message: %s" % e)
+                self.pollUntil(time.time() + self.settings["event_stream_retry_msec"] / 1000.0)
+                continue
+            self.logger.info("Subscribed to OpenHAB event stream.")
+            try:
+                self.syncAllValues()
+                self.readEventStream(self.eventStream)
+            except socket.timeout:
+                self.logger.info("OpenHAB event stream idle for too long. Reconnecting.")
+            except BaseException as e:
+                if self.isRunning:
+                    self.logger.info("OpenHAB event stream interrupted. Reconnecting. Exception message: %s" % e)
+                    self.stopEvent.wait(1) # don't hammer a server that closes streams right away
+            finally:
+                self.closeEventStream()
+
+    def openEventStream(self):
+        restEndpoint = self.settings["openhab_instance"] + "/rest/events?topics=" + self.settings["event_topics"]
+        req = request.Request(restEndpoint)
+        req.add_header('Accept', 'text/event-stream')
+        if self.settings["openhab_username"] != "":
+            credentials = "%s:%s" % (self.settings["openhab_username"], self.settings["openhab_password"])
+            req.add_header('Authorization', 'Basic %s' % base64.b64encode(credentials.encode("utf-8")).decode("ascii"))
+        handle = request.urlopen(req, timeout = self.settings["event_stream_idle_timeout_msec"] / 1000.0)
+        if not handle.headers.get("Content-Type", "").startswith("text/event-stream"):
+            handle.close()
+            raise IOError("OpenHAB answered with %s instead of an event stream" % handle.headers.get("Content-Type"))
+        return handle
+
+    def interruptEventStream(self):
+        """
+        Ends a pending read of the event stream from another thread. Closing
+        the stream would wait for that read to finish, so the socket is shut
+        down instead. If that's not possible, the read ends once the stream
+        was idle for event_stream_idle_timeout_msec.
+        """
+        eventStream = self.eventStream
+        if eventStream is None:
+            return
+        try:
+            eventStream.fp.raw._sock.shutdown(socket.SHUT_RDWR)
+        except BaseException:
+            pass
+
+    def closeEventStream(self):
+        eventStream = self.eventStream
+        self.eventStream = None
+        if eventStream is not None:
+            try:
+                eventStream.close()
+            except BaseException:
+                pass
+
+    def readEventStream(self, eventStream):
+        """Parses server-sent events line by line - data lines are collected until a blank line ends the event."""
+        dataLines = []
+        while self.isRunning:
+            line = eventStream.readline()
+            if not line:
+                raise IOError("event stream closed by OpenHAB")
+            line = line.decode("utf-8").rstrip("\r\n")
+            if line == "":
+                if dataLines:
+                    self.handleEvent("\n".join(dataLines))
+                    dataLines = []
+            elif line.startswith("data:"):
+                dataLines.append(line[5:].lstrip(" "))
+            # comments (keep-alives), event types and ids are of no interest to us
+
+    def handleEvent(self, data):
+        try:
+            event = json.loads(data)
+            topic = event["topic"].split("/")
+            if len(topic) < 4 or topic[1] != "items" or topic[3] != "statechanged":
+                return
+            itemName = topic[2]
+            if not self.agent.sensorActive(self.localId(itemName)):
+                return
+            state = json.loads(event["payload"])["value"]
+        except BaseException as e:
+            self.logger.debug("Could not interpret OpenHAB event %s. Exception message: %s" % (data, e))
+            return
+        self.agent.sendValue(self.localId(itemName), state)
+
+    def pollUntil(self, deadline):
+        """
+        Polls the configured items until the deadline passed (None for no
+        deadline) or the connection is stopped. Every item is polled at its own
+        interval - poll_interval_msec of its sensor mapping, or
+        update_interval_msec - which adaptive_polling adjusts to how often the
+        item actually changes. Items that are due at about the same time are
+        fetched together.
+        """
+        while self.isRunning and (deadline is None or time.time() < deadline):
+            if self.newItemsPending:
+                self.newItemsPending = False
+                self.schedulePolls(onlyNew = True)
+            if not self.pollQueue:
+                self.schedulePolls()
+                if not self.pollQueue:
+                    self.pollWakeUp.wait(self.settings["update_interval_msec"] / 1000.0) # no items configured yet
+                    self.pollWakeUp.clear()
+                    continue
+            wakeUp = self.pollQueue[0][0]
+            if deadline is not None:
+                wakeUp = min(wakeUp, deadline)
+            self.pollWakeUp.wait(max(0, wakeUp - time.time()))
+            self.pollWakeUp.clear()
+            if not self.isRunning or self.newItemsPending or time.time() < self.pollQueue[0][0]:
+                continue
+            batchEnd = time.time() + self.settings["poll_batch_window_msec"] / 1000.0
+            itemNames = []
+            while self.pollQueue and self.pollQueue[0][0] <= batchEnd:
+                itemNames.append(heapq.heappop(self.pollQueue)[1])
+            self.pollItems(itemNames)
+
+    def schedulePolls(self, onlyNew = False):
+        """
+        (Re)fills the poll queue with all configured items, due right away.
+        With onlyNew set, only items never scheduled before are added.
+        """
+        now = time.time()
+        if not onlyNew:
+            self.pollQueue = []
+        for sensor in self.agent.sensorRegistry:
+            if not self.servesSensor(sensor.get("local_id")):
+                continue
+            itemName = self.itemName(sensor["local_id"])
+            if itemName in self.pollIntervals:
+                if onlyNew:
+                    continue
+            else:
+                self.pollIntervals[itemName] = sensor.get("poll_interval_msec", self.settings["update_interval_msec"]) / 1000.0
+            heapq.heappush(self.pollQueue, (now, itemName))
+
+    def itemsActivated(self):
+        """
+        Called from other threads once sensors became active, e.g. after they
+        were created on the platform. Their items are polled right away.
+        """
+        self.newItemsPending = True
+        self.pollWakeUp.set()
+
+    def pollItems(self, itemNames):
+        states = self.fetchStates(itemNames)
+        now = time.time()
+        for itemName in itemNames:
+            interval = self.pollIntervals[itemName]
+            if states is not None:
+                state = states.get(itemName)
+                changed = state is not None and state != self.lastStates.get(itemName)
+                if state is not None:
+                    self.lastStates[itemName] = state
+                    # unchanged values are dropped by the value filter (see defaultValueFilter)
+                    self.agent.sendValue(self.localId(itemName), state)
+                if self.settings["adaptive_polling"]:
+                    if changed:
+                        interval = max(self.settings["min_poll_interval_msec"] / 1000.0, interval / 2)
+                    else:
+                        interval = min(self.settings["max_poll_interval_msec"] / 1000.0, interval * 1.5)
+                    self.pollIntervals[itemName] = interval
+            heapq.heappush(self.pollQueue, (now + interval, itemName))
+
+    # number of item sets whose ETag is remembered - with adaptive polling, batches are made up differently over time
+    maxETags = 32
+
+    def getJsonFromOpenHAB(self, fields = None, eTagKey = None):
+        """
+        Fetches OpenHAB's item list. Returns False if the request failed,
+        otherwise an iterator over the items, which are parsed one by one while
+        the response arrives. fields optionally restricts the attributes
+        OpenHAB returns per item. With eTagKey given (the set of items the
+        caller is interested in), the ETag of the last response for that key is
+        sent along and an empty list is returned if the items did not change
+        since.
+        """
+        restEndpoint = self.settings["openhab_instance"] + "/rest/items"
+        params = {}
+        if fields is not None:
+            params["fields"] = fields
+        headers = {"Accept": "application/json"}
+        if eTagKey is not None and eTagKey in self.itemsETags:
+            headers["If-None-Match"] = self.itemsETags[eTagKey]
+        #self.logger.debug("Trying to connect to OpenHAB instance's REST endpoint at %s" % restEndpoint)
+        try:
+            response = self.session.get(restEndpoint, params=params, headers=headers, stream=True, timeout=self.settings["openhab_request_timeout_msec"] / 1000.0)
+        except BaseException as e:
+            self.logger.info("Could not fetch data from OpenHAB. Configuration correct? Exception message: %s" % e)
+            return False
+        if response.status_code == 304:
+            response.close()
+            return []
+        if response.status_code != requests.codes.ok:
+            self.logger.info("Could not fetch data from OpenHAB. Configuration correct? Status code: %s" % response.status_code)
+            response.close()
+            return False
+        if eTagKey is not None:
+            self.itemsETags.pop(eTagKey, None)
+            if response.headers.get("ETag") is not None:
+                self.itemsETags[eTagKey] = response.headers.get("ETag")
+                if len(self.itemsETags) > self.maxETags:
+                    self.itemsETags.popitem(last = False)
+        return self.iterItems(response, eTagKey)
+
+    def iterItems(self, response, eTagKey = None):
+        try:
+            for item in iterJsonArray(response.iter_content(chunk_size = 65536)):
+                yield item
+        except BaseException as e:
+            self.itemsETags.pop(eTagKey, None) # we might have missed items, so don't skip them next time
+            self.logger.warning("Could not parse JSON from Openhab response. Exception message: %s" % e)
+        finally:
+            response.close()
+
+    def getItemStateFromOpenHAB(self, itemName):
+        """Fetches the state of a single item, returns None if that failed."""
+        restEndpoint = self.settings["openhab_instance"] + "/rest/items/" + quote(itemName) + "/state"
+        try:
+            response = self.session.get(restEndpoint, headers={"Accept": "text/plain"}, timeout=self.settings["openhab_request_timeout_msec"] / 1000.0)
+        except BaseException as e:
+            self.logger.info("Could not fetch state of %s from OpenHAB. Exception message: %s" % (itemName, e))
+            return None
+        if response.status_code != requests.codes.ok:
+            self.logger.info("Could not fetch state of %s from OpenHAB. Status code: %s" % (itemName, response.status_code))
+            return None
+        return response.text
+
+    def stop(self):
+        self.isRunning = False
+        self.stopEvent.set()
+        self.pollWakeUp.set()
+        self.interruptEventStream()
+
 
 class OpenHABAgent(AbstractAgent):
     """
     A donation agent collecting Data from an existing OpenHAB (http://openhab.org) installation.
     """
 
+    # items are polled, so by default only send values that changed
+    defaultValueFilter = {"deadband_absolute": 0}
+
     def __init__(self, configDir, osnInstance):
         AbstractAgent.__init__(self, configDir, osnInstance)
-        self.curSensorValues = {}
         configChanged = False
-        # we need some update interval in any case
+        # we need some update interval in any case - it is the default poll interval of items that don't set poll_interval_msec
         if "update_interval_msec" not in self.configData:
             self.configData["update_interval_msec"]=5000
             configChanged = True
@@ -55,81 +415,98 @@ class OpenHABAgent(AbstractAgent):
         if "openhab_password" not in self.configData:
             self.configData["openhab_password"]=""
             configChanged = True
+        # "polling" fetches the items periodically, "events" (opt-in) subscribes to OpenHAB's event stream for item
+        # state changes and only polls while the stream is unavailable
+        if "update_mode" not in self.configData:
+            self.configData["update_mode"]="polling"
+            configChanged = True
+        # OpenHAB 2 uses the "smarthome" namespace for its event topics, OpenHAB 3 and later "openhab"
+        if "event_topics" not in self.configData:
+            self.configData["event_topics"]="smarthome/items/*/statechanged,openhab/items/*/statechanged"
+            configChanged = True
+        # reconnect (and sync all items) if the event stream was silent for this long
+        if "event_stream_idle_timeout_msec" not in self.configData:
+            self.configData["event_stream_idle_timeout_msec"]=300000
+            configChanged = True
+        # while the event stream is unavailable, we poll and retry the stream after this time
+        if "event_stream_retry_msec" not in self.configData:
+            self.configData["event_stream_retry_msec"]=60000
+            configChanged = True
+        if "openhab_request_timeout_msec" not in self.configData:
+            self.configData["openhab_request_timeout_msec"]=10000
+            configChanged = True
+        # up to this number of configured items, states are fetched item by item instead of as part of the full item list
+        if "max_single_item_requests" not in self.configData:
+            self.configData["max_single_item_requests"]=10
+            configChanged = True
+        # adaptive polling shortens the poll interval of items whose state changed and extends it for static ones
+        if "adaptive_polling" not in self.configData:
+            self.configData["adaptive_polling"]=False
+            configChanged = True
+        if "min_poll_interval_msec" not in self.configData:
+            self.configData["min_poll_interval_msec"]=1000
+            configChanged = True
+        if "max_poll_interval_msec" not in self.configData:
+            self.configData["max_poll_interval_msec"]=60000
+            configChanged = True
+        # items that become due within this time after each other are fetched with the same request
+        if "poll_batch_window_msec" not in self.configData:
+            self.configData["poll_batch_window_msec"]=200
+            configChanged = True
         if configChanged:
             self.serializeConfig()
 
-        self.scheduler = sched.scheduler(time.time, time.sleep)
+        self.connections = [OpenHABConnection(self, instance.get("name", ""), instance) for instance in self.instanceSettings()]
+
+    def instanceSettings(self):
+        """
+        Returns the settings of every OpenHAB instance to fetch from. These are
+        the entries of openhab_instances, each with a unique "name" and the
+        keys of this config (like openhab_instance, openhab_username or
+        update_mode) that are to differ from it. Without openhab_instances, the
+        single instance configured by openhab_instance is used and items are
+        not namespaced.
+        """
+        instances = self.configData.get("openhab_instances") or [{"name": ""}]
+        settingsList = []
+        for instance in instances:
+            settings = dict(self.configData)
+            settings.update(instance)
+            settingsList.append(settings)
+        return settingsList
 
     def run(self):
-        # Todo: maybe some smarter way off connecting to OpenHAB than polling every x msec...
-        self.logger.info("OpenHAB agent started. Update interval is %s." % self.configData["update_interval_msec"])
         self.isRunning = True
-        self.updateValues()
-        self.scheduler.run()
-
-    def updateValues(self):
-        #self.logger.debug("updating OpenHab values...")
-        items = self.getJsonFromOpenHAB()
-        if items != False:
-            for item in items:
-                # checking for sensorActive is actually redundant here as sendValue already performs
-                # this test. However, we include it here for safety reasons and to prevent log-flooding
-                if "name" in item and "state" in item and self.sensorActive(item["name"]):
-                    value = item["state"]
-                    name = item["name"]
-                    # send only if nor previous value there or if value change
-                    if (name not in self.curSensorValues) or (self.curSensorValues[name] != value):
-                        #self.logger.debug("Item %s is at %s - sending value" % (item["name"], value))
-                        self.sendValue(name, value)
-                        self.curSensorValues[name] = value
-        # and now create the next update cycle. Probably, we'll do this later on a per-item basis,
-        # but for the moment, it seems ok to simply do it this way
-        if self.isRunning:
-            delay = self.configData["update_interval_msec"]
-            self.scheduler.enter(delay/1000, 1, self.updateValues, argument=())
+        for connection in self.connections:
+            self.logger.info("Fetching from OpenHAB instance %s (%s). Update mode is %s, default poll interval is %s msec." % \
+                (connection.instanceName or "default", connection.settings["openhab_instance"], connection.settings["update_mode"], connection.settings["update_interval_msec"]))
+            connection.start()
 
+    def sensorsProvisioned(self):
+        """Polls the items of sensors that just got their remote IDs in the background right away."""
+        for connection in self.connections:
+            connection.itemsActivated()
 
     def discoverSensors(self):
         itemTypesToRecognize = {"Number", "Contact"} # we dont't want to be flooded with switch- or group items
         configChanged = False
 
-        availableItems = self.getJsonFromOpenHAB()
-        if availableItems != False:
-            for item in availableItems:
-                if "name" in item and "type" in item:
-                    #self.logger.info("Name: %s, Type: %s" % (item["name"], item["type"]))
-                    if ((item["type"] in itemTypesToRecognize) and (not self.sensorConfigured(item["name"]))):
-                        self.logger.info("JSON item: %s" % item)
-                        self.addDefaultSensor(item["name"], "", "")
-                        configChanged = True
+        for connection in self.connections:
+            availableItems = connection.getJsonFromOpenHAB()
+            if availableItems != False:
+                for item in availableItems:
+                    if "name" in item and "type" in item:
+                        #self.logger.info("Name: %s, Type: %s" % (item["name"], item["type"]))
+                        localId = connection.localId(item["name"])
+                        if ((item["type"] in itemTypesToRecognize) and (not self.sensorConfigured(localId))):
+                            self.logger.info("JSON item: %s" % item)
+                            self.addDefaultSensor(localId, "", "")
+                            configChanged = True
 
         if configChanged:
             self.serializeConfig()
 
-    def getJsonFromOpenHAB(self):
-        retVal = False
-        restEndpoint = self.configData["openhab_instance"] + "/rest/items/"
-        req = request.Request(restEndpoint)
-        req.add_header('Accept', 'application/json')
-        #self.logger.debug("Trying to connect to OpenHAB instance's REST endpoint at %s" % restEndpoint)
-        response = ""
-        try:
-            handle = request.urlopen(req) # timeout of 10 secs should be ok
-            response = handle.read().decode("utf-8")
-            #self.logger.info("JSON response: %s" % response)
-            #self.logger.debug("sent value. json: %s response: %s" % (self.jsonData, response))
-            #self.logger.debug("Success.")
-        except BaseException as e:
-            self.logger.info("Could not fetch data from OpenHAB. Configuration correct? Exception message: %s" % e)
-        try:
-            availableItems = json.loads(response)
-            #self.logger.info("JSON content: %s" % availableItems)
-            retVal = availableItems
-        except BaseException as e:
-            self.logger.warning("Could not parse JSON from Openhab response. Exception message: %s" % e)
-        return retVal
-
     def stop(self):
-        for pendingEvent in self.scheduler.queue:
-            self.scheduler.cancel(pendingEvent) # could be that this does not work as the queue does not return events....
+        for connection in self.connections:
+            connection.stop()
         self.isRunning = False
@@ -25,66 +25,83 @@ along with opensense. If not, see http://www.gnu.org/licenses.
 
 import logging
 import sys
-
-import openzwave
-from openzwave.node import ZWaveNode
-from openzwave.value import ZWaveValue
-from openzwave.scene import ZWaveScene
-from openzwave.controller import ZWaveController
-from openzwave.network import ZWaveNetwork
-from openzwave.option import ZWaveOption
+import datetime
+from collections import deque
+from threading import Thread, Event
 import time
-from louie import dispatcher, All
-
-from os.path import expanduser, isfile
 
 from ...core.abstract_agent import *
+from ...core.config_store import configStore
+
+def createBackend(name, configData, configDir):
+    """Creates the network backend configured by zwave_backend. Backends are imported lazily as openzwave might not be installed."""
+    if name == "simulated":
+        from .backends.simulated_backend import SimulatedBackend
+        return SimulatedBackend(configData, configDir)
+    from .backends.openzwave_backend import OpenZWaveBackend
+    return OpenZWaveBackend(configData, configDir)
 
 class ZWaveAgent(AbstractAgent):
     """A Zwave Agent for directly collecting data from a ZWave network. Requires openzwave to be
-    installed (see tools folder) and ZWave Stick to be plugged in"""
+    installed (see tools folder) and ZWave Stick to be plugged in, unless the simulated backend is used"""
 
     def __init__(self, configDir, osnInstance):
         AbstractAgent.__init__(self, configDir, osnInstance)
 
-        log="Info" # should be read from config later
-
         configChanged = False
         if "zwave_device" not in self.configData:
             self.configData["zwave_device"] = "/dev/ttyACM0"
             configChanged = True
+        # "openzwave" for a real network, "simulated" for a simulated one (see backends/simulated_backend.py)
+        if "zwave_backend" not in self.configData:
+            self.configData["zwave_backend"] = "openzwave"
+            configChanged = True
+        # max. number of value updates waiting for being processed - if exceeded, the oldest ones are dropped
+        if "value_buffer_size" not in self.configData:
+            self.configData["value_buffer_size"] = 10000
+            configChanged = True
         if configChanged:
             self.serializeConfig()
 
         # handle zwave default device configurations
         self.zwaveDefaultConfigs = {}
+        self.defaultConfigIndex = {} # product id -> {value id -> value to be set}
         self.zwaveDefaultConfigFile = os.path.join(self.configDir, "zwavedefaultconfigs.config.json")
         self.readZwaveDefaultConfigs()
 
+        # fingerprints of the configuration applied to each node, so that unchanged nodes aren't configured again on every start.
+        # Delete the file for enforcing reconfiguration of all nodes.
+        self.nodeFingerprintFile = os.path.join(os.path.dirname(os.path.abspath(self.configDir)), self.osnInstance.configData["cache_dir"], "zwavenodes.cache.json")
+        self.nodeFingerprints = {}
+        self.readNodeFingerprints()
+
         self.device = self.configData["zwave_device"]
-        self.logger.debug("Initiating ZWaveAgent with device %s." % self.device)
-        self.zwaveOptions = ""
-        try:
-            self.zwaveOptions = ZWaveOption(self.device.encode('ascii'), \
-            config_path=expanduser("~")+"/ozw-install/python-open-zwave/openzwave/config", \
-            user_path=self.configDir, cmd_line="")
-            self.zwaveOptions.set_log_file("../log/openzwave.log") # Todo: don't hardcode openzwave-path
-            self.zwaveOptions.set_append_log_file(False)
-            self.zwaveOptions.set_console_output(False)
-            self.zwaveOptions.set_save_log_level(log)
-            self.zwaveOptions.set_logging(False)
-            self.zwaveOptions.lock()
-        except BaseException as e:
-            self.logger.info("Error setting up ZWave network. Correct device? Device properly connected? Device is: %s Exception message: %s" % (self.device, e))
+        self.logger.debug("Initiating ZWaveAgent with %s backend and device %s." % (self.configData["zwave_backend"], self.device))
+        self.backend = createBackend(self.configData["zwave_backend"], self.configData, self.configDir)
+        self.network = None
         self.inDiscoveryMode = False #scanning for available devices and sensors is slightly more complicated here...
 
+        # value updates are handed over from openzwave's notification thread to a consumer thread of our own
+        self.activeValueIds = frozenset()
+        self.valueBuffer = deque(maxlen = self.configData["value_buffer_size"])
+        self.valuesAvailable = Event()
+        self.valueConsumer = None
+        self.droppedValues = self.osnInstance.metrics.counter("zwave_dropped_values_total", "Z-Wave value updates dropped because the hand-off buffer was full")
+
+    def refreshActiveValueIds(self):
+        """Precomputes the value ids to be donated so that valueUpdate can discard all others right away."""
+        self.activeValueIds = frozenset(sensor["local_id"] for sensor in self.sensorRegistry if self.sensorActive(sensor.get("local_id")))
+
+    def sensorsProvisioned(self):
+        self.refreshActiveValueIds()
+
     def networkStarted(self, network):
         self.logger.info("Network %0.8x started" % network.home_id)
 
     def networkFailed(self, network):
         self.logger.warning("Sorry, Network couldn't be started...")
         if self.inDiscoveryMode:
-            self.logger("Discovery failed - terminating.")
+            self.logger.warning("Discovery failed - terminating.")
             self.stop()
 
     def networkReady(self, network):
@@ -93,6 +110,8 @@ class ZWaveAgent(AbstractAgent):
         self.logger.info("\nNodes List:")
         self.logger.info("===========")
         configChanged = False
+        self.defaultConfigsChanged = False
+        self.nodeFingerprintsChanged = False
         for node in network.nodes:
             self.logger.info("Node %s: %s (battery: %s)" % (node, network.nodes[node].product_name, network.nodes[node].get_battery_level()))
             self.logger.info("Available Command Classes: %s" % network.nodes[node].command_classes)
@@ -107,6 +126,11 @@ class ZWaveAgent(AbstractAgent):
                     configChanged = True
                 self.logger.debug("Sensor %s has %s of %s (Unit: %s)" % (sensor, network.nodes[node].get_sensors()[sensor].label, \
                                                               network.nodes[node].get_sensor_value(sensor), network.nodes[node].get_sensors()[sensor].units))
+        # templates and fingerprints of all nodes are written at once
+        if self.defaultConfigsChanged:
+            self.serializeZwaveDefaultConfigs()
+        if self.nodeFingerprintsChanged:
+            self.serializeNodeFingerprints()
         if self.inDiscoveryMode:
             # as discovery is more complicated for Zwave, we have to do it this way.
             # in discovery Mode, the config including new default configurations is serialized, then the agent Is stopped.
@@ -115,8 +139,13 @@ class ZWaveAgent(AbstractAgent):
                 self.serializeConfig()
             self.isRunning = False # this ensures that runner stops this agent after discovery is completed
         else:
-            dispatcher.connect(self.nodeUpdate, ZWaveNetwork.SIGNAL_NODE)
-            dispatcher.connect(self.valueUpdate, ZWaveNetwork.SIGNAL_VALUE)
+            self.refreshActiveValueIds()
+            if self.valueConsumer is None:
+                self.valueConsumer = Thread(target = self.consumeValues)
+                self.valueConsumer.daemon = True
+                self.valueConsumer.start()
+            self.backend.connect(self.nodeUpdate, self.backend.SIGNAL_NODE)
+            self.backend.connect(self.valueUpdate, self.backend.SIGNAL_VALUE)
 
     def nodeUpdate(self, network, node):
         # maybe do something valuable here later...
@@ -126,43 +155,87 @@ class ZWaveAgent(AbstractAgent):
     def valueUpdate(self, network, node, value):
         # not sure whether this might produce redundancies in case of one value_id appearing for multiple nodes...
         # nonetheless, staying with this for the moment
-        self.sendValue(value.value_id, value.data)
+        # This runs in openzwave's notification thread, which must not be held up - so we only
+        # hand the value over to the consumer thread here. A deque's append needs no lock of ours.
+        if value.value_id not in self.activeValueIds:
+            return
+        if len(self.valueBuffer) == self.valueBuffer.maxlen:
+            self.droppedValues.inc()
+        self.valueBuffer.append((value.value_id, value.data, time.time()))
+        self.valuesAvailable.set()
+
+    def consumeValues(self):
+        """Runs in a thread of its own and sends the values handed over by valueUpdate."""
+        while self.isRunning:
+            self.valuesAvailable.wait()
+            self.valuesAvailable.clear()
+            while True:
+                try:
+                    valueId, data, timestamp = self.valueBuffer.popleft()
+                except IndexError:
+                    break
+                try:
+                    self.sendValue(valueId, data, datetime.datetime.utcfromtimestamp(timestamp))
+                except BaseException as e:
+                    self.logger.warning("Could not send value of %s. Exception message: %s" % (valueId, e))
 
     def configureNode(self,network, node):
         # Model-specific configuration of node. This definitely needs a complete rewrite later...
-        self.logger.info("Setting specific configuration for product %s (Product ID: %s)..." % (network.nodes[node].product_name, network.nodes[node].product_id))
         productId = network.nodes[node].product_id
-        defaultConfig = self.getDefaultDeviceConfiguration(productId)
-        if defaultConfig: # could also be empty in case this product has no default config yet
-            self.logger.debug("Got default config.")
-            for param in network.nodes[node].values.values(): # traverse through available parameters
-                self.logger.debug("Checking if default config exists for %s" % param.value_id)
-                if defaultConfig.has_key("%s" % param.value_id): # is this parameter specified in default config? we take the long value id as key to avoid misinterpretations
-                    self.logger.debug("Default config found. Now checking if default config contains a value")
-                    if defaultConfig["%s" % param.value_id].has_key("value"):
-                        self.logger.debug("Found value. Setting parameter <%s> to %s as specified in default config" % (param.label, defaultConfig["%s" % param.value_id]["value"]))
-                        param.data = defaultConfig["%s" % param.value_id]["value"]
-        else:
+        defaultValues = self.getDefaultDeviceConfiguration(productId)
+        if defaultValues: # could also be empty in case this product has no default config yet
+            nodeKey = "%0.8x:%s" % (network.home_id, node)
+            fingerprint = "%s|%s" % (productId, json.dumps(defaultValues, sort_keys = True))
+            if self.nodeFingerprints.get(nodeKey) == fingerprint:
+                self.logger.debug("Configuration of node %s (Product ID: %s) unchanged since last start. Skipping." % (node, productId))
+                return
+            self.logger.info("Setting specific configuration for product %s (Product ID: %s)..." % (network.nodes[node].product_name, productId))
+            nodeValues = network.nodes[node].values
+            for valueId, value in defaultValues.items(): # only the parameters specified in default config, we take the long value id as key to avoid misinterpretations
+                param = nodeValues.get(int(valueId))
+                if param is not None:
+                    self.logger.debug("Setting parameter <%s> to %s as specified in default config" % (param.label, value))
+                    param.data = value
+            self.nodeFingerprints[nodeKey] = fingerprint
+            self.nodeFingerprintsChanged = True
+        elif productId not in self.zwaveDefaultConfigs["products"]:
             self.logger.info("No default configuration found for device with product id %s - creating dumb template from what is reported..." % productId)
             newConfig = {}
             for param in network.nodes[node].values.values(): # traverse through available parameters
                 newConfig["product name"] = network.nodes[node].manufacturer_name + " " + network.nodes[node].product_name
-                newConfig[param.value_id] = {}
+                newConfig["%s" % param.value_id] = {}
                 note = param.label
                 if param.units:
                     note = note + " (" + param.units + ")"
-                newConfig[param.value_id]["note"] = note
-                newConfig[param.value_id]["parameter index"] = param.index
-                newConfig[param.value_id]["value"] = param.data
+                newConfig["%s" % param.value_id]["note"] = note
+                newConfig["%s" % param.value_id]["parameter index"] = param.index
+                newConfig["%s" % param.value_id]["value"] = param.data
             self.zwaveDefaultConfigs["products"][productId] = newConfig
-            self.serializeZwaveDefaultConfigs()
+            self.indexDefaultConfig(productId)
+            self.defaultConfigsChanged = True # serialized once all nodes are done
 
     def getDefaultDeviceConfiguration(self, productId):
+        """Returns value id -> value of all parameters the default config of the product sets."""
         self.logger.debug("getting zwave default configs for product id %s" % productId)
-        if self.zwaveDefaultConfigs["products"].has_key(productId):
-            return self.zwaveDefaultConfigs["products"][productId]
-        else:
-            return {}
+        return self.defaultConfigIndex.get(productId, {})
+
+    def indexDefaultConfig(self, productId):
+        defaultValues = {}
+        for valueId, param in self.zwaveDefaultConfigs["products"][productId].items():
+            if isinstance(param, dict) and "value" in param:
+                defaultValues["%s" % valueId] = param["value"]
+        self.defaultConfigIndex[productId] = defaultValues
+
+    def readNodeFingerprints(self):
+        if os.path.isfile(self.nodeFingerprintFile):
+            try:
+                with open(self.nodeFingerprintFile) as cacheFileHandle:
+                    self.nodeFingerprints = json.load(cacheFileHandle)
+            except BaseException as e:
+                self.logger.warning("Could not read node fingerprints from %s - all nodes will be configured. Exception message: %s" % (self.nodeFingerprintFile, e))
+
+    def serializeNodeFingerprints(self):
+        configStore.write(self.nodeFingerprintFile, self.nodeFingerprints)
 
     def readZwaveDefaultConfigs(self):
         self.logger.debug("reading zwave default device configs from %s" % self.zwaveDefaultConfigFile)
@@ -173,23 +246,23 @@ class ZWaveAgent(AbstractAgent):
         if "products" not in self.zwaveDefaultConfigs:
             self.zwaveDefaultConfigs["products"]={}
             configChanged = True
+        for productId in self.zwaveDefaultConfigs["products"]:
+            self.indexDefaultConfig(productId)
         if (configChanged):
             self.serializeZwaveDefaultConfigs()
 
     def serializeZwaveDefaultConfigs(self):
-        with open(self.zwaveDefaultConfigFile, "w") as configFileHandle:
-            self.logger.info("Serializing zwave default device configs to %s." % self.zwaveDefaultConfigFile)
-            json.dump(self.zwaveDefaultConfigs, configFileHandle, sort_keys = False, indent = 4, ensure_ascii=False)
-            # data_file.close
+        self.logger.info("Serializing zwave default device configs to %s." % self.zwaveDefaultConfigFile)
+        configStore.write(self.zwaveDefaultConfigFile, self.zwaveDefaultConfigs)
 
     def run(self):
         self.isRunning = True
         #Create a network object
-        self.network = ZWaveNetwork(self.zwaveOptions, autostart=False)
+        self.network = self.backend.createNetwork()
         #and connect our above handlers to respective events
-        dispatcher.connect(self.networkStarted, ZWaveNetwork.SIGNAL_NETWORK_STARTED)
-        dispatcher.connect(self.networkFailed, ZWaveNetwork.SIGNAL_NETWORK_FAILED)
-        dispatcher.connect(self.networkReady, ZWaveNetwork.SIGNAL_NETWORK_READY)
+        self.backend.connect(self.networkStarted, self.backend.SIGNAL_NETWORK_STARTED)
+        self.backend.connect(self.networkFailed, self.backend.SIGNAL_NETWORK_FAILED)
+        self.backend.connect(self.networkReady, self.backend.SIGNAL_NETWORK_READY)
         self.network.start()
 
     def discoverSensors(self):
@@ -199,5 +272,7 @@ class ZWaveAgent(AbstractAgent):
         self.run()
 
     def stop(self):
-        self.network.stop()
+        if self.network is not None:
+            self.network.stop()
         self.isRunning = False
+        self.valuesAvailable.set() # wakes up the consumer, which sends what is buffered and terminates
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+
+This file is part of **opensense** project https://github.com/opensense-network/.
+    :platform: Unix, Windows, MacOS X
+    :sinopsis: opensense
+
+.. moduleauthor:: Frank Pallas <frank.pallas@tu-berlin.de>
+
+License : GPL(v3)
+
+**opensense** is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+**opensense** is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with opensense. If not, see http://www.gnu.org/licenses.
+
+"""
+import logging
+
+import openzwave
+from openzwave.network import ZWaveNetwork
+from openzwave.option import ZWaveOption
+from louie import dispatcher
+
+from os.path import expanduser
+
+class OpenZWaveBackend:
+    """
+    Z-Wave network backend talking to a physical controller stick via the
+    openzwave library. Requires openzwave to be installed (see tools folder).
+    """
+
+    SIGNAL_NETWORK_STARTED = ZWaveNetwork.SIGNAL_NETWORK_STARTED
+    SIGNAL_NETWORK_FAILED = ZWaveNetwork.SIGNAL_NETWORK_FAILED
+    SIGNAL_NETWORK_READY = ZWaveNetwork.SIGNAL_NETWORK_READY
+    SIGNAL_NODE = ZWaveNetwork.SIGNAL_NODE
+    SIGNAL_VALUE = ZWaveNetwork.SIGNAL_VALUE
+
+    def __init__(self, configData, configDir):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        log="Info" # should be read from config later
+        self.device = configData["zwave_device"]
+        self.zwaveOptions = ""
+        try:
+            self.zwaveOptions = ZWaveOption(self.device.encode('ascii'), \
+            config_path=expanduser("~")+"/ozw-install/python-open-zwave/openzwave/config", \
+            user_path=configDir, cmd_line="")
+            self.zwaveOptions.set_log_file("../log/openzwave.log") # Todo: don't hardcode openzwave-path
+            self.zwaveOptions.set_append_log_file(False)
+            self.zwaveOptions.set_console_output(False)
+            self.zwaveOptions.set_save_log_level(log)
+            self.zwaveOptions.set_logging(False)
+            self.zwaveOptions.lock()
+        except BaseException as e:
+            self.logger.info("Error setting up ZWave network. Correct device? Device properly connected? Device is: %s Exception message: %s" % (self.device, e))
+
+    def createNetwork(self):
+        return ZWaveNetwork(self.zwaveOptions, autostart=False)
+
+    def connect(self, handler, signal):
+        dispatcher.connect(handler, signal)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+
+This file is part of **opensense** project https://github.com/opensense-network/.
+    :platform: Unix, Windows, MacOS X
+    :sinopsis: opensense
+
+.. moduleauthor:: Frank Pallas <frank.pallas@tu-berlin.de>
+
+License : GPL(v3)
+
+**opensense** is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+**opensense** is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with opensense. If not, see http://www.gnu.org/licenses.
+
+"""
+import time
+import random
+import logging
+from threading import Thread, Event, Lock
+
+class SimulatedValue(object):
+    """A value of a simulated node, offering the attributes of openzwave's ZWaveValue the agent uses."""
+
+    def __init__(self, valueId, index, label, units, data):
+        self.value_id = valueId
+        self.index = index
+        self.label = label
+        self.units = units
+        self.data = data
+
+class SimulatedNode(object):
+    """A simulated node, offering the attributes and methods of openzwave's ZWaveNode the agent uses."""
+
+    def __init__(self, nodeId, productId, productName, sensorValues, configValues):
+        self.node_id = nodeId
+        self.product_id = productId
+        self.product_name = productName
+        self.manufacturer_name = "Simulated"
+        self.command_classes = set(["COMMAND_CLASS_SENSOR_MULTILEVEL", "COMMAND_CLASS_CONFIGURATION", "COMMAND_CLASS_BATTERY"])
+        self.sensors = dict((value.value_id, value) for value in sensorValues)
+        self.values = dict((value.value_id, value) for value in sensorValues + configValues)
+
+    def get_battery_level(self):
+        return 100
+
+    def get_sensors(self):
+        return self.sensors
+
+    def get_sensor_value(self, valueId):
+        return self.sensors[valueId].data
+
+class SimulatedController(object):
+    def __init__(self, node):
+        self.node = node
+        self.node_id = node.node_id
+
+class SimulatedNetwork:
+    """
+    A simulated Z-Wave network. start() signals network started and ready
+    after a configurable delay and then emits value updates of random
+    sensor values at a configurable total rate until stop() is called.
+    """
+
+    sensorTypes = [("Temperature", "C", 15.0, 30.0), ("Relative Humidity", "%", 20.0, 80.0), ("Luminance", "lux", 0.0, 1000.0), ("Power", "W", 0.0, 3000.0)]
+
+    def __init__(self, backend, numNodes, valuesPerNode, configValuesPerNode, numProducts, updatesPerSec, startupDelay):
+        self.backend = backend
+        self.updatesPerSec = updatesPerSec
+        self.startupDelay = startupDelay
+        self.home_id = 0x0badcafe
+        self.stopEvent = Event()
+        self.numUpdates = 0
+        self.nodes = {}
+        controllerNode = SimulatedNode(1, "0x0000", "Simulated Controller", [], [])
+        self.nodes[1] = controllerNode
+        self.controller = SimulatedController(controllerNode)
+        for nodeId in range(2, numNodes + 2):
+            productNumber = nodeId % numProducts
+            sensorValues = []
+            for index in range(valuesPerNode):
+                label, units, low, high = self.sensorTypes[index % len(self.sensorTypes)]
+                sensorValues.append(SimulatedValue(self.valueId(nodeId, 49, index), index, label, units, random.uniform(low, high)))
+            configValues = [SimulatedValue(self.valueId(nodeId, 112, index), index, "Parameter %s" % index, "", 0) for index in range(configValuesPerNode)]
+            self.nodes[nodeId] = SimulatedNode(nodeId, "0x%04x" % (productNumber + 1), "Simulated Sensor %s" % (productNumber + 1), sensorValues, configValues)
+        self.nodes_count = len(self.nodes)
+        self.sensorValues = [(node, value) for node in self.nodes.values() for value in node.sensors.values()]
+
+    @staticmethod
+    def valueId(nodeId, commandClass, index):
+        # unique and stable like openzwave's 64 bit value ids
+        return (nodeId << 32) | (commandClass << 16) | index
+
+    def start(self):
+        worker = Thread(target = self.simulate)
+        worker.daemon = True
+        worker.start()
+
+    def stop(self):
+        self.stopEvent.set()
+
+    def simulate(self):
+        if self.stopEvent.wait(self.startupDelay):
+            return
+        self.backend.send(self.backend.SIGNAL_NETWORK_STARTED, network = self)
+        self.backend.send(self.backend.SIGNAL_NETWORK_READY, network = self)
+        for node in self.nodes.values():
+            self.backend.send(self.backend.SIGNAL_NODE, network = self, node = node)
+        if self.updatesPerSec <= 0 or not self.sensorValues:
+            return
+        # values are emitted in small bursts so that high rates don't depend on sleep granularity
+        start = time.time()
+        while not self.stopEvent.is_set():
+            due = int((time.time() - start) * self.updatesPerSec)
+            while self.numUpdates < due:
+                node, value = random.choice(self.sensorValues)
+                _, _, low, high = self.sensorTypes[value.index % len(self.sensorTypes)]
+                value.data = random.uniform(low, high)
+                self.numUpdates += 1
+                self.backend.send(self.backend.SIGNAL_VALUE, network = self, node = node, value = value)
+            self.stopEvent.wait(0.01)
+
+class SimulatedBackend:
+    """
+    Z-Wave network backend simulating a network of sensor nodes, so that the
+    agent can be tried out, load-tested and profiled without a controller
+    stick or openzwave. Configured via the agent config keys
+    simulated_nodes, simulated_values_per_node,
+    simulated_config_values_per_node, simulated_products,
+    simulated_updates_per_sec and simulated_startup_msec.
+    """
+
+    SIGNAL_NETWORK_STARTED = "NetworkStarted"
+    SIGNAL_NETWORK_FAILED = "NetworkFailed"
+    SIGNAL_NETWORK_READY = "NetworkReady"
+    SIGNAL_NODE = "Node"
+    SIGNAL_VALUE = "ValueChanged"
+
+    def __init__(self, configData, configDir):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.configData = configData
+        self.handlers = {} # signal -> list of handlers
+        self.lock = Lock()
+
+    def createNetwork(self):
+        return SimulatedNetwork(self, self.configData.get("simulated_nodes", 10), self.configData.get("simulated_values_per_node", 4), \
+            self.configData.get("simulated_config_values_per_node", 10), self.configData.get("simulated_products", 3), \
+            self.configData.get("simulated_updates_per_sec", 10.0), self.configData.get("simulated_startup_msec", 0) / 1000.0)
+
+    def connect(self, handler, signal):
+        with self.lock:
+            self.handlers[signal] = self.handlers.get(signal, []) + [handler]
+
+    def send(self, signal, **arguments):
+        # like louie, handlers are called in the emitting thread
+        for handler in self.handlers.get(signal, []):
+            try:
+                handler(**arguments)
+            except BaseException as e:
+                self.logger.warning("Handler for signal %s failed. Exception message: %s" % (signal, e))
@@ -26,11 +26,25 @@ along with opensense. If not, see http://www.gnu.org/licenses.
 import logging
 import os
 import json
+import importlib
 from threading import Thread
 import datetime
 
+from .sensor_registry import SensorRegistry
+from .value_filter import ValueFilter
+from .aggregation import WindowAggregator
+from .value_record import numericValue, timestampMsFromUtcTime
+from .config_store import configStore
+from .sensor_provisioner import SensorProvisioner
+
 #from opensense import OpenSenseNetInstance
 
+def loadAgent(importName, className, configDir, osnInstance):
+    """Imports an agent's module and creates an instance of the agent."""
+    agentModule = importlib.import_module(importName)
+    agentClass = getattr(agentModule, className)
+    return agentClass(configDir, osnInstance)
+
 class AbstractAgent(Thread):
     """
     An abstract Agent class to be reimplemented by each specific Agent
@@ -49,6 +63,9 @@ class AbstractAgent(Thread):
 
     """
 
+    # filter settings (see ValueFilter) applied to sensors that don't configure their own
+    defaultValueFilter = {}
+
     def __init__(self, configDir, openSenseNetInstance):
         """
         Initializes the agent, particularly including the interpretation of
@@ -67,6 +84,10 @@ class AbstractAgent(Thread):
         self.configChanged = False
         self.isRunning = False
         self.configData = {}
+        self.sensorRegistry = None
+        self.valueFilters = {} # local id -> ValueFilter, or None if values of the sensor are not filtered
+        self.aggregator = WindowAggregator(self.sendAggregatedValue)
+        self.provisioner = None
         self.readConfig()
 
     def readConfig(self):
@@ -88,28 +109,46 @@ class AbstractAgent(Thread):
         if "sensor_mappings" not in self.configData:
             self.configData["sensor_mappings"]=[]
             configChanged = True
-        # create new sensors for each one marked as "create" in configfile
-        for sensor in self.configData["sensor_mappings"]:
-            if sensor.has_key("local_id") and sensor.has_key("remote_id") and sensor["remote_id"] == "create":
-                unitString = ""
-                measurandString = ""
-                if sensor.has_key("measurand"):
-                    measurandString = sensor["measurand"]
-                if sensor.has_key("unit"):
-                    unitString = sensor["unit"]
-                ret = self.osnInstance.createRemoteSensor(measurandString, unitString) #TODO: probably also detect other things like model etc here.
-                if ret:
-                    sensor["remote_id"] = "%s" % ret
-                    configChanged = True
+        self.sensorRegistry = SensorRegistry(self.configData["sensor_mappings"])
+        self.valueFilters = {}
+        for sensor in self.sensorRegistry:
+            if "local_id" in sensor and sensor.get("aggregation_window_msec", 0) > 0:
+                self.aggregator.configure(sensor["local_id"], sensor.get("aggregation", "mean"), sensor["aggregation_window_msec"])
         if (configChanged):
             self.serializeConfig()
+        # create new sensors for each one marked as "create" in configfile. This is done in the background
+        # so that the sensors already mapped are donated in the meantime.
+        pendingSensors = self.sensorRegistry.pendingCreation()
+        if pendingSensors and self.provisioner is None:
+            self.provisioner = SensorProvisioner(self.osnInstance, self.sensorRegistry, pendingSensors, self.provisioningFinished, \
+                self.osnInstance.configData["provisioning_max_parallel"], self.osnInstance.configData["default_sensor_license"])
+            self.provisioner.start()
+
+    def provisioningFinished (self, numCreated):
+        """Called by the provisioner once all sensors marked "create" were dealt with."""
+        if numCreated > 0:
+            self.serializeConfig()
+            self.sensorsProvisioned()
+
+    def sensorsProvisioned (self):
+        """
+        Hook for agents that cache which sensors are active. Called after
+        sensors marked "create" in the config got their remote IDs.
+        """
+        pass
+
+    def stopProvisioning (self, timeout = None):
+        """Stops creating further sensors and waits until the remote IDs of those created are serialized."""
+        if self.provisioner is not None:
+            self.provisioner.stop(timeout)
 
     def serializeConfig (self):
-        """Serializes config data according to directory- and naming-conventions used for donation agents"""
-        with open(self.configFile, "w") as configFileHandle:
-            self.logger.info("Serializing config to %s." % self.configFile)
-            json.dump(self.configData, configFileHandle, sort_keys = False, indent = 4, ensure_ascii=False)
-            # data_file.close
+        """
+        Serializes config data according to directory- and naming-conventions used for donation agents.
+        The file is written shortly afterwards in the background, so calling this often is cheap.
+        """
+        self.logger.info("Serializing config to %s." % self.configFile)
+        configStore.write(self.configFile, self.configData)
 
     def sendValue (self, localSensorId, value, utcTime = None):
         """
@@ -118,14 +157,58 @@ class AbstractAgent(Thread):
         mapping to remoteIDs as well as the identification whether data from
         a certain sensor is to be sent at all based on the agent-specific
         configuration-file.
+
+        For sensors with "aggregation_window_msec" set in their mapping, values
+        are not sent individually but aggregated over tumbling windows of that
+        length. "aggregation" selects mean (default), min, max, last or count.
         """
-        if utcTime == None:
-            utcTime = datetime.datetime.utcnow()
-        if (self.sensorConfigured(localSensorId) and self.remoteSensorIdFromLocalId(localSensorId) != ""):
-            remoteId = self.remoteSensorIdFromLocalId(localSensorId)
-            self.osnInstance.sendValue(remoteId, value, utcTime)
-        else:
-            self.logger.info("Sensor with local ID %s not configured for OpenSense or has no remote ID. Skipping" % localSensorId)
+        # utcTime None means now - the OpenSenseNet instance takes the timestamp
+        mapping = self.sensorRegistry.get(localSensorId)
+        if mapping is None or mapping.get("remote_id", "") in ("", SensorRegistry.createRemoteId):
+            self.logger.info("Sensor with local ID %s not configured for OpenSense or has no remote ID (yet). Skipping" % localSensorId)
+            return
+        if self.aggregator.configured(localSensorId):
+            numberValue = numericValue(value)
+            if numberValue is None:
+                self.logger.debug("Value %s of aggregated sensor %s is not a number. Skipping" % (value, localSensorId))
+                return
+            timestampMs = None
+            if utcTime is not None:
+                timestampMs = timestampMsFromUtcTime(utcTime)
+            self.aggregator.add(localSensorId, numberValue, timestampMs)
+            return
+        if not self.passesValueFilter(localSensorId, mapping, value):
+            return
+        self.osnInstance.sendValue(mapping["remote_id"], value, utcTime)
+
+    def sendAggregatedValue (self, localSensorId, value, utcTime):
+        """
+        Called by the aggregator whenever the window of a sensor with
+        "aggregation_window_msec" configured ended. The aggregated value is
+        subject to the sensor's value filter just like a raw value.
+        """
+        mapping = self.sensorRegistry.get(localSensorId)
+        if mapping is None or mapping.get("remote_id", "") in ("", SensorRegistry.createRemoteId):
+            return
+        if not self.passesValueFilter(localSensorId, mapping, value):
+            return
+        self.osnInstance.sendValue(mapping["remote_id"], value, utcTime)
+
+    def flushAggregation (self):
+        """Sends the aggregates of all windows still open. To be called once the agent is stopped."""
+        self.aggregator.flush()
+
+    def passesValueFilter(self, localSensorId, mapping, value):
+        """
+        Applies the deadband and interval settings of the sensor's mapping (see
+        ValueFilter) so that redundant values are dropped before being sent.
+        """
+        try:
+            valueFilter = self.valueFilters[localSensorId]
+        except KeyError:
+            valueFilter = ValueFilter.fromMapping(mapping, self.defaultValueFilter)
+            self.valueFilters[localSensorId] = valueFilter
+        return valueFilter is None or valueFilter.accept(value)
 
     def discoverSensors(self):
         """
@@ -139,23 +222,10 @@ class AbstractAgent(Thread):
         pass
 
     def remoteSensorIdFromLocalId(self, localSensorId):
-        remoteId = "uninitialized" # default for testing
-        for sensor in self.configData["sensor_mappings"]:
-            # travers through sensor mappings to find zwave_sensor_id
-            # print("traversing sensor_mappings: %s" % sensor)
-            if (sensor["local_id"] == localSensorId):
-                remoteId = sensor["remote_id"]
-                break
-        return remoteId
+        return self.sensorRegistry.remoteId(localSensorId, "uninitialized") # default for testing
 
     def sensorConfigured (self, localSensorId):
-        retVal = False
-        for sensor in self.configData["sensor_mappings"]:
-            # traverse through sensor mappings to find localSensorId
-            if (sensor["local_id"] == localSensorId):
-                retVal = True
-                break
-        return retVal
+        return self.sensorRegistry.isConfigured(localSensorId)
 
     def sensorActive (self, localSensorId):
         """
@@ -165,10 +235,7 @@ class AbstractAgent(Thread):
 
         Returns False if the sensor is not configured at all
         """
-        retVal = False
-        if self.sensorConfigured(localSensorId) and self.remoteSensorIdFromLocalId(localSensorId) != "":
-            retVal = True
-        return retVal
+        return self.sensorRegistry.isActive(localSensorId)
 
     def addDefaultSensor (self, localSensorId, measurandString, unitString, additional_params = None):
         if additional_params == None:
@@ -180,9 +247,17 @@ class AbstractAgent(Thread):
             # the parameters optionally provided in the method call
             params = {"local_id":localSensorId,"remote_id":"", "measurand":measurandString,"unit":unitString}
             params.update(additional_params)
-            self.configData["sensor_mappings"].append(params)
+            self.sensorRegistry.add(params)
             self.logger.debug("New default sensor (%s, %s) added for local ID %s. Locally added params: %s" % (measurandString, unitString, localSensorId, additional_params))
 
+    def removeSensor (self, localSensorId):
+        """
+        Removes the sensor mapping for the given local ID. Returns True if a
+        mapping was removed. Config must be serialized manually afterwards.
+        """
+        self.valueFilters.pop(localSensorId, None)
+        return self.sensorRegistry.remove(localSensorId) is not None
+
     def run(self):
         # this is the place for putting additional code that shall not run directly
         # in the initialization phase but should rather be triggered manually
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+
+This file is part of **opensense** project https://github.com/opensense-network/.
+    :platform: Unix, Windows, MacOS X
+    :sinopsis: opensense
+
+.. moduleauthor:: Frank Pallas <frank.pallas@tu-berlin.de>
+
+License : GPL(v3)
+
+**opensense** is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+**opensense** is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with opensense. If not, see http://www.gnu.org/licenses.
+
+"""
+import os
+import time
+import logging
+import signal
+import multiprocessing
+from threading import Thread, Lock, Condition, Event
+
+from .metrics import MetricsRegistry
+from .value_record import ValueRecord, numericValue, timestampMsFromUtcTime
+from .config_store import configStore
+from .retry import backoffDelay
+from .abstract_agent import loadAgent
+
+# waiting for several processes at once - not available in Python 2, where the supervisor checks once a second
+try:
+    from multiprocessing.connection import wait as waitForObjects
+except ImportError:
+    waitForObjects = None
+
+# spawned workers don't inherit locks held by threads of the runner at fork time - not available in Python 2
+try:
+    processContext = multiprocessing.get_context("spawn")
+except AttributeError:
+    processContext = multiprocessing
+
+class OpenSenseNetProxy:
+    """
+    Stands in for the OpenSenseNetInstance within an agent worker process.
+
+    Values passed to sendValue are turned into records right away and sent
+    to the runner process in batches of at most batchSize records, each
+    batch waiting at most lingerMsec for further values. The few other
+    calls agents make (creating sensors) are forwarded to the runner's
+    OpenSenseNetInstance and answered there. Metrics are kept locally.
+    """
+
+    # calls forwarded to the runner process
+    forwardedCalls = ("resolveSensorParams", "addRemoteSensor", "createRemoteSensor")
+
+    def __init__(self, configData, connection, batchSize = 100, lingerMsec = 100):
+        self.logger = logging.getLogger(__name__)
+        self.configData = configData
+        self.connection = connection
+        self.batchSize = batchSize
+        self.linger = lingerMsec / 1000.0
+        self.metrics = MetricsRegistry()
+        self.sendLock = Lock() # the connection is shared by the batch flusher and forwarded calls
+        self.batchCondition = Condition()
+        self.batch = []
+        self.batchDeadline = None
+        self.pendingCalls = {} # call id -> [Event, result]
+        self.nextCallId = 0
+        self.stopped = False
+        self.disconnected = False
+        self.flusher = Thread(target = self.batchFlusher)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def sendValue(self, remoteSensorId, value, utcTime = None):
+        numberValue = numericValue(value)
+        if numberValue is None:
+            self.logger.debug("Skipping non-numeric value <%s> for remote sensor id %s" % (value, remoteSensorId))
+            return
+        with self.batchCondition:
+            self.batch.append((remoteSensorId, numberValue, timestampMsFromUtcTime(utcTime)))
+            if len(self.batch) == 1:
+                self.batchDeadline = time.time() + self.linger
+                self.batchCondition.notify()
+            if len(self.batch) >= self.batchSize or self.stopped:
+                self.flushBatch() # after stop, there is no flusher anymore for values agents still send
+
+    def flushBatch(self):
+        """Sends the current batch to the runner process. Must be called with batchCondition held."""
+        if not self.batch:
+            return
+        batch = self.batch
+        self.batch = []
+        self.send(("values", batch))
+
+    def batchFlusher(self):
+        with self.batchCondition:
+            while not self.stopped:
+                if not self.batch:
+                    self.batchCondition.wait()
+                    continue
+                remaining = self.batchDeadline - time.time()
+                if remaining > 0:
+                    self.batchCondition.wait(remaining)
+                    continue
+                self.flushBatch()
+
+    def send(self, message):
+        try:
+            with self.sendLock:
+                self.connection.send(message)
+        except (IOError, OSError, EOFError, ValueError) as e:
+            if not self.disconnected:
+                self.logger.warning("Lost connection to runner process. Exception message: %s" % e)
+            self.disconnected = True
+
+    def call(self, method, *args):
+        """Calls method of the runner's OpenSenseNetInstance and waits for the result."""
+        finished = Event()
+        with self.batchCondition:
+            self.nextCallId += 1
+            callId = self.nextCallId
+            self.pendingCalls[callId] = [finished, None]
+        self.send(("call", callId, method, args))
+        while not finished.wait(1):
+            if self.disconnected:
+                break
+        with self.batchCondition:
+            return self.pendingCalls.pop(callId)[1]
+
+    def callReturned(self, callId, result):
+        with self.batchCondition:
+            pendingCall = self.pendingCalls.get(callId)
+            if pendingCall is not None:
+                pendingCall[1] = result
+                pendingCall[0].set()
+
+    def resolveSensorParams(self, measurandString, unitString, licenseString):
+        return self.call("resolveSensorParams", measurandString, unitString, licenseString)
+
+    def addRemoteSensor(self, params, additional_params = None):
+        return self.call("addRemoteSensor", params, additional_params)
+
+    def createRemoteSensor(self, measurandString, unitString, licenseString, additional_params = None):
+        return self.call("createRemoteSensor", measurandString, unitString, licenseString, additional_params)
+
+    def stop(self):
+        """Sends the values still batched."""
+        with self.batchCondition:
+            self.stopped = True
+            self.flushBatch()
+            self.batchCondition.notify()
+
+def runAgentWorker(agentSpecs, configDir, osnConfigData, connection, discover, batchSize, lingerMsec, logFile, logLevel):
+    """
+    Main function of an agent worker process. Creates and starts the agents
+    given as (import name, class name) and runs them until the runner asks
+    for stopping or, in discovery mode, until all of them are done.
+    """
+    # ctrl+c reaches the whole process group, and service managers send SIGTERM to all of its processes - the runner
+    # decides when to stop, so that values are handed over before the worker exits
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logging.basicConfig(filename=logFile, level=logLevel, format='%(asctime)s - %(processName)s - %(name)s - %(message)s')
+    logger = logging.getLogger("agentWorker")
+    osnProxy = OpenSenseNetProxy(osnConfigData, connection, batchSize, lingerMsec)
+    stopRequested = Event()
+
+    def receive():
+        while True:
+            try:
+                message = connection.recv()
+            except (IOError, OSError, EOFError):
+                stopRequested.set() # runner is gone
+                return
+            if message[0] == "result":
+                osnProxy.callReturned(message[1], message[2])
+            elif message[0] == "stop":
+                stopRequested.set()
+    receiver = Thread(target = receive)
+    receiver.daemon = True
+    receiver.start()
+
+    constructionStart = time.time()
+    agents = []
+    for importName, className in agentSpecs:
+        try:
+            logger.debug("importing %s and creating an instance..." % className)
+            agents.append(loadAgent(importName, className, configDir, osnProxy))
+        except BaseException as e:
+            logger.warning("Could not import and instantiate Agent %s. Exception message: %s" % (className, e))
+    logger.info("creating agents took %.3f sec" % (time.time() - constructionStart))
+    for agent in agents:
+        if discover:
+            logger.debug("starting agent instance %s in discovery mode..." % agent)
+            agent.discoverSensors()
+        else:
+            logger.debug("starting agent instance %s..." % agent)
+            agent.start()
+
+    while not stopRequested.wait(1):
+        if not any(agent.running() for agent in agents):
+            logger.debug("all agents of this worker are inactive")
+            break
+    for agent in agents:
+        agent.stop()
+        agent.flushAggregation()
+        agent.stopProvisioning()
+    osnProxy.stop()
+    configStore.flush()
+    osnProxy.send(("exit",))
+    connection.close()
+
+class AgentWorker:
+    """
+    The runner's handle of an agent worker process: starts the process and
+    hands the values it sends over to the OpenSenseNetInstance.
+    """
+
+    def __init__(self, supervisor, name, agentSpecs):
+        self.logger = logging.getLogger("%s.%s" % (__name__, name))
+        self.supervisor = supervisor
+        self.name = name
+        self.agentSpecs = agentSpecs
+        self.process = None
+        self.connection = None
+        self.receiver = None
+        self.sendLock = Lock()
+        self.finished = False # the worker exited on its own behalf, it must not be restarted
+        self.startedAt = 0
+        self.numFailures = 0 # consecutive failures, for backing off restarts
+        self.restartAt = None
+
+    def start(self):
+        supervisor = self.supervisor
+        self.connection, childConnection = processContext.Pipe()
+        self.process = processContext.Process(target = runAgentWorker, name = "agents-%s" % self.name, \
+            args = (self.agentSpecs, supervisor.configDir, supervisor.osnInstance.configData, childConnection, supervisor.discover, \
+                supervisor.batchSize, supervisor.lingerMsec, supervisor.logFile, supervisor.logLevel))
+        self.process.daemon = True
+        self.process.start()
+        childConnection.close()
+        self.startedAt = time.time()
+        self.restartAt = None
+        self.receiver = Thread(target = self.receive, name = "receiver-%s" % self.name)
+        self.receiver.daemon = True
+        self.receiver.start()
+        self.logger.info("started worker process %s for %s" % (self.process.pid, ", ".join(className for importName, className in self.agentSpecs)))
+
+    def receive(self):
+        osnInstance = self.supervisor.osnInstance
+        while True:
+            try:
+                message = self.connection.recv()
+            except (IOError, OSError, EOFError):
+                return # worker is gone, the supervisor takes care of it
+            if message[0] == "values":
+                for sensorId, value, timestampMs in message[1]:
+                    osnInstance.sendRecord(ValueRecord(sensorId, value, timestampMs))
+            elif message[0] == "call":
+                # forwarded calls may take a while - don't hold up values meanwhile
+                caller = Thread(target = self.answerCall, args = message[1:])
+                caller.daemon = True
+                caller.start()
+            elif message[0] == "exit":
+                self.finished = True
+                self.supervisor.workerFinished()
+
+    def answerCall(self, callId, method, args):
+        result = None
+        if method in OpenSenseNetProxy.forwardedCalls:
+            try:
+                result = getattr(self.supervisor.osnInstance, method)(*args)
+            except BaseException as e:
+                self.logger.warning("Forwarded call %s failed. Exception message: %s" % (method, e))
+        self.send(("result", callId, result))
+
+    def send(self, message):
+        try:
+            with self.sendLock:
+                self.connection.send(message)
+        except (IOError, OSError, EOFError, ValueError):
+            pass # worker is gone
+
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+class AgentProcessSupervisor(Thread):
+    """
+    Runs groups of agents in worker processes of their own, so that agents
+    don't compete with each other and with the sender threads for one
+    interpreter lock.
+
+    Every worker sends its values to this (the runner) process in batches
+    via a pipe, where they are handed to the OpenSenseNetInstance. Workers
+    that die are restarted, backing off exponentially up to
+    maxRestartDelaySec if they keep dying shortly after their start.
+    finishedEvent, if given, is set once all workers finished on their own
+    behalf (e.g. after discovery).
+    """
+
+    def __init__(self, osnInstance, configDir, agentGroups, discover = False, batchSize = 100, lingerMsec = 100, \
+            logFile = None, logLevel = logging.INFO, maxRestartDelaySec = 60, finishedEvent = None):
+        Thread.__init__(self)
+        self.daemon = True
+        self.logger = logging.getLogger(__name__)
+        self.osnInstance = osnInstance
+        self.configDir = configDir
+        self.discover = discover
+        self.batchSize = batchSize
+        self.lingerMsec = lingerMsec
+        self.logFile = logFile
+        self.logLevel = logLevel
+        self.maxRestartDelay = maxRestartDelaySec
+        self.workers = [AgentWorker(self, "%s" % (i + 1), agentSpecs) for i, agentSpecs in enumerate(agentGroups) if agentSpecs]
+        self.restarts = self.osnInstance.metrics.counter("agent_worker_restarts_total", "Agent worker processes restarted after they died")
+        self.finishedEvent = finishedEvent
+        self.stopEvent = Event()
+        self.wakeUpReader, self.wakeUpWriter = processContext.Pipe(False) # wakes up the supervisor waiting for workers on stop
+
+    def run(self):
+        for worker in self.workers:
+            worker.start()
+        if not self.workers:
+            self.workerFinished()
+        while not self.stopEvent.is_set():
+            timeout = self.superviseWorkers()
+            if waitForObjects is None:
+                self.stopEvent.wait(1)
+            else:
+                # wakes up as soon as a worker process exits, a restart is due, or on stop
+                waitForObjects([worker.process.sentinel for worker in self.workers if worker.alive()] + [self.wakeUpReader], timeout)
+
+    def superviseWorkers(self):
+        """Restarts dead workers when due. Returns the time till the next restart is due, or None."""
+        now = time.time()
+        nextRestart = None
+        for worker in self.workers:
+            if worker.finished or worker.alive():
+                continue
+            if worker.restartAt is None:
+                worker.receiver.join(1) # take over values sent before the worker died
+                if worker.finished:
+                    continue
+                if now - worker.startedAt > self.maxRestartDelay:
+                    worker.numFailures = 0
+                worker.numFailures += 1
+                worker.restartAt = now + backoffDelay(worker.numFailures, 1, self.maxRestartDelay)
+                self.logger.warning("worker process %s died with exit code %s, restarting it in %.1f seconds" % \
+                    (worker.process.pid, worker.process.exitcode, worker.restartAt - now))
+            if now >= worker.restartAt:
+                self.restarts.inc()
+                worker.start()
+            elif nextRestart is None or worker.restartAt < nextRestart:
+                nextRestart = worker.restartAt
+        if nextRestart is None:
+            return None
+        return max(0, nextRestart - time.time())
+
+    def workerFinished(self):
+        if self.finishedEvent is not None and not self.running():
+            self.finishedEvent.set()
+
+    def running(self):
+        """True as long as any worker has not finished on its own behalf."""
+        return any(not worker.finished for worker in self.workers)
+
+    def stop(self, timeoutSec = 30):
+        """
+        Asks all workers to stop their agents and waits until they did, at
+        most timeoutSec. Workers still running then are terminated.
+        """
+        self.stopEvent.set()
+        self.wakeUpWriter.send(None)
+        if self.is_alive():
+            self.join()
+        for worker in self.workers:
+            if worker.alive():
+                worker.send(("stop",))
+        deadline = time.time() + timeoutSec
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            worker.process.join(max(0, deadline - time.time()))
+            if worker.process.is_alive():
+                self.logger.warning("worker process %s did not stop in time, killing it" % worker.process.pid)
+                self.killWorker(worker)
+                worker.process.join()
+            worker.receiver.join(max(0, deadline - time.time()))
+
+    def killWorker(self, worker):
+        """Kills a worker process - terminate() is not enough, as workers ignore SIGTERM."""
+        try:
+            worker.process.kill()
+        except AttributeError:
+            # Python 2 lacks Process.kill(), on Windows terminate() kills the process anyway
+            if hasattr(signal, "SIGKILL"):
+                os.kill(worker.process.pid, signal.SIGKILL)
+            else:
+                worker.process.terminate()
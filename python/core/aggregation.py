@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+
+This file is part of **opensense** project https://github.com/opensense-network/.
+    :platform: Unix, Windows, MacOS X
+    :sinopsis: opensense
+
+.. moduleauthor:: Frank Pallas <frank.pallas@tu-berlin.de>
+
+License : GPL(v3)
+
+**opensense** is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+**opensense** is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with opensense. If not, see http://www.gnu.org/licenses.
+
+"""
+import time
+import heapq
+import logging
+import datetime
+from threading import Thread, Condition
+
+class Accumulator(object):
+    """Running aggregates of one sensor's readings within one window - raw samples are not kept."""
+    __slots__ = ("windowEnd", "count", "sum", "min", "max", "last")
+
+    def __init__(self, windowEnd):
+        self.windowEnd = windowEnd
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.last = value
+
+    def result(self, function):
+        if function == "mean":
+            return self.sum / self.count
+        if function == "min":
+            return self.min
+        if function == "max":
+            return self.max
+        if function == "count":
+            return self.count
+        return self.last
+
+class WindowAggregator:
+    """
+    Aggregates readings per sensor over tumbling windows.
+
+    Windows are aligned to multiples of their length since the epoch. When a
+    window ends, one value (mean, min, max, last or count of the readings
+    within it) is handed to the emit callback, timestamped at the window end.
+    A background thread closes windows on time, even if no further reading
+    arrives. Readings older than the open window or belonging to a window
+    already emitted are late - they are dropped and counted in
+    numLateReadings, so that every window is emitted once at most.
+    """
+
+    functions = ("mean", "min", "max", "last", "count")
+
+    def __init__(self, emitCallback):
+        self.logger = logging.getLogger(__name__)
+        self.emitCallback = emitCallback # called as emitCallback(localSensorId, value, utcTime)
+        self.condition = Condition()
+        self.accumulators = {} # local id -> Accumulator of the currently open window
+        self.settings = {} # local id -> (function, window length in ms)
+        self.windowEnds = [] # heap of (windowEnd, local id)
+        self.closedUntil = {} # local id -> end of the latest window emitted
+        self.numLateReadings = 0
+        self.stopped = False
+        self.worker = None
+
+    def configure(self, localSensorId, function, windowMsec):
+        if function not in self.functions:
+            self.logger.warning("Unknown aggregation %s for sensor %s - using last" % (function, localSensorId))
+            function = "last"
+        with self.condition:
+            self.settings[localSensorId] = (function, int(windowMsec))
+
+    def configured(self, localSensorId):
+        return localSensorId in self.settings
+
+    def add(self, localSensorId, value, timestampMs = None):
+        if timestampMs is None:
+            timestampMs = int(time.time() * 1000)
+        function, windowMsec = self.settings[localSensorId]
+        windowEnd = (timestampMs // windowMsec + 1) * windowMsec
+        dueResult = None
+        with self.condition:
+            if self.stopped:
+                # open windows were flushed already - the reading is emitted on its own right away
+                accumulator = Accumulator(windowEnd)
+                accumulator.add(value)
+                dueResult = (accumulator.result(function), timestampMs)
+            else:
+                accumulator = self.accumulators.get(localSensorId)
+                if windowEnd <= self.closedUntil.get(localSensorId, 0) or (accumulator is not None and windowEnd < accumulator.windowEnd):
+                    self.numLateReadings += 1
+                    self.logger.debug("Dropping late reading of sensor %s for the window ending at %s" % (localSensorId, windowEnd))
+                    return
+                if accumulator is not None and accumulator.windowEnd != windowEnd:
+                    # reading belongs to a later window than the open one, so that one is complete
+                    dueResult = (accumulator.result(function), accumulator.windowEnd)
+                    self.closedUntil[localSensorId] = accumulator.windowEnd
+                    accumulator = None
+                if accumulator is None:
+                    accumulator = Accumulator(windowEnd)
+                    self.accumulators[localSensorId] = accumulator
+                    heapq.heappush(self.windowEnds, (windowEnd, localSensorId))
+                    self.condition.notify()
+                accumulator.add(value)
+                if self.worker is None:
+                    self.worker = Thread(target = self.closeWindows)
+                    self.worker.daemon = True
+                    self.worker.start()
+        if dueResult is not None:
+            self.emit(localSensorId, dueResult[0], dueResult[1])
+
+    def emit(self, localSensorId, value, windowEndMs):
+        utcTime = datetime.datetime.utcfromtimestamp(windowEndMs / 1000.0)
+        try:
+            self.emitCallback(localSensorId, value, utcTime)
+        except BaseException as e:
+            self.logger.warning("Could not emit aggregated value for sensor %s. Exception message: %s" % (localSensorId, e))
+
+    def closeWindows(self):
+        """Runs in a background thread and emits the results of all windows that ended."""
+        while True:
+            due = []
+            with self.condition:
+                while not self.stopped and (not self.windowEnds or self.windowEnds[0][0] > time.time() * 1000):
+                    if self.windowEnds:
+                        self.condition.wait(self.windowEnds[0][0] / 1000.0 - time.time())
+                    else:
+                        self.condition.wait()
+                if self.stopped:
+                    break
+                now = time.time() * 1000
+                while self.windowEnds and self.windowEnds[0][0] <= now:
+                    windowEnd, localSensorId = heapq.heappop(self.windowEnds)
+                    accumulator = self.accumulators.get(localSensorId)
+                    if accumulator is not None and accumulator.windowEnd == windowEnd:
+                        del self.accumulators[localSensorId]
+                        self.closedUntil[localSensorId] = windowEnd
+                        due.append((localSensorId, accumulator.result(self.settings[localSensorId][0]), windowEnd))
+            for localSensorId, value, windowEnd in due:
+                self.emit(localSensorId, value, windowEnd)
+
+    def flush(self):
+        """
+        Emits the results of all open windows right away and stops the
+        background thread. Like complete windows, a partial window is
+        timestamped at its end, even though that may lie in the future.
+        Readings added afterwards are emitted one by one without aggregation.
+        """
+        with self.condition:
+            self.stopped = True
+            due = [(localSensorId, accumulator.result(self.settings[localSensorId][0]), accumulator.windowEnd) \
+                for localSensorId, accumulator in self.accumulators.items()]
+            self.accumulators = {}
+            self.windowEnds = []
+            self.condition.notify_all()
+        for localSensorId, value, windowEnd in due:
+            self.emit(localSensorId, value, windowEnd)
+        if self.numLateReadings > 0:
+            self.logger.info("dropped %s late readings" % self.numLateReadings)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+
+This file is part of **opensense** project https://github.com/opensense-network/.
+    :platform: Unix, Windows, MacOS X
+    :sinopsis: opensense
+
+.. moduleauthor:: Frank Pallas <frank.pallas@tu-berlin.de>
+
+License : GPL(v3)
+
+**opensense** is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+**opensense** is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with opensense. If not, see http://www.gnu.org/licenses.
+
+"""
+import logging
+import time
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+
+# requires Python 3 with asyncio and the aiohttp library. OpenSenseNetInstance
+# falls back to threaded sending if this module can't be imported.
+import asyncio
+import aiohttp
+
+class AsyncSender(Thread):
+    """
+    An asyncio-based alternative to the pool of threadedApiCallPOST sender threads.
+
+    Runs an event loop in a thread of its own, takes messages from the same
+    sending queue as the sender threads and keeps up to maxInFlight POST
+    requests in flight concurrently over a small pool of keep-alive
+    connections. Success/failure accounting, re-login on 401, retries and
+    the circuit breaker are delegated to the OpenSenseNetInstance
+    so that both sender modes behave the same.
+    """
+
+    def __init__(self, osnInstance, maxInFlight = 200, maxConnections = 4, requestTimeoutSec = 30, finishTimeoutSec = 2):
+        Thread.__init__(self)
+        self.daemon = True
+        self.logger = logging.getLogger(__name__)
+        self.osnInstance = osnInstance
+        self.maxInFlight = maxInFlight
+        self.maxConnections = maxConnections
+        self.requestTimeoutSec = requestTimeoutSec
+        self.finishTimeoutSec = finishTimeoutSec # grace period for requests still in flight on shutdown
+        # blocking queue access is done in helper threads to keep the loop responsive
+        self.queueExecutor = ThreadPoolExecutor(max_workers = 1)
+
+    def run(self):
+        self.logger.debug("starting asyncio sender with at most %s requests in flight over %s connections" % (self.maxInFlight, self.maxConnections))
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.sendLoop())
+        finally:
+            loop.close()
+        self.logger.debug("exiting asyncio sender")
+
+    async def sendLoop(self):
+        loop = asyncio.get_event_loop()
+        sslSetting = None # default validation
+        if not self.osnInstance.configData["validate_certificate"]:
+            sslSetting = False
+        connector = aiohttp.TCPConnector(limit = self.maxConnections, ssl = sslSetting)
+        timeout = aiohttp.ClientTimeout(total = self.requestTimeoutSec)
+        inFlight = asyncio.Semaphore(self.maxInFlight)
+        sendTasks = set()
+        async with aiohttp.ClientSession(connector = connector, timeout = timeout) as session:
+            while not self.osnInstance.stopped:
+                if not self.osnInstance.tokenManager.token():
+                    # not logged in yet - values are kept in the queue meanwhile
+                    await loop.run_in_executor(self.queueExecutor, self.osnInstance.tokenManager.waitForToken, 1)
+                    continue
+                if not self.osnInstance.circuitBreaker.allowRequest():
+                    # endpoint is considered to be down - pause instead of hammering it
+                    await asyncio.sleep(max(0.1, self.osnInstance.circuitBreaker.secondsUntilProbe()))
+                    continue
+                await inFlight.acquire()
+                messageObject = await loop.run_in_executor(self.queueExecutor, self.osnInstance.threadedSendingQueue.get)
+                if messageObject is None:
+                    self.osnInstance.circuitBreaker.releaseProbe()
+                    inFlight.release()
+                    break # queue closed on shutdown
+                sendTask = loop.create_task(self.send(session, messageObject, inFlight))
+                sendTasks.add(sendTask)
+                sendTask.add_done_callback(sendTasks.discard)
+            await self.finishSending(sendTasks)
+
+    async def finishSending(self, sendTasks):
+        """
+        Lets the requests still in flight finish for at most finishTimeoutSec
+        and cancels the rest, before the session and the loop are closed.
+        Cancelled messages remain in the spool and are sent after restart.
+        """
+        if not sendTasks:
+            return
+        done, pending = await asyncio.wait(set(sendTasks), timeout = self.finishTimeoutSec)
+        if pending:
+            self.logger.info("cancelling %s requests still in flight" % len(pending))
+            for sendTask in pending:
+                sendTask.cancel()
+            await asyncio.wait(pending)
+
+    async def send(self, session, messageObject, inFlight):
+        osn = self.osnInstance
+        callURI = messageObject.getPostUri()
+        token = osn.tokenManager.token()
+        heads = {"Content-Type": "application/json", "Accept": "application/json", "Authorization":token}
+        osn.queueWaitTime.record(time.time() - messageObject.queuedAt)
+        try:
+            requestStart = time.time()
+            async with session.post(callURI, json = messageObject.getJsonData(), headers = heads) as response:
+                statusCode = response.status
+            osn.httpRoundTrip.record(time.time() - requestStart)
+            if statusCode == 200:
+                osn.messageSent(messageObject)
+            else:
+                osn.logger.debug("Couldn't perform async api POST call to %s. Response Code: %s. Num succeeded / failed threads: %s / %s" % (callURI, statusCode, osn.succeededRequests.value(), osn.failedRequests.value()))
+                if statusCode == 401:
+                    osn.messageUnauthorized(messageObject, token)
+                else:
+                    osn.messageFailed(messageObject, osn.isEndpointFailure(statusCode))
+        except asyncio.CancelledError:
+            # cancelled on shutdown - the message stays in the spool
+            osn.threadedSendingQueue.abandon(messageObject)
+            raise
+        except BaseException as e:
+            osn.logger.debug("Couldn't perform async api POST call to %s. Exception message: %s. Scheduling message for retry. Num succeeded / failed threads: %s / %s" % (callURI, e, osn.succeededRequests.value(), osn.failedRequests.value()))
+            osn.messageFailed(messageObject)
+        finally:
+            inFlight.release()
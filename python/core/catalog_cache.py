@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+
+This file is part of **opensense** project https://github.com/opensense-network/.
+    :platform: Unix, Windows, MacOS X
+    :sinopsis: opensense
+
+.. moduleauthor:: Frank Pallas <frank.pallas@tu-berlin.de>
+
+License : GPL(v3)
+
+**opensense** is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+**opensense** is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with opensense. If not, see http://www.gnu.org/licenses.
+
+"""
+import json
+import time
+import os
+import logging
+from threading import Lock
+from .config_store import configStore
+
+class CatalogCache:
+    """
+    A persistent cache for the platform's catalog of measurand-, unit- and license-IDs.
+
+    Entries are kept per kind ("measurand", "unit", "license") and expire
+    after a configurable time. Negative results (a name the platform does
+    not know) are cached as well, using a shorter expiry. Once a complete
+    catalog of a kind has been stored via storeCatalog(), lookups for names
+    not contained in it are answered negatively without asking the platform
+    again until the catalog expires. The cache is persisted to a JSON file
+    through the write-behind config store so that it survives restarts.
+    """
+
+    def __init__(self, cacheFile, ttlSec = 86400, negativeTtlSec = 600):
+        self.logger = logging.getLogger(__name__)
+        self.cacheFile = cacheFile
+        self.ttl = ttlSec
+        self.negativeTtl = negativeTtlSec
+        self.lock = Lock()
+        self.entries = {} # kind -> {key: [value, expiresAt]}
+        self.completeCatalogs = {} # kind -> expiresAt
+        self.read()
+
+    def read(self):
+        if not os.path.isfile(self.cacheFile):
+            return
+        try:
+            with open(self.cacheFile) as cacheFileHandle:
+                cacheData = json.load(cacheFileHandle)
+            self.entries = cacheData.get("entries", {})
+            self.completeCatalogs = cacheData.get("complete", {})
+            self.logger.debug("read catalog cache from %s" % self.cacheFile)
+        except BaseException as e:
+            self.logger.warning("Could not read catalog cache from %s, starting empty. Exception message: %s" % (self.cacheFile, e))
+
+    def serialize(self):
+        """Schedules writing the cache to disk via the write-behind config store. Must be called with lock held."""
+        configStore.write(self.cacheFile, {"entries":self.entries, "complete":self.completeCatalogs})
+
+    def lookup(self, kind, key):
+        """
+        Returns a tuple (found, value). value is None for cached negative
+        results. found is False if the platform must be asked.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(kind, {}).get(key)
+            if entry is not None and entry[1] > now:
+                return (True, entry[0])
+            if self.completeCatalogs.get(kind, 0) > now:
+                return (True, None)
+        return (False, None)
+
+    def store(self, kind, key, value):
+        """Stores a single lookup result. value None marks a negative result."""
+        ttl = self.ttl
+        if value is None:
+            ttl = self.negativeTtl
+        with self.lock:
+            self.entries.setdefault(kind, {})[key] = [value, time.time() + ttl]
+            self.serialize()
+
+    def storeCatalog(self, kind, catalog):
+        """Replaces all entries of the given kind with a complete catalog given as dict key -> value."""
+        expiresAt = time.time() + self.ttl
+        with self.lock:
+            self.entries[kind] = dict((key, [value, expiresAt]) for key, value in catalog.items())
+            self.completeCatalogs[kind] = expiresAt
+            self.serialize()
+
+    def catalogComplete(self, kind):
+        with self.lock:
+            return self.completeCatalogs.get(kind, 0) > time.time()
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.completeCatalogs = {}
+            self.serialize()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+
+This file is part of **opensense** project https://github.com/opensense-network/.
+    :platform: Unix, Windows, MacOS X
+    :sinopsis: opensense
+
+.. moduleauthor:: Frank Pallas <frank.pallas@tu-berlin.de>
+
+License : GPL(v3)
+
+**opensense** is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+**opensense** is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with opensense. If not, see http://www.gnu.org/licenses.
+
+"""
+import os
+import json
+import time
+import atexit
+import logging
+from threading import Thread, Condition, Lock
+
+# os.replace is not available in Python 2, where os.rename already overwrites on Unix
+replaceFile = getattr(os, "replace", os.rename)
+
+fileLocks = {} # file name -> Lock serializing writes of that file within this process
+fileLocksLock = Lock()
+
+def writeJsonFile(fileName, data, pretty = True):
+    """
+    Atomically writes data as json to fileName: it is written to a temporary
+    file, synced to disk and then renamed, so that a crash never leaves a
+    half-written file behind. Writes of the same file are serialized, and the
+    temporary file is named after the process, so that concurrent writers
+    never rename a file another one is still writing.
+    """
+    with fileLocksLock:
+        fileLock = fileLocks.setdefault(os.path.abspath(fileName), Lock())
+    directory = os.path.dirname(fileName)
+    tempFile = "%s.%s.tmp" % (fileName, os.getpid())
+    with fileLock:
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        try:
+            with open(tempFile, "w") as fileHandle:
+                if pretty:
+                    json.dump(data, fileHandle, sort_keys = False, indent = 4, ensure_ascii=False)
+                else:
+                    json.dump(data, fileHandle)
+                fileHandle.flush()
+                os.fsync(fileHandle.fileno())
+            replaceFile(tempFile, fileName)
+        except BaseException:
+            if os.path.exists(tempFile):
+                os.remove(tempFile)
+            raise
+    if hasattr(os, "O_DIRECTORY"):
+        # make the rename itself durable
+        try:
+            directoryHandle = os.open(directory or ".", os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(directoryHandle)
+            finally:
+                os.close(directoryHandle)
+        except OSError:
+            pass
+
+class ConfigStore:
+    """
+    Write-behind store for json config files, shared by the OpenSenseNet
+    instance and all agents.
+
+    write() only notes that a file is to be written - a background thread
+    writes it after a short delay, so that rapid successive changes of the
+    same file result in a single write. The data is serialized only then, so
+    callers simply pass their (mutable) config dict. Files are written via
+    writeJsonFile and thus never end up half-written. flush() writes all
+    pending files right away and is called on interpreter exit at the latest.
+    """
+
+    def __init__(self, delaySec = 1.0):
+        self.logger = logging.getLogger(__name__)
+        self.delay = delaySec
+        self.condition = Condition()
+        self.pending = {} # file name -> (data, due time)
+        self.writer = None
+        atexit.register(self.flush)
+
+    def write(self, fileName, data):
+        with self.condition:
+            due = time.time() + self.delay
+            if fileName in self.pending:
+                due = self.pending[fileName][1] # coalesce with the write already scheduled
+            self.pending[fileName] = (data, due)
+            if self.writer is None:
+                self.writer = Thread(target = self.writePending)
+                self.writer.daemon = True
+                self.writer.start()
+            self.condition.notify()
+
+    def writeNow(self, fileName, data):
+        with self.condition:
+            self.pending.pop(fileName, None)
+        self.writeFile(fileName, data)
+
+    def flush(self):
+        with self.condition:
+            pending = self.pending
+            self.pending = {}
+        for fileName, (data, due) in pending.items():
+            for attempt in range(3):
+                if self.writeFile(fileName, data):
+                    break
+
+    def writePending(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                fileName, (data, due) = min(self.pending.items(), key = lambda item: item[1][1])
+                if due > time.time():
+                    self.condition.wait(due - time.time())
+                    continue
+                del self.pending[fileName]
+            if not self.writeFile(fileName, data):
+                with self.condition:
+                    if fileName not in self.pending:
+                        self.pending[fileName] = (data, time.time() + self.delay) # try again later
+
+    def writeFile(self, fileName, data):
+        try:
+            self.logger.debug("Writing %s." % fileName)
+            writeJsonFile(fileName, data)
+            return True
+        except RuntimeError:
+            # data was changed while being serialized - it is written again shortly anyway
+            return False
+        except BaseException as e:
+            self.logger.warning("Could not write %s. Exception message: %s" % (fileName, e))
+            return True
+
+configStore = ConfigStore()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+
+This file is part of **opensense** project https://github.com/opensense-network/.
+    :platform: Unix, Windows, MacOS X
+    :sinopsis: opensense
+
+.. moduleauthor:: Frank Pallas <frank.pallas@tu-berlin.de>
+
+License : GPL(v3)
+
+**opensense** is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+**opensense** is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with opensense. If not, see http://www.gnu.org/licenses.
+
+"""
+import re
+import json
+import codecs
+
+decoder = json.JSONDecoder()
+whitespace = " \t\r\n"
+nonWhitespace = re.compile(r'[^ \t\r\n]')
+# characters that change the nesting within an element, or end it
+structuralChars = re.compile(r'["\[\]{},]')
+# characters that end a string or escape the next one
+stringChars = re.compile(r'["\\]')
+
+def iterJsonArray(chunks, encoding = "utf-8"):
+    """
+    Yields the elements of a json array arriving as a sequence of byte
+    chunks one by one, so that only a single element (plus one chunk) has to
+    be held in memory instead of the whole document. Raises ValueError if the
+    data is not a well-formed array.
+
+    An element is only accepted once the comma or bracket following it
+    arrived, so a number split across chunks is not taken for a shorter one.
+    Elements within a chunk are parsed right away, those spanning chunks are
+    scanned for their end chunk by chunk and parsed once complete, so that
+    large elements aren't parsed again for every chunk.
+    """
+    textDecoder = codecs.getincrementaldecoder(encoding)()
+    pieces = [] # text of the current element that arrived so far
+    started = False
+    elementExpected = False # after a comma, another element has to follow
+    depth = 0 # nesting of objects and arrays within the current element
+    inString = False
+    escaped = False
+    exhausted = False
+    chunks = iter(chunks)
+    while not exhausted:
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            exhausted = True
+            chunk = b""
+        text = textDecoder.decode(chunk, exhausted)
+        position = 0
+        if not started:
+            text = text.lstrip(whitespace)
+            if not text:
+                continue
+            if text[0] != "[":
+                raise ValueError("json data is not an array")
+            started = True
+            position = 1
+        elementStart = position
+        while position < len(text):
+            complete = False # whether the element and the delimiter following it were read
+            if position == elementStart and not pieces and depth == 0 and not inString:
+                # an element within this chunk can be parsed right away
+                match = nonWhitespace.search(text, position)
+                if match is None:
+                    break
+                if match.group() not in ",]":
+                    try:
+                        element, end = decoder.raw_decode(text, match.start())
+                    except ValueError:
+                        pass
+                    else:
+                        match = nonWhitespace.search(text, end)
+                        if match is not None and match.group() in ",]":
+                            complete = True
+                            delimiter = match.group()
+                            position = match.end()
+            if not complete:
+                if escaped:
+                    escaped = False
+                    position += 1
+                    continue
+                match = (stringChars if inString else structuralChars).search(text, position)
+                if match is None:
+                    break
+                char = match.group()
+                position = match.end()
+                if inString:
+                    if char == "\\":
+                        escaped = True
+                    else:
+                        inString = False
+                    continue
+                if char == '"':
+                    inString = True
+                    continue
+                if char in "[{":
+                    depth += 1
+                    continue
+                if char in "]}" and depth > 0:
+                    depth -= 1
+                    continue
+                if char == "}":
+                    raise ValueError("unbalanced braces in json array")
+                if depth > 0:
+                    continue
+                # a comma or the closing bracket of the array ends the element
+                delimiter = char
+                pieces.append(text[elementStart:position - 1])
+                elementText = "".join(pieces).strip(whitespace)
+                pieces = []
+                if not elementText:
+                    if elementExpected or delimiter == ",":
+                        raise ValueError("missing element in json array")
+                    return # empty array
+                element, end = decoder.raw_decode(elementText)
+                if end != len(elementText):
+                    raise ValueError("unexpected data after json array element: %s" % elementText[end:end + 20])
+            yield element
+            elementStart = position
+            elementExpected = delimiter == ","
+            if delimiter == "]":
+                return
+        if elementStart < len(text):
+            pieces.append(text[elementStart:])
+    raise ValueError("json array not terminated")
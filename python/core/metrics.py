@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+
+This file is part of **opensense** project https://github.com/opensense-network/.
+    :platform: Unix, Windows, MacOS X
+    :sinopsis: opensense
+
+.. moduleauthor:: Frank Pallas <frank.pallas@tu-berlin.de>
+
+License : GPL(v3)
+
+**opensense** is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+**opensense** is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with opensense. If not, see http://www.gnu.org/licenses.
+
+"""
+import os
+import time
+import logging
+from threading import Thread, Lock
+
+# eliminate incompatibilities between Python v2 and v3
+try:
+    # For Python 3.0 and later
+    from threading import get_ident
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    # Fall back to Python 2
+    from thread import get_ident
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from .config_store import replaceFile
+
+class Counter:
+    """
+    A monotonically increasing counter that may be incremented from many threads.
+
+    Every thread increments a shard of its own, so no lock is needed on the
+    hot path - the shards are only summed up when the value is read.
+    """
+
+    def __init__(self):
+        self.shards = {}
+        self.lock = Lock()
+
+    def inc(self, amount = 1):
+        try:
+            self.shards[get_ident()][0] += amount
+        except KeyError:
+            with self.lock:
+                self.shards[get_ident()] = [amount]
+
+    def value(self):
+        return sum(shard[0] for shard in list(self.shards.values()))
+
+class Gauge:
+    """A value that may go up and down. Either set explicitly or read from a function on every snapshot."""
+
+    def __init__(self, function = None):
+        self.function = function
+        self.currentValue = 0
+
+    def set(self, value):
+        self.currentValue = value
+
+    def value(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except BaseException:
+                return 0
+        return self.currentValue
+
+class Histogram:
+    """
+    A histogram for durations in the style of HdrHistogram.
+
+    Values are recorded in microseconds into log-linear buckets: every
+    power of two is split into 16 sub-buckets, which bounds the relative
+    error of reported percentiles to about 6% at constant memory, no
+    matter how many values are recorded.
+    """
+
+    subBuckets = 16
+    subBucketBits = 4
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def bucketIndex(self, micros):
+        if micros < self.subBuckets:
+            return micros
+        exponent = micros.bit_length() - self.subBucketBits - 1
+        return (exponent + 1) * self.subBuckets + (micros >> exponent) - self.subBuckets
+
+    def bucketUpperBound(self, index):
+        """Returns the largest value in microseconds falling into the given bucket."""
+        if index < self.subBuckets:
+            return index
+        exponent = index // self.subBuckets - 1
+        subBucket = index % self.subBuckets + self.subBuckets
+        return ((subBucket + 1) << exponent) - 1
+
+    def record(self, seconds):
+        micros = max(0, int(seconds * 1000000))
+        index = self.bucketIndex(micros)
+        with self.lock:
+            self.counts[index] = self.counts.get(index, 0) + 1
+            self.count += 1
+            self.sum += seconds
+            if self.min is None or seconds < self.min:
+                self.min = seconds
+            if self.max is None or seconds > self.max:
+                self.max = seconds
+
+    def percentiles(self, quantiles):
+        """Returns a dict quantile -> value in seconds for the given quantiles (0..1)."""
+        with self.lock:
+            counts = sorted(self.counts.items())
+            total = self.count
+            maxValue = self.max
+        result = {}
+        for quantile in quantiles:
+            result[quantile] = 0.0
+            if total == 0:
+                continue
+            threshold = quantile * total
+            seen = 0
+            for index, bucketCount in counts:
+                seen += bucketCount
+                if seen >= threshold:
+                    result[quantile] = min(self.bucketUpperBound(index) / 1000000.0, maxValue)
+                    break
+        return result
+
+    def value(self):
+        quantiles = self.percentiles([0.5, 0.9, 0.99, 0.999])
+        with self.lock:
+            return {"count":self.count, "sum":self.sum, "min":self.min, "max":self.max, "quantiles":quantiles}
+
+class MetricsRegistry:
+    """
+    A registry of named counters, gauges and histograms.
+
+    Metrics are identified by name plus an optional dict of labels. The
+    registry can be snapshotted at any time and rendered in the Prometheus
+    text exposition format, which can periodically be written to a file
+    (e.g. for node_exporter's textfile collector) or served via HTTP on a
+    local port.
+    """
+
+    def __init__(self, prefix = "opensense_"):
+        self.logger = logging.getLogger(__name__)
+        self.prefix = prefix
+        self.lock = Lock()
+        self.metrics = {} # (name, labelTuple) -> metric
+        self.descriptions = {} # name -> (type, help)
+
+    def register(self, name, metricType, helpText, labels, metric):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            if key not in self.metrics:
+                self.metrics[key] = metric
+                self.descriptions[name] = (metricType, helpText)
+            return self.metrics[key]
+
+    def counter(self, name, helpText = "", labels = None):
+        return self.register(name, "counter", helpText, labels, Counter())
+
+    def gauge(self, name, helpText = "", labels = None, function = None):
+        return self.register(name, "gauge", helpText, labels, Gauge(function))
+
+    def histogram(self, name, helpText = "", labels = None):
+        return self.register(name, "summary", helpText, labels, Histogram())
+
+    def snapshot(self):
+        """Returns a dict "name{labels}" -> current value of all metrics."""
+        with self.lock:
+            items = list(self.metrics.items())
+        snapshot = {}
+        for (name, labels), metric in sorted(items):
+            snapshot[name + self.formatLabels(labels)] = metric.value()
+        return snapshot
+
+    def formatLabels(self, labels, extraLabels = ()):
+        allLabels = list(labels) + list(extraLabels)
+        if not allLabels:
+            return ""
+        return "{" + ",".join('%s="%s"' % (key, value) for key, value in allLabels) + "}"
+
+    def prometheusText(self):
+        with self.lock:
+            items = sorted(self.metrics.items())
+            descriptions = dict(self.descriptions)
+        lines = []
+        describedNames = set()
+        for (name, labels), metric in items:
+            fullName = self.prefix + name
+            if name not in describedNames:
+                metricType, helpText = descriptions[name]
+                lines.append("# HELP %s %s" % (fullName, helpText))
+                lines.append("# TYPE %s %s" % (fullName, metricType))
+                describedNames.add(name)
+            if isinstance(metric, Histogram):
+                value = metric.value()
+                for quantile, quantileValue in sorted(value["quantiles"].items()):
+                    lines.append("%s%s %s" % (fullName, self.formatLabels(labels, [("quantile", quantile)]), quantileValue))
+                lines.append("%s_sum%s %s" % (fullName, self.formatLabels(labels), value["sum"]))
+                lines.append("%s_count%s %s" % (fullName, self.formatLabels(labels), value["count"]))
+            else:
+                lines.append("%s%s %s" % (fullName, self.formatLabels(labels), metric.value()))
+        return "\n".join(lines) + "\n"
+
+    def writePrometheusFile(self, path):
+        """Atomically writes all metrics in Prometheus text format to the given file."""
+        tempFile = path + ".tmp"
+        with open(tempFile, "w") as metricsFileHandle:
+            metricsFileHandle.write(self.prometheusText())
+        replaceFile(tempFile, path)
+
+    def startFileExport(self, path, intervalSec):
+        def exportLoop():
+            while True:
+                try:
+                    self.writePrometheusFile(path)
+                except BaseException as e:
+                    self.logger.warning("Could not write metrics to %s. Exception message: %s" % (path, e))
+                time.sleep(intervalSec)
+        exporter = Thread(target = exportLoop)
+        exporter.daemon = True
+        exporter.start()
+
+    def startHttpExport(self, port, host = "127.0.0.1"):
+        """Serves all metrics in Prometheus text format on http://host:port/metrics."""
+        registry = self
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.prometheusText().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+        server = HTTPServer((host, port), MetricsHandler)
+        exporter = Thread(target = server.serve_forever)
+        exporter.daemon = True
+        exporter.start()
+        return server
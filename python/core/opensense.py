@@ -42,8 +42,32 @@ import requests
 #     import urllib2 as request
 #     import urllib as urlencode
 
-from threading import Thread, Lock
-import Queue
+from threading import Thread, Lock, Condition, Event
+
+# eliminate Queue incompatibility between Python v2 and v3
+try:
+    # For Python 3.0 and later
+    import queue as Queue
+except ImportError:
+    # Fall back to Python 2's Queue
+    import Queue
+
+from .spool import SpooledSendingQueue
+from .catalog_cache import CatalogCache
+from .retry import CircuitBreaker, DelayedRetryQueue, backoffDelay
+from .metrics import MetricsRegistry
+from .config_store import configStore
+from .token_manager import TokenManager
+from .value_record import ValueRecord, ValueArray, numericValue, timestampMsFromUtcTime, timestampFormatter
+
+# the asyncio sender requires Python 3 and aiohttp - if not available, only threaded sending is supported.
+# Python 2 can't even compile async_sender (SyntaxError on async def), so it is not imported there at all.
+AsyncSender = None
+if sys.version_info >= (3, 5):
+    try:
+        from .async_sender import AsyncSender
+    except ImportError:
+        pass
 
 class OpenSenseNetInstance:
     "A simple Class for managing OpenSenseNet settings and for performing basic communication with the OSN platform"
@@ -60,9 +84,18 @@ class OpenSenseNetInstance:
         self.logger.info("Initing OpenSenseNet with config file %s..." % configFile)
         # read configfile
         config_changed = False
-        self.threadedSendingQueue = Queue.Queue()
         self.bulkSendingArrays = {} # this is a dict of arrays
         self.collapsedSendingArray = [] # and this is an array for sending collapsedMessages - multiple messages for *different* sensors at a time
+        self.lingerBatch = [] # values passed to sendValue and collected for automatic collapsed sending
+        self.lingerDeadline = 0
+        self.lingerCondition = Condition()
+        self.admissionLock = Lock()
+        self.downsampleCounter = 0
+        self.metrics = MetricsRegistry()
+        # number of values affected by each backpressure policy
+        self.backpressureStats = {}
+        for policyResult in ["blocked", "block_timeouts", "dropped_oldest", "dropped_newest", "downsampled", "spilled"]:
+            self.backpressureStats[policyResult] = self.metrics.counter("backpressure_values_total", "Values affected by the backpressure policy", {"result":policyResult})
 
         with open(configFile) as data_file:
             self.configData = json.load(data_file)
@@ -72,9 +105,6 @@ class OpenSenseNetInstance:
             if "password" not in self.configData:
                 self.configData["password"]=""
                 config_changed = True
-            if "api_token" not in self.configData:
-                self.configData["api_token"]=""
-                config_changed = True
             if "osn_api_endpoint" not in self.configData:
                 self.configData["osn_api_endpoint"]="default-host"
                 config_changed = True
@@ -96,6 +126,131 @@ class OpenSenseNetInstance:
             if "max_bulk_sending_array_length" not in self.configData:
                 self.configData["max_bulk_sending_array_length"]=100 # default settings for less load-heavy scenarios. Increase as appropriate
                 config_changed = True
+            if "metrics_file" not in self.configData:
+                self.configData["metrics_file"]="" # relative to rootDir. If set, metrics are periodically written there in Prometheus text format
+                config_changed = True
+            if "metrics_export_interval_msec" not in self.configData:
+                self.configData["metrics_export_interval_msec"]=10000
+                config_changed = True
+            if "metrics_port" not in self.configData:
+                self.configData["metrics_port"]=0 # if set, metrics are served in Prometheus text format on http://127.0.0.1:<port>/metrics
+                config_changed = True
+            if "retry_base_delay_msec" not in self.configData:
+                self.configData["retry_base_delay_msec"]=1000 # delay before first retry of a failed message, doubled with every further attempt
+                config_changed = True
+            if "retry_max_delay_msec" not in self.configData:
+                self.configData["retry_max_delay_msec"]=60000
+                config_changed = True
+            if "circuit_failure_threshold" not in self.configData:
+                self.configData["circuit_failure_threshold"]=10 # consecutive failures after which sending is paused
+                config_changed = True
+            if "circuit_reset_timeout_msec" not in self.configData:
+                self.configData["circuit_reset_timeout_msec"]=30000 # pause before probing the endpoint again
+                config_changed = True
+            if "circuit_probe_timeout_msec" not in self.configData:
+                self.configData["circuit_probe_timeout_msec"]=60000 # probe without outcome after this time is considered lost
+                config_changed = True
+            if "backpressure_policy" not in self.configData:
+                self.configData["backpressure_policy"]="block" # what to do with new messages when queue exceeds max_queue_length: block, drop_oldest, drop_newest, downsample or spill
+                config_changed = True
+            if "backpressure_timeout_msec" not in self.configData:
+                self.configData["backpressure_timeout_msec"]=0 # max blocking time for policy block, 0 for no limit. Message is spilled to the spool after the timeout
+                config_changed = True
+            if "backpressure_downsample_factor" not in self.configData:
+                self.configData["backpressure_downsample_factor"]=10 # for policy downsample, only every n-th message is kept while queue is full
+                config_changed = True
+            if "auto_batching" not in self.configData:
+                self.configData["auto_batching"]=False # collect values passed to sendValue and send them as collapsed messages
+                config_changed = True
+            if "auto_batch_linger_msec" not in self.configData:
+                self.configData["auto_batch_linger_msec"]=500 # max time a value waits for further values in auto batching
+                config_changed = True
+            if "auto_batch_size" not in self.configData:
+                self.configData["auto_batch_size"]=100 # max number of values per automatically collapsed message
+                config_changed = True
+            if "sender_mode" not in self.configData:
+                self.configData["sender_mode"]="threaded" # "threaded" for max_sending_threads blocking senders, "asyncio" for one event loop
+                config_changed = True
+            if "async_max_in_flight" not in self.configData:
+                self.configData["async_max_in_flight"]=200 # concurrent requests in asyncio sender mode
+                config_changed = True
+            if "async_max_connections" not in self.configData:
+                self.configData["async_max_connections"]=4 # pooled keep-alive connections in asyncio sender mode
+                config_changed = True
+            if "spool_dir" not in self.configData:
+                self.configData["spool_dir"]="spool" # relative to rootDir. Unsent messages are kept here across restarts
+                config_changed = True
+            if "spool_segment_bytes" not in self.configData:
+                self.configData["spool_segment_bytes"]=4194304
+                config_changed = True
+            if "spool_fsync_batch" not in self.configData:
+                self.configData["spool_fsync_batch"]=100 # number of messages written or acknowledged before forcing them to disk
+                config_changed = True
+            if "spool_fsync_interval_msec" not in self.configData:
+                self.configData["spool_fsync_interval_msec"]=1000 # upper bound for the time messages may stay unsynced
+                config_changed = True
+            if "spool_memory_messages" not in self.configData:
+                self.configData["spool_memory_messages"]=1000 # max number of queued messages held in memory, the rest stays on disk
+                config_changed = True
+
+            if "cache_dir" not in self.configData:
+                self.configData["cache_dir"]="cache" # relative to rootDir
+                config_changed = True
+            if "catalog_cache_ttl_sec" not in self.configData:
+                self.configData["catalog_cache_ttl_sec"]=86400 # measurand, unit and license ids hardly ever change
+                config_changed = True
+            if "catalog_cache_negative_ttl_sec" not in self.configData:
+                self.configData["catalog_cache_negative_ttl_sec"]=600 # names unknown to the platform are asked for again after this time
+                config_changed = True
+            if "shutdown_timeout_msec" not in self.configData:
+                self.configData["shutdown_timeout_msec"]=10000 # max time for sending queued messages on shutdown, the rest is kept in the spool
+                config_changed = True
+            if "min_login_interval_sec" not in self.configData:
+                self.configData["min_login_interval_sec"]=60 # logins should not happen more often than this
+                config_changed = True
+            if "catalog_prefetch" not in self.configData:
+                self.configData["catalog_prefetch"]=True # fetch the whole catalog at once before creating the first sensor
+                config_changed = True
+            if "default_sensor_license" not in self.configData:
+                self.configData["default_sensor_license"]="ODC-PDDL" # for sensors marked "create" that don't specify a "license"
+                config_changed = True
+            if "provisioning_max_parallel" not in self.configData:
+                self.configData["provisioning_max_parallel"]=8 # sensors created on the platform concurrently
+                config_changed = True
+
+            # runtime state like the api token is kept apart from the user-edited config
+            self.stateFile = os.path.join(rootDir, self.configData["cache_dir"], "opensensenet.state.json")
+            self.state = {"api_token":""}
+            if os.path.isfile(self.stateFile):
+                try:
+                    with open(self.stateFile) as stateFileHandle:
+                        self.state.update(json.load(stateFileHandle))
+                except BaseException as e:
+                    self.logger.warning("Could not read state from %s. Exception message: %s" % (self.stateFile, e))
+            # earlier versions kept the token in the config file
+            if "api_token" in self.configData:
+                if self.configData["api_token"] and not self.state["api_token"]:
+                    self.state["api_token"] = self.configData["api_token"]
+                    configStore.write(self.stateFile, self.state)
+                del self.configData["api_token"]
+                config_changed = True
+
+            catalogCacheFile = os.path.join(rootDir, self.configData["cache_dir"], "catalog.cache.json")
+            self.catalogCache = CatalogCache(catalogCacheFile, self.configData["catalog_cache_ttl_sec"], self.configData["catalog_cache_negative_ttl_sec"])
+            self.catalogPrefetchAttempted = False
+            self.catalogLock = Lock()
+
+            # the sending queue is backed by an append-only spool on disk so that no messages get lost on crashes
+            spoolDir = os.path.join(rootDir, self.configData["spool_dir"])
+            spoolStart = time.time()
+            self.threadedSendingQueue = SpooledSendingQueue(spoolDir, postMessageObject, \
+                segmentBytes = self.configData["spool_segment_bytes"], \
+                fsyncBatch = self.configData["spool_fsync_batch"], \
+                fsyncIntervalMsec = self.configData["spool_fsync_interval_msec"], \
+                memoryMessages = self.configData["spool_memory_messages"])
+            spoolSec = time.time() - spoolStart
+
+            # earlier versions serialized unsent messages to the config file - move them to the spool
             if "unsentMessages" in self.configData:
                 unsentMessages = self.configData["unsentMessages"]
                 msgCount = 0
@@ -106,7 +261,7 @@ class OpenSenseNetInstance:
                         self.threadedSendingQueue.put(postMessageObject(postUri, jsonData))
                         msgCount += 1
                 del self.configData["unsentMessages"]
-                self.logger.info("imported %s yet unsent messages" % msgCount)
+                self.logger.info("moved %s yet unsent messages from config to spool" % msgCount)
                 config_changed = True
 
         if (config_changed):
@@ -128,15 +283,76 @@ class OpenSenseNetInstance:
 
         # and now set up some worker threads...
         self.stopped = False
-        self.numFailedThreads = 0
-        self.numSucceededThreads = 0
-        self.numHandledValues = 0
-        self.numSentValues = 0
+        self.draining = False # set on stop(), while queued messages are still being sent
+        self.drainFinished = Event()
+        self.circuitBreaker = CircuitBreaker(self.configData["circuit_failure_threshold"], self.configData["circuit_reset_timeout_msec"] / 1000.0, self.configData["circuit_probe_timeout_msec"] / 1000.0)
+        self.delayedRetries = DelayedRetryQueue(self.retryDue)
+        self.setupMetrics(rootDir)
+        self.recordStartupPhase("spool", spoolSec)
         self.startTime = time.time()
-        self.loginInitiated = False
-        self.lastLogin = time.time() - 61 # we use this variable for preventing overly repeated auto-logins
+        self.loggedIn = False
+        # logins are done by the token manager's thread, one at a time
+        self.tokenManager = TokenManager(self.login, self.state["api_token"], self.configData["min_login_interval_sec"])
+        self.tokenManager.start()
+        # login is done in the background - until there is a token, values are kept in the queue
         self.logger.info("logging in...")
-        self.login()
+        self.tokenManager.requestLogin()
+        self.startSenders()
+        if self.configData["auto_batching"]:
+            lingerFlusher = Thread(target = self.lingerBatchFlusher)
+            lingerFlusher.daemon = True
+            lingerFlusher.start()
+
+    def setupMetrics(self, rootDir):
+        """
+        Registers the metrics of the sending pipeline and starts the configured exporters.
+        """
+        self.handledValues = self.metrics.counter("handled_values_total", "Values passed to the instance for sending")
+        self.sentValues = self.metrics.counter("sent_values_total", "Values successfully sent to the platform")
+        self.succeededRequests = self.metrics.counter("succeeded_requests_total", "Successful POST requests")
+        self.failedRequests = self.metrics.counter("failed_requests_total", "Failed POST requests")
+        self.queueWaitTime = self.metrics.histogram("queue_wait_seconds", "Time messages spent in the sending queue")
+        self.httpRoundTrip = self.metrics.histogram("http_round_trip_seconds", "Duration of POST requests")
+        self.endToEndLatency = self.metrics.histogram("end_to_end_latency_seconds", "Time from enqueueing a message till it was acknowledged by the platform")
+        self.metrics.gauge("queue_depth", "Messages in the sending queue", function = self.queueLength)
+        self.metrics.gauge("queue_memory_depth", "Messages of the sending queue held in memory", function = self.threadedSendingQueue.memorySize)
+        self.metrics.gauge("buffered_values", "Values in bulk, collapsed and auto batching buffers not yet queued", function = self.bufferedValues)
+        self.metrics.gauge("retry_waiting_messages", "Messages waiting for a retry", function = lambda: len(self.delayedRetries))
+        self.metrics.gauge("circuit_open", "1 if sending is paused by the circuit breaker", function = lambda: int(self.circuitBreaker.state != CircuitBreaker.CLOSED))
+        if self.configData["metrics_file"]:
+            self.metrics.startFileExport(os.path.join(rootDir, self.configData["metrics_file"]), self.configData["metrics_export_interval_msec"] / 1000.0)
+        if self.configData["metrics_port"]:
+            try:
+                self.metrics.startHttpExport(self.configData["metrics_port"])
+            except BaseException as e:
+                self.logger.warning("Could not serve metrics on port %s. Exception message: %s" % (self.configData["metrics_port"], e))
+
+    def recordStartupPhase(self, phase, seconds):
+        """Logs the duration of a startup phase and exports it as metric, for tracking cold start cost."""
+        self.logger.info("startup phase %s took %.3f sec" % (phase, seconds))
+        self.metrics.gauge("startup_seconds", "Duration of startup phases", {"phase":phase}).set(seconds)
+
+    def bufferedValues(self):
+        """
+        Returns the number of values held in bulk, collapsed and auto batching buffers, i.e. not yet in the queue.
+        """
+        numValues = len(self.collapsedSendingArray) + len(self.lingerBatch)
+        for messageArray in list(self.bulkSendingArrays.values()):
+            numValues += len(messageArray)
+        return numValues
+
+    def startSenders(self):
+        """
+        Starts either the configured number of sender threads or, if so configured and
+        available, a single asyncio sender handling many requests concurrently.
+        """
+        if self.configData["sender_mode"] == "asyncio":
+            if AsyncSender is not None:
+                self.logger.debug("creating asyncio sender")
+                sender = AsyncSender(self, self.configData["async_max_in_flight"], self.configData["async_max_connections"])
+                sender.start()
+                return
+            self.logger.warning("asyncio sender mode requires Python 3 and aiohttp - falling back to threaded sending")
         self.logger.debug("creating %s sender threads" % self.configData["max_sending_threads"])
         for i in range(self.configData["max_sending_threads"]):
             worker = Thread(target = self.threadedApiCallPOST)
@@ -144,23 +360,26 @@ class OpenSenseNetInstance:
             worker.start()
 
     def login(self):
-        if self.loginInitiated == False:
-            self.loginInitiated = True
-        self.logger.info("login. curTime is %s, lastlogin was %s" % (time.time(), self.lastLogin))
-        while time.time() - self.lastLogin < 60: #should not happen more often than once a minute
-            self.logger.info("repeated login - postponing for a while... curTime is %s, lastlogin was %s" % (time.time(), self.lastLogin))
-            time.sleep(0.3)
-        self.lastLogin = time.time()
+        """
+        Performs a single login. Called by the token manager only - use tokenManager.requestLogin() instead.
+        Returns the new token and its ttl in seconds (None if unknown), or None if login failed.
+        """
+        self.logger.info("login. curTime is %s" % time.time())
         #jsonData = [{"username":self.configData["username"], "password":self.configData["password"]}]
         jsonData = {"username":self.configData["username"], "password":self.configData["password"]}
         self.logger.debug("Logging in - jsonData: %s" % jsonData)
         #apiToken = self.apiCallPOST("Users/login", jsonData)
         apiToken = self.apiCallPOST("users/login", jsonData, False)
         if "id" in apiToken:
-            self.configData["api_token"] = apiToken["id"]
-            self.serializeConfig()
+            self.state["api_token"] = apiToken["id"]
+            configStore.write(self.stateFile, self.state)
             self.logger.info("logged in, token is: %s", apiToken)
-        self.loginInitiated = False
+            if not self.loggedIn:
+                self.loggedIn = True
+                self.recordStartupPhase("login", time.time() - self.startTime)
+            return apiToken["id"], apiToken.get("ttl")
+        self.logger.warning("login failed, response was: %s" % apiToken)
+        return None
 
     def createRemoteSensor (self, measurandString, unitString, licenseString, additional_params = None):
         """
@@ -173,148 +392,195 @@ class OpenSenseNetInstance:
         license-IDs to which these strings are mapped. Currently, however, this list and the
         respective mapping functionality is very limited.
         """
-        if additional_params == None:
-            additional_params = {}
-        retVal = None
-        self.logger.debug("creating new sensor on platform with measurand %s and unit %s..." % (measurandString, unitString))
+        params = self.resolveSensorParams(measurandString, unitString, licenseString)
+        if params is None:
+            return None
+        return self.addRemoteSensor(params, additional_params)
+
+    def resolveSensorParams (self, measurandString, unitString, licenseString):
+        """
+        Maps measurand, unit and license strings to the platform's catalog ids.
+        Returns the ids as params for addRemoteSensor or None if any of them is
+        not supported by the platform. Safe to be called from several threads.
+        """
+        self.logger.debug("resolving catalog ids for measurand %s, unit %s and license %s..." % (measurandString, unitString, licenseString))
+        with self.catalogLock:
+            if self.configData["catalog_prefetch"] and not self.catalogPrefetchAttempted and not self.catalogCache.catalogComplete("measurand"):
+                self.catalogPrefetchAttempted = True
+                self.prefetchCatalog()
         measurandId = self.getMeasurandId(measurandString.lower())
         unitId = self.getUnitId(measurandId, unitString)
         licenseId = self.getLicenseId(licenseString)
-        # check that both ids could be properly identified. If not, break
-        if (not measurandId or not unitId or not measurandId):
+        # check that all ids could be properly identified. If not, break
+        if (not measurandId or not unitId or not licenseId):
             self.logger.debug("Sensor could not be created - Either measurandString (%s) or unitString (%s) or licenseString (%s) not supported by platform yet" % (measurandString, unitString, licenseString))
-            return retVal
+            return None
+        return {"measurandId":measurandId, "unitId":unitId, "licenseId":licenseId}
 
+    def addRemoteSensor (self, params, additional_params = None):
+        """
+        Creates a new sensor on the platform from catalog ids as returned by
+        resolveSensorParams. Returns the new sensor's ID or None.
+        """
+        if additional_params == None:
+            additional_params = {}
+        retVal = None
+        # login is done in the background on startup - wait for it, but don't block a shutdown forever
+        self.tokenManager.waitForToken(60)
         # the following values might somehow be programmatically identified later
         # now pack stuff together for api call
-        params = {"measurandId":measurandId, "unitId":unitId, "licenseId":licenseId}
-        #params = {"measurandId":measurandId, "unitId":unitId}
+        params = dict(params)
         params.update(additional_params)
         jsonData = params
         self.logger.debug("sending post request in createSensor")
         apiResponse = self.apiCallPOST("sensors/addSensor", jsonData)
 
-        if "id" in apiResponse:
+        if isinstance(apiResponse, dict) and "id" in apiResponse:
             retVal = apiResponse["id"]
             self.logger.info("Created sensor on platform with ID %s. Additional params: %s" % (retVal, params))
         return retVal
 
 
-    def getUnitId(self, measurandId, unitString):
+    def prefetchCatalog(self):
         """
-        Fetches the unique, well-defined unit ID associated with a given
-        unit-String (eg "celsius") for the given measurand Id (eg "1", standing
-        for temperature).  Returns None if unit-String could not be matched for
-        the given measurand.
+        Fetches the complete lists of measurands, units and licenses from the
+        platform in one pass and stores them in the catalog cache, so that
+        subsequent id lookups don't require any further requests. Returns
+        True if all three lists could be fetched.
         """
-        retVal = None
-        queryString = "?name=" + unitString + "&measurandId=" + str(measurandId)
-        relativePath = "units" + queryString
+        retVal = True
+        measurands = self.apiCallGET("measurands", False)
+        if isinstance(measurands, list):
+            self.catalogCache.storeCatalog("measurand", dict((entry["name"], entry["id"]) for entry in measurands if "name" in entry and "id" in entry))
+        else:
+            retVal = False
+        units = self.apiCallGET("units", False)
+        if isinstance(units, list):
+            self.catalogCache.storeCatalog("unit", dict(("%s|%s" % (entry["measurandId"], entry["name"]), entry["id"]) for entry in units if "measurandId" in entry and "name" in entry and "id" in entry))
+        else:
+            retVal = False
+        licenses = self.apiCallGET("licenses", False)
+        if isinstance(licenses, list):
+            self.catalogCache.storeCatalog("license", dict((entry["shortName"], entry["id"]) for entry in licenses if "shortName" in entry and "id" in entry))
+        else:
+            retVal = False
+        self.logger.info("prefetched catalog from platform. Complete: %s" % retVal)
+        return retVal
+
+    def getCatalogId(self, kind, key, relativePath):
+        """
+        Internal helper for looking up a catalog id, first in the catalog cache,
+        then on the platform. Only proper answers of the platform are cached -
+        an empty list is remembered as negative result, failed requests are not.
+        """
+        found, retVal = self.catalogCache.lookup(kind, key)
+        if found:
+            return retVal
         apiResponse = self.apiCallGET(relativePath, False)
+        if isinstance(apiResponse, list) and len(apiResponse) == 0:
+            self.logger.debug("%s %s not known to platform" % (kind, key))
+            self.catalogCache.store(kind, key, None)
+            return retVal
         try:
             apiResponse = apiResponse[0]
         except BaseException as e:
-            self.logger.debug("Could not get UnitId. API Response empty. Exception message: %s" % (e))
+            self.logger.debug("Could not get %s id. API Response empty. Exception message: %s" % (kind, e))
             return retVal
         if "id" in apiResponse:
             retVal = apiResponse["id"]
-            self.logger.debug("got the unit id for %s: %s" % (unitString, retVal))
+            self.catalogCache.store(kind, key, retVal)
+            self.logger.debug("got the %s id for %s: %s" % (kind, key, retVal))
         return retVal
 
+    def getUnitId(self, measurandId, unitString):
+        """
+        Fetches the unique, well-defined unit ID associated with a given
+        unit-String (eg "celsius") for the given measurand Id (eg "1", standing
+        for temperature).  Returns None if unit-String could not be matched for
+        the given measurand.
+        """
+        queryString = "?name=" + unitString + "&measurandId=" + str(measurandId)
+        return self.getCatalogId("unit", "%s|%s" % (measurandId, unitString), "units" + queryString)
+
     def getMeasurandId(self, measurandString):
         """
         Fetches the unique, well-defined unit ID associated with a given measurand-String (eg "temperature"). Returns None if unit-String could not be matched
         """
-        retVal = None
         queryString = "?name=" + measurandString
-        relativePath = "measurands" + queryString
-        apiResponse = self.apiCallGET(relativePath, False)
-        try:
-            apiResponse = apiResponse[0]
-        except BaseException as e:
-            self.logger.debug("Could not get MeasurandId. API Response empty. Exception message: %s" % (e))
-            return retVal
-        if "id" in apiResponse:
-            retVal = apiResponse["id"]
-            self.logger.debug("got the measurand id for %s: %s" % (measurandString, retVal))
-        return retVal
+        return self.getCatalogId("measurand", measurandString, "measurands" + queryString)
 
     def getLicenseId(self, licenseShortName):
         """
         Fetches the unique, well-defined license ID associated with a given short name (eg "ODC-PDDL"). Returns None if short name could not be matched
         """
-        retVal = None
         queryString = "?shortName=" + licenseShortName
-        relativePath = "licenses" + queryString
-        apiResponse = self.apiCallGET(relativePath, False)
-        try:
-            apiResponse = apiResponse[0]
-        except BaseException as e:
-            self.logger.debug("Could not get License Id. API Response empty. Exception message: %s" % (e))
-            return retVal
-        if "id" in apiResponse:
-            retVal = apiResponse["id"]
-            self.logger.debug("got the license id for %s: %s" % (licenseShortName, retVal))
-        return retVal
+        return self.getCatalogId("license", licenseShortName, "licenses" + queryString)
 
     def sendValue (self, remoteSensorId, value, utcTime = None):
         """
         Sends a value for the given remoteSensorId to the platform. Currently, value muste be a number. Values are sent using multiple sender threads.
+
+        If auto_batching is configured, the value is not sent on its own but collected with
+        other values for at most auto_batch_linger_msec and sent as part of a collapsed message.
         """
         #self.logger.debug("sending value <%s> for remote sensor id %s..." % (value, remoteSensorId))
-        jsonData = self.makeValueSendingJson(value, utcTime)
-        # we don't need this in bulk-sending, must thus be added manually
-        jsonData["sensorId"] = remoteSensorId
+        record = self.makeValueRecord(remoteSensorId, value, utcTime)
+        if record is None:
+            return
+        self.sendRecord(record)
+
+    def sendRecord (self, record):
+        """
+        Sends a value already made up as ValueRecord, e.g. one received from
+        an agent worker process. See sendValue.
+        """
+        if self.configData["auto_batching"]:
+            with self.lingerCondition:
+                self.lingerBatch.append(record)
+                if len(self.lingerBatch) == 1:
+                    self.lingerDeadline = time.time() + self.configData["auto_batch_linger_msec"] / 1000.0
+                    self.lingerCondition.notify()
+                batchFull = len(self.lingerBatch) >= self.configData["auto_batch_size"]
+            if batchFull:
+                self.flushLingerBatch()
+            self.handledValues.inc()
+            return
         valuePostURI = self.makeValueSendingURI("sensors/addValue")
-        if self.queueLength() > self.configData["max_queue_length"]:
-            targetLength = (self.configData["max_queue_length"] * 2 / 3)
-            self.logger.debug("Queue has more than %s entries - sleeping till below %s..." % (self.configData["max_queue_length"], targetLength))
-            while self.queueLength() > targetLength:
-                time.sleep(0.1)
-        self.threadedSendingQueue.put(postMessageObject(valuePostURI, jsonData))
-        self.numHandledValues += 1
+        self.enqueueMessage(postMessageObject(valuePostURI, None, record.toJson))
+        self.handledValues.inc()
 
     def putValueToCollapsedSending (self, remoteSensorId, value, utcTime = None):
         """
         puts a value for a given Sensor to the array for collapsed sending and sends array if max length is reached. Currently, value muste be a number. Values are sent using multiple sender threads.
         """
         #self.logger.debug("sending value <%s> for remote sensor id %s..." % (value, remoteSensorId))
-        jsonData = self.makeValueSendingJson(value, utcTime)
-        # we don't need this in bulk-sending, must thus be added manually
-        jsonData["sensorId"] = remoteSensorId
-        self.collapsedSendingArray.append(jsonData)
+        record = self.makeValueRecord(remoteSensorId, value, utcTime)
+        if record is None:
+            return
+        self.collapsedSendingArray.append(record)
         if len(self.collapsedSendingArray) >= self.configData["max_bulk_sending_array_length"]:
-            # cool down a bit in case queue is too long
-            if self.queueLength() > self.configData["max_queue_length"]:
-                targetLength = (self.configData["max_queue_length"] * 2 / 3)
-                self.logger.debug("Queue has more than %s entries - sleeping till below %s..." % (self.configData["max_queue_length"], targetLength))
-                while self.queueLength() > targetLength:
-                    time.sleep(0.1)
-            valuePostURI = self.makeValueSendingURI("sensors/addMultipleValues")
-            collapsedJson = {"collapsedMessages": self.collapsedSendingArray}
+            records = self.collapsedSendingArray
             self.collapsedSendingArray = []
-            self.threadedSendingQueue.put(postMessageObject(valuePostURI, collapsedJson))
+            self.enqueueMessage(self.makeCollapsedMessage(records))
 
-        self.numHandledValues += 1
+        self.handledValues.inc()
 
     def putValueToBulkSending (self, remoteSensorId, value, utcTime = None):
         """
         Puts a value for the given remoteSensorId to the corresponding bulk-sending array, which is automatically sent once configured length or number of arrays is reached. Currently, value muste be a number.
         """
         #self.logger.debug("putting value <%s> for remote sensor id %s to bulk sending..." % (value, remoteSensorId))
-        jsonData = self.makeValueSendingJson(value, utcTime)
+        numberValue = numericValue(value)
+        if numberValue is None:
+            self.logger.debug("Skipping non-numeric value <%s> for remote sensor id %s" % (value, remoteSensorId))
+            return
         if remoteSensorId in self.bulkSendingArrays:
             #this sending array already exists
-            self.bulkSendingArrays[remoteSensorId].append(jsonData)
+            self.bulkSendingArrays[remoteSensorId].append(numberValue, timestampMsFromUtcTime(utcTime))
         else:
-            self.bulkSendingArrays[remoteSensorId] = [jsonData]
-
-        # ensure to cool down a bit - queue might consist of very large bulks...
-        if self.queueLength() > self.configData["max_queue_length"]:
-            targetLength = (self.configData["max_queue_length"] * 2 / 3)
-            self.logger.debug("Queue has more than %s entries - sleeping till below %s..." % (self.configData["max_queue_length"], targetLength))
-            while self.queueLength() > targetLength:
-                time.sleep(0.1)
+            valueArray = ValueArray(remoteSensorId)
+            valueArray.append(numberValue, timestampMsFromUtcTime(utcTime))
+            self.bulkSendingArrays[remoteSensorId] = valueArray
 
         # now check if configured max values are reached and automatically flush
         # the respective array might, however, just have been removed from the list, so check first
@@ -331,34 +597,137 @@ class OpenSenseNetInstance:
                     maxLength = len(self.bulkSendingArrays[key])
             #self.logger.debug("maxNum of %s bulk sending arrays reached - flushing %s with length %s..." % (self.configData["max_bulk_sending_arrays"], remoteIdToFlush, maxLength))
             self.flushBulkSendingArray(remoteIdToFlush)
-        self.numHandledValues += 1
+        self.handledValues.inc()
 
 
 
     def flushBulkSendingArray(self, remoteSensorId):
         self.logger.debug("flushing bulk array for %s..." %remoteSensorId)
-        messageArray = self.bulkSendingArrays.pop(remoteSensorId, None)
-        if messageArray:
+        valueArray = self.bulkSendingArrays.pop(remoteSensorId, None)
+        if valueArray:
             valuePostURI = self.makeValueSendingURI("sensors/addMultipleValues")
-            self.threadedSendingQueue.put(postMessageObject(valuePostURI, {"sensorId":remoteSensorId, "values":messageArray}))
+            self.enqueueMessage(postMessageObject(valuePostURI, None, lambda: {"sensorId":remoteSensorId, "values":valueArray.toJson()}))
+
+    def makeValueRecord(self, remoteSensorId, value, utcTime):
+        """
+        Creates a compact record for a single value. Returns None (and drops the value) if it is not a number.
+        """
+        numberValue = numericValue(value)
+        if numberValue is None:
+            self.logger.debug("Skipping non-numeric value <%s> for remote sensor id %s" % (value, remoteSensorId))
+            return None
+        return ValueRecord(remoteSensorId, numberValue, timestampMsFromUtcTime(utcTime))
+
+    def makeCollapsedMessage(self, records):
+        """
+        Creates a message for sending values of different sensors at once. Json is only built when needed.
+        """
+        valuePostURI = self.makeValueSendingURI("sensors/addMultipleValues")
+        return postMessageObject(valuePostURI, None, lambda: {"collapsedMessages": [record.toJson() for record in records]})
+
+    def enqueueMessage(self, messageObject):
+        """
+        Puts a message to the sending queue, applying the configured backpressure policy
+        in case the queue already holds more than max_queue_length messages:
+
+        - block: wait till the queue is down to 2/3 of max_queue_length (at most
+          backpressure_timeout_msec if configured, then spill)
+        - drop_oldest: discard the oldest queued message to make room
+        - drop_newest: discard the new message
+        - downsample: only keep every backpressure_downsample_factor-th message
+        - spill: accept the message anyway. As the queue is backed by the spool,
+          this costs disk space but not memory.
+
+        Returns True if the message was queued.
+        """
+        maxLength = self.configData["max_queue_length"]
+        messageObject.queuedAt = time.time()
+        if self.stopped or self.draining or self.queueLength() <= maxLength:
+            # on shutdown, values still coming in are spilled to the spool rather than holding up the agents
+            self.threadedSendingQueue.put(messageObject)
+            return True
+        policy = self.configData["backpressure_policy"]
+        numValues = self.countContainedValues(messageObject.getJsonData())
+        if policy == "drop_newest":
+            self.countBackpressure("dropped_newest", numValues)
+            return False
+        if policy == "downsample":
+            with self.admissionLock:
+                self.downsampleCounter += 1
+                keep = self.downsampleCounter % self.configData["backpressure_downsample_factor"] == 0
+            if not keep:
+                self.countBackpressure("downsampled", numValues)
+                return False
+        elif policy == "drop_oldest":
+            try:
+                oldestMessage = self.threadedSendingQueue.get(block = False)
+                if oldestMessage is not None:
+                    self.threadedSendingQueue.task_done(oldestMessage)
+                    self.countBackpressure("dropped_oldest", self.countContainedValues(oldestMessage.getJsonData()))
+            except Queue.Empty:
+                pass
+        elif policy == "spill":
+            self.countBackpressure("spilled", numValues)
+        else:
+            targetLength = maxLength * 2 // 3
+            timeout = None
+            if self.configData["backpressure_timeout_msec"] > 0:
+                timeout = self.configData["backpressure_timeout_msec"] / 1000.0
+            self.logger.debug("Queue has more than %s entries - waiting till below %s..." % (maxLength, targetLength))
+            self.countBackpressure("blocked", numValues)
+            if not self.threadedSendingQueue.waitForLength(targetLength, timeout):
+                self.countBackpressure("block_timeouts", numValues)
+        self.threadedSendingQueue.put(messageObject)
+        return True
+
+    def countBackpressure(self, policyResult, numValues):
+        self.backpressureStats[policyResult].inc(numValues)
+
+    def flushLingerBatch(self):
+        """
+        Puts all values collected by sendValue in auto batching mode to the queue as one collapsed message.
+        Must be called without lingerCondition held: only taking the batch is done under the lock, as
+        enqueueing might block on backpressure and would hold up all other callers of sendValue then.
+        """
+        with self.lingerCondition:
+            records = self.lingerBatch
+            self.lingerBatch = []
+        if records:
+            self.enqueueMessage(self.makeCollapsedMessage(records))
+
+    def lingerBatchFlusher(self):
+        """
+        Runs in a thread of its own in auto batching mode and flushes collected values once the oldest one waited for auto_batch_linger_msec.
+        """
+        while not self.stopped:
+            with self.lingerCondition:
+                if not self.lingerBatch:
+                    self.lingerCondition.wait()
+                    continue
+                remaining = self.lingerDeadline - time.time()
+                if remaining > 0:
+                    self.lingerCondition.wait(remaining)
+                    continue
+            self.flushLingerBatch()
 
     def flushAllBulkSendingArrays(self):
         #print("flushing all bulk arrays")
         while self.bulkSendingArrays:
-            remoteSensorId = self.bulkSendingArrays.keys()[0]
+            remoteSensorId = next(iter(self.bulkSendingArrays))
             self.flushBulkSendingArray(remoteSensorId)
         # also flush the collapsed array if there is something in it
         if len(self.collapsedSendingArray) > 0:
-            valuePostURI = self.makeValueSendingURI("sensors/addMultipleValues")
-            collapsedJson = {"collapsedMessages": self.collapsedSendingArray}
+            records = self.collapsedSendingArray
             self.collapsedSendingArray = []
-            self.threadedSendingQueue.put(postMessageObject(valuePostURI, collapsedJson))
+            self.threadedSendingQueue.put(self.makeCollapsedMessage(records))
+        # and whatever was collected in auto batching mode
+        self.flushLingerBatch()
+        with self.lingerCondition:
+            self.lingerCondition.notify()
 
 
     def makeValueSendingJson(self, value, utcTime):
-        if utcTime == None:
-            utcTime = datetime.datetime.utcnow()
-        timestampstring = utcTime.strftime("%Y-%m-%dT%H:%M:%S.") + ("%sZ" % (utcTime.microsecond//1000))
+        timestampstring = timestampFormatter.format(timestampMsFromUtcTime(utcTime))
         # note: we always assume a number value here - string values are not supported by API yet but might be added somewhen later
         jsonData = {"numberValue":value, "timestamp":timestampstring}
         return jsonData
@@ -402,7 +771,7 @@ class OpenSenseNetInstance:
 
         heads = {}
         if withAuth:
-            heads = {"content-type": "application/json", "Authorization":self.configData["api_token"]}
+            heads = {"content-type": "application/json", "Authorization":self.tokenManager.token()}
         else:
             heads = {"content-type": "application/json"}
 
@@ -426,8 +795,8 @@ class OpenSenseNetInstance:
         """
         heads = {}
         if withAuth:
-            heads = {"Content-Type": "application/json", "Accept": "application/json", "Authorization":self.configData["api_token"]}
-            self.logger.debug("authorizing with %s..." % self.configData["api_token"])
+            heads = {"Content-Type": "application/json", "Accept": "application/json", "Authorization":self.tokenManager.token()}
+            self.logger.debug("authorizing with %s..." % self.tokenManager.token())
         else:
             heads = {"Content-Type": "application/json", "Accept": "application/json",}
             #heads = {"Content-Type": "application/json"}
@@ -461,8 +830,8 @@ class OpenSenseNetInstance:
         The call is protected by httpS if possible depending on the used python version
         """
         heads = {}
-        heads = {"Authorization":self.configData["api_token"]}
-        self.logger.debug("authorizing with %s..." % self.configData["api_token"])
+        heads = {"Authorization":self.tokenManager.token()}
+        self.logger.debug("authorizing with %s..." % self.tokenManager.token())
 
         callURI = ""
         if self.configData["encrypt_traffic"]:
@@ -523,77 +892,131 @@ class OpenSenseNetInstance:
                 #time.sleep(0.001)
                 pass
 
+            if not self.tokenManager.waitForToken(1):
+                continue # not logged in yet
+            if not self.circuitBreaker.allowRequest():
+                # endpoint is considered to be down - pause instead of hammering it
+                self.circuitBreaker.waitForChange()
+                continue
+
             # obsolete as we switch to requests lib
             # handle = None
             messageObject = self.threadedSendingQueue.get()
+            if messageObject is None:
+                self.circuitBreaker.releaseProbe()
+                self.logger.debug("exiting sender thread")
+                break # queue closed on shutdown
+            self.queueWaitTime.record(time.time() - messageObject.queuedAt)
 
             callURI = messageObject.getPostUri()
             jsonData = messageObject.getJsonData()
-            numContainedValues = 1
-            if "values" in jsonData:
-                numContainedValues = len(jsonData["values"])
-            heads = {"Content-Type": "application/json", "Accept": "application/json", "Authorization":self.configData["api_token"]}
+            token = self.tokenManager.token()
+            heads = {"Content-Type": "application/json", "Accept": "application/json", "Authorization":token}
 
             try:
                 #self.logger.debug("api post worker doing request...")
+                requestStart = time.time()
                 response = session.post(callURI, json=jsonData, headers=heads, verify=validateCert)
+                self.httpRoundTrip.record(time.time() - requestStart)
                 if response.status_code == requests.codes.ok:
                     #self.logger.debug("api post worker successfully sent message")
-                    self.numSentValues += numContainedValues
-                    self.notifyPostThreadSucceeded()
+                    self.messageSent(messageObject)
                 else:
                     if self.stopped:
                         self.logger.debug("exiting sender thread")
                         break
-                    self.logger.debug("Couldn't perform threaded api POST call to %s. Response Code: %s. Num succeeded / failed threads: %s / %s" % (callURI, response.status_code, self.numSucceededThreads, self.numFailedThreads))
+                    self.logger.debug("Couldn't perform threaded api POST call to %s. Response Code: %s. Num succeeded / failed threads: %s / %s" % (callURI, response.status_code, self.succeededRequests.value(), self.failedRequests.value()))
                     if response.status_code == 401:
-                        # authorization failed, might be due to token expiration, so re-logging in in case this was nt just recently triggered
-                        self.logger.info("Initiating new login to renew token")
-                        if not self.loginInitiated:
-                            self.loginInitiated = True
-                            self.logger.debug("Authentication failed at timestamp %s (last login at %s). Logging in again." % (time.time(), self.lastLogin))
-                            self.logger.debug("now invalid token is: %s" % self.configData["api_token"])
-                            self.login()
-                            self.loginInitiated = False
-                        else:
-                            while self.loginInitiated:
-                                # this thread shall wait some time till the other finished login
-                                self.logger.debug("waiting 0.5 sec for login to be completed by other thread")
-                                time.sleep(0.5)
-                    self.threadedSendingQueue.put(messageObject)
-                    self.notifyPostThreadFailed()
+                        self.messageUnauthorized(messageObject, token)
+                    else:
+                        self.messageFailed(messageObject, self.isEndpointFailure(response.status_code))
             except BaseException as e:
-                self.threadedSendingQueue.put(messageObject)
-                self.logger.debug("Couldn't perform threaded api POST call to %s. Exception message: %s. Putting message back in queue. Num succeeded / failed threads: %s / %s" % (callURI, e, self.numSucceededThreads, self.numFailedThreads))
-                self.notifyPostThreadFailed()
-            #self.logger.debug("Num succeeded / failed threads: %s / %s" % (self.numSucceededThreads, self.numFailedThreads))
-            self.threadedSendingQueue.task_done()
+                self.logger.debug("Couldn't perform threaded api POST call to %s. Exception message: %s. Scheduling message for retry. Num succeeded / failed threads: %s / %s" % (callURI, e, self.succeededRequests.value(), self.failedRequests.value()))
+                self.messageFailed(messageObject)
+            #self.logger.debug("Num succeeded / failed threads: %s / %s" % (self.succeededRequests.value(), self.failedRequests.value()))
 
-    def notifyPostThreadFailed (self):
+    def messageSent(self, messageObject):
         """
-        A notifier mainly used for internal monitoring/logging.
+        Accounting for a message successfully sent by any sender. Not to be called directly / manually.
         """
-        self.numFailedThreads += 1
+        self.sentValues.inc(self.countContainedValues(messageObject.getJsonData()))
+        self.endToEndLatency.record(time.time() - messageObject.createdAt)
+        self.circuitBreaker.recordSuccess()
+        self.threadedSendingQueue.task_done(messageObject)
+        self.notifyPostThreadSucceeded()
 
-    def notifyPostThreadSucceeded (self):
+    def isEndpointFailure(self, statusCode):
+        """
+        Returns True if a response status indicates a problem of the platform rather than of a single message.
+        """
+        return statusCode >= 500 or statusCode == 429
+
+    def countContainedValues(self, jsonData):
+        """
+        Returns the number of values contained in a message's json load.
+        """
+        numContainedValues = 1
+        if "values" in jsonData:
+            numContainedValues = len(jsonData["values"])
+        elif "collapsedMessages" in jsonData:
+            numContainedValues = len(jsonData["collapsedMessages"])
+        return numContainedValues
+
+    def messageFailed(self, messageObject, endpointFailure = True):
+        """
+        Schedules a message that could not be sent for a retry with exponential backoff. Failures
+        of the endpoint (rather than of the single message) also count for the circuit breaker.
+        Not to be called directly / manually.
+        """
+        if endpointFailure:
+            self.circuitBreaker.recordFailure()
+        else:
+            # the platform answered, only this message is at fault
+            self.circuitBreaker.recordSuccess()
+        if self.draining:
+            # no retries while shutting down - the message stays in the spool and is sent after restart
+            self.threadedSendingQueue.abandon(messageObject)
+            self.notifyPostThreadFailed()
+            if endpointFailure:
+                self.logger.info("platform failed during shutdown - leaving queued messages for next startup")
+                self.drainFinished.set()
+            return
+        messageObject.attempts += 1
+        delay = backoffDelay(messageObject.attempts, self.configData["retry_base_delay_msec"] / 1000.0, self.configData["retry_max_delay_msec"] / 1000.0)
+        self.delayedRetries.schedule(messageObject, delay)
+        self.notifyPostThreadFailed()
+
+    def messageUnauthorized(self, messageObject, token):
+        """
+        Handles a message rejected with 401 when sent with token: it is put back to the queue as soon
+        as there is a new token, without counting as failed attempt. Not to be called directly / manually.
+        """
+        self.circuitBreaker.recordSuccess() # the platform answered
+        self.notifyPostThreadFailed()
+        self.tokenManager.unauthorized(token, lambda: self.retryDue(messageObject))
+
+    def retryDue(self, messageObject):
+        """
+        Called once the retry of a failed message is due. Puts a copy of the message back to the
+        queue before marking the original one as done, so that it can't get lost in between.
+        """
+        retryMessage = postMessageObject(messageObject.getPostUri(), messageObject.getJsonData())
+        retryMessage.attempts = messageObject.attempts
+        retryMessage.createdAt = messageObject.createdAt
+        self.threadedSendingQueue.put(retryMessage)
+        self.threadedSendingQueue.task_done(messageObject)
+
+    def notifyPostThreadFailed (self):
         """
         A notifier mainly used for internal monitoring/logging.
         """
-        self.numSucceededThreads += 1
+        self.failedRequests.inc()
 
-    def transferQueueToMessageList(self):
+    def notifyPostThreadSucceeded (self):
         """
-        An internal method used for serializing yet unsent messages in case of main thread being stopped. Messages are read and send on next startup.
+        A notifier mainly used for internal monitoring/logging.
         """
-        self.configData["unsentMessages"] = []
-        msgCount = 0
-        while True:
-            messageObject = self.threadedSendingQueue.get()
-            #self.remainingMessages.append(messageObject)
-            self.configData["unsentMessages"].append({"postUri":messageObject.getPostUri(), "jsonData":messageObject.getJsonData()})
-            msgCount += 1
-            self.logger.debug("remembering unsent message %s..." % msgCount)
-            self.threadedSendingQueue.task_done()
+        self.succeededRequests.inc()
 
     def patchedGetAddrInfo(self, *args):
         """
@@ -620,48 +1043,81 @@ class OpenSenseNetInstance:
 
     def serializeConfig (self):
         """
-        Serializes internal config data (including a list of yet unsent messages) to disk for re-read on next startup.
+        Serializes internal config data to disk for re-read on next startup. Yet unsent messages are kept in the spool,
+        the api token in the state file. Writing is done shortly afterwards in the background (see ConfigStore).
         """
+        self.logger.info("Serializing OSN config to %s" % self.config_file)
+        configStore.write(self.config_file, self.configData)
 
-        with open(self.config_file, "w") as data_file:
-            self.logger.info("Serializing OSN config to %s" % self.config_file)
-            json.dump(self.configData, data_file, sort_keys = False, indent = 4, ensure_ascii=False)
-            # data_file.close
+    def beginShutdown(self):
+        """
+        To be called as soon as shutdown begins, before stopping the agents:
+        values coming in from then on are queued without applying the
+        backpressure policy, so that stopping agents is not held up.
+        """
+        self.draining = True
+        self.threadedSendingQueue.releaseBlocked()
 
-    def stop(self):
+    def stop(self, deadline = None):
         """
         Gracefully stops the OSN instance, doing some cleanup.
 
-        Waits for pending requests to be finalized so that no messages are lost
-        and serializes yet unsent messages to config file for handling at next
+        Values still buffered for bulk, collapsed or auto batched sending are
+        queued, and the sender threads go on sending at full speed until the
+        queue is empty or the deadline (epoch seconds, by default
+        shutdown_timeout_msec from now) passed. Messages failing meanwhile are
+        not retried, and if the platform seems down, the drain ends early.
+        Messages not sent by then remain in the spool and are sent on next
         startup.
         """
-        self.logger.info("stopping gracefully...")
-        self.stopped = True
-        self.logger.info("during runtime, sent %s values overall within %s seconds (%s values/s)" % (self.numSentValues, time.time()-self.startTime, self.numSentValues/(time.time()-self.startTime)))
+        if deadline is None:
+            deadline = time.time() + self.configData["shutdown_timeout_msec"] / 1000.0
+        self.logger.info("stopping gracefully, sending queued messages for at most %.1f sec..." % max(0, deadline - time.time()))
         # flush everything remembered for bulk sending and not yet put to message queue
+        self.beginShutdown()
         self.flushAllBulkSendingArrays()
-        # remember unsent messages in configdata
-        queueSerializer = Thread(target = self.transferQueueToMessageList)
-        queueSerializer.daemon = True # necessary as thread would otherwise block exiting tha main process. Join, however, prevents main process to proceed before serializer is done
-        queueSerializer.start() # also works on the same queue
-        self.threadedSendingQueue.join()
-        del queueSerializer # just to be safe
-        numUnsent = 0
-        if "unsentMessages" in self.configData:
-            numUnsent = len(self.configData["unsentMessages"])
-        self.logger.info("serialized %s unsent messages" % numUnsent)
-        #self.logger.info(self.configData["unsentMessages"])
-        self.serializeConfig()
+        # messages waiting for a retry get one last chance right away
+        self.delayedRetries.releaseAll()
+        if self.tokenManager.token():
+            drainer = Thread(target = self.drainQueue)
+            drainer.daemon = True
+            drainer.start()
+            self.drainFinished.wait(max(0, deadline - time.time()))
+        else:
+            self.logger.info("not logged in - leaving queued messages for next startup")
+        self.stopped = True
+        numSentValues = self.sentValues.value()
+        self.logger.info("during runtime, sent %s values overall within %s seconds (%s values/s)" % (numSentValues, time.time()-self.startTime, numSentValues/(time.time()-self.startTime)))
+        self.logger.info("values affected by backpressure policy %s: %s" % (self.configData["backpressure_policy"], dict((policyResult, counter.value()) for policyResult, counter in self.backpressureStats.items())))
+        self.logger.info("metrics at shutdown: %s" % self.metrics.snapshot())
+        self.circuitBreaker.wakeUp()
+        self.tokenManager.stop()
+        # unsent messages are already on disk, just make sure they are synced. Closing also wakes up the senders
+        self.threadedSendingQueue.close()
+        configStore.flush()
+
+    def drainQueue(self):
+        """Waits until all queued messages were handled during shutdown. Not to be called directly / manually."""
+        if self.threadedSendingQueue.join():
+            self.logger.info("all queued messages handled")
+        self.drainFinished.set()
 
 class postMessageObject:
-    def __init__(self, postUri, jsonData):
+    def __init__(self, postUri, jsonData, jsonBuilder = None):
         self.postUri = postUri
         self.jsonData = jsonData
+        self.jsonBuilder = jsonBuilder # if given, jsonData is only built on first access
+        self.spoolPosition = None # set by the spool, identifies the message on disk
+        self.attempts = 0 # number of failed sending attempts
+        self.createdAt = time.time() # for measuring end-to-end latency
+        self.queuedAt = self.createdAt # for measuring the time spent in the queue
         return
 
     def getPostUri(self):
         return self.postUri
 
     def getJsonData(self):
+        if self.jsonData is None and self.jsonBuilder is not None:
+            self.jsonData = self.jsonBuilder()
+            self.jsonBuilder = None
         return self.jsonData
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+
+This file is part of **opensense** project https://github.com/opensense-network/.
+    :platform: Unix, Windows, MacOS X
+    :sinopsis: opensense
+
+.. moduleauthor:: Frank Pallas <frank.pallas@tu-berlin.de>
+
+License : GPL(v3)
+
+**opensense** is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+**opensense** is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with opensense. If not, see http://www.gnu.org/licenses.
+
+"""
+import time
+import random
+import heapq
+import itertools
+import logging
+from threading import Thread, Lock, Condition
+
+def backoffDelay(attempts, baseDelaySec, maxDelaySec):
+    """
+    Returns the delay in seconds before retrying a message that already failed
+    attempts times: exponentially growing, capped at maxDelaySec, and with
+    random jitter so that retries of many messages don't arrive in lockstep.
+    """
+    delay = min(maxDelaySec, baseDelaySec * (2 ** max(attempts - 1, 0)))
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+class CircuitBreaker:
+    """
+    A circuit breaker shared by all senders.
+
+    After failureThreshold consecutive failures of the endpoint, the breaker
+    opens and senders pause instead of hammering an unreachable platform.
+    Once resetTimeoutSec passed, a single probe request is let through
+    (half-open). If it succeeds, the breaker closes again, otherwise it
+    stays open for another resetTimeoutSec. A caller that got the probe
+    but did not send it must hand it back with releaseProbe(). A probe
+    without outcome after probeTimeoutSec is considered lost and the next
+    caller may probe instead.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failureThreshold = 10, resetTimeoutSec = 30, probeTimeoutSec = 60):
+        self.logger = logging.getLogger(__name__)
+        self.failureThreshold = failureThreshold
+        self.resetTimeoutSec = resetTimeoutSec
+        self.probeTimeoutSec = probeTimeoutSec
+        self.condition = Condition()
+        self.state = self.CLOSED
+        self.consecutiveFailures = 0
+        self.openedAt = 0
+        self.probeInFlight = False
+        self.probeStartedAt = 0
+
+    def allowRequest(self):
+        """Returns True if a request may be sent now. In half-open state, only one caller gets True."""
+        with self.condition:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self.openedAt >= self.resetTimeoutSec:
+                self.logger.info("circuit half-open - probing endpoint")
+                self.state = self.HALF_OPEN
+                self.probeInFlight = False
+            if self.state == self.HALF_OPEN and self.probeInFlight and time.time() - self.probeStartedAt >= self.probeTimeoutSec:
+                self.logger.warning("no outcome of probe request after %s seconds - probing again" % self.probeTimeoutSec)
+                self.probeInFlight = False
+            if self.state == self.HALF_OPEN and not self.probeInFlight:
+                self.probeInFlight = True
+                self.probeStartedAt = time.time()
+                return True
+            return False
+
+    def releaseProbe(self):
+        """Hands back the probe taken by allowRequest if no request was sent after all."""
+        with self.condition:
+            if self.state == self.HALF_OPEN and self.probeInFlight:
+                self.probeInFlight = False
+                self.condition.notify_all()
+
+    def secondsUntilProbe(self):
+        with self.condition:
+            if self.state == self.OPEN:
+                return max(0, self.openedAt + self.resetTimeoutSec - time.time())
+            return 0
+
+    def waitForChange(self, maxWaitSec = None):
+        """Blocks until the breaker changes its state or a probe might be due."""
+        with self.condition:
+            if self.state == self.CLOSED:
+                return
+            waitSec = self.resetTimeoutSec
+            if self.state == self.OPEN:
+                waitSec = max(0.01, self.openedAt + self.resetTimeoutSec - time.time())
+            elif self.probeInFlight:
+                waitSec = max(0.01, self.probeStartedAt + self.probeTimeoutSec - time.time())
+            if maxWaitSec is not None:
+                waitSec = min(waitSec, maxWaitSec)
+            self.condition.wait(waitSec)
+
+    def recordSuccess(self):
+        with self.condition:
+            if self.state != self.CLOSED:
+                self.logger.info("endpoint reachable again - closing circuit")
+                self.condition.notify_all()
+            self.state = self.CLOSED
+            self.consecutiveFailures = 0
+            self.probeInFlight = False
+
+    def recordFailure(self):
+        with self.condition:
+            self.consecutiveFailures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.consecutiveFailures >= self.failureThreshold):
+                if self.state == self.CLOSED:
+                    self.logger.warning("%s consecutive failures - opening circuit for %s seconds" % (self.consecutiveFailures, self.resetTimeoutSec))
+                self.state = self.OPEN
+                self.openedAt = time.time()
+                self.probeInFlight = False
+                self.condition.notify_all()
+
+    def wakeUp(self):
+        """Wakes up all waiting senders, e.g. on shutdown."""
+        with self.condition:
+            self.condition.notify_all()
+
+class DelayedRetryQueue:
+    """
+    Holds messages until their retry is due and then hands them to a callback.
+
+    Messages waiting for a retry are thus kept out of the sending queue,
+    so that healthy traffic is not blocked behind them. A single thread
+    sleeps until the next retry is due.
+    """
+
+    def __init__(self, dueCallback):
+        self.logger = logging.getLogger(__name__)
+        self.dueCallback = dueCallback
+        self.condition = Condition()
+        self.heap = []
+        self.sequence = itertools.count() # keeps heap entries comparable for equal due times
+        self.stopped = False
+        worker = Thread(target = self.run)
+        worker.daemon = True
+        worker.start()
+
+    def schedule(self, messageObject, delaySec):
+        with self.condition:
+            heapq.heappush(self.heap, (time.time() + delaySec, next(self.sequence), messageObject))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (not self.heap or self.heap[0][0] > time.time()):
+                    if self.heap:
+                        self.condition.wait(self.heap[0][0] - time.time())
+                    else:
+                        self.condition.wait()
+                if self.stopped:
+                    break
+                dueTime, sequenceNumber, messageObject = heapq.heappop(self.heap)
+            try:
+                self.dueCallback(messageObject)
+            except BaseException as e:
+                self.logger.warning("Could not re-queue message for retry. Exception message: %s" % e)
+
+    def releaseAll(self):
+        """Hands all waiting messages to the callback right away and stops the retry thread."""
+        with self.condition:
+            self.stopped = True
+            messages = [entry[2] for entry in sorted(self.heap)]
+            self.heap = []
+            self.condition.notify_all()
+        for messageObject in messages:
+            self.dueCallback(messageObject)
+        return len(messages)
+
+    def __len__(self):
+        return len(self.heap)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+
+This file is part of **opensense** project https://github.com/opensense-network/.
+    :platform: Unix, Windows, MacOS X
+    :sinopsis: opensense
+
+.. moduleauthor:: Frank Pallas <frank.pallas@tu-berlin.de>
+
+License : GPL(v3)
+
+**opensense** is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+**opensense** is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with opensense. If not, see http://www.gnu.org/licenses.
+
+"""
+import time
+
+import logging
+from threading import Thread, Lock
+
+# eliminate Queue incompatibility between Python v2 and v3
+try:
+    # For Python 3.0 and later
+    import queue as Queue
+except ImportError:
+    # Fall back to Python 2's Queue
+    import Queue
+
+class SensorProvisioner(Thread):
+    """
+    Creates the sensors marked "create" in an agent's sensor mappings on the
+    platform in the background.
+
+    The catalog ids are resolved once per distinct combination of measurand,
+    unit and license, then the sensors are created by up to maxParallel
+    threads. Each remote ID is set in the sensor registry as soon as the
+    sensor exists, so that it is donated from then on - sensors already
+    mapped are donated all along. Once all sensors are done, finishedCallback
+    is called with the number of sensors created, for persisting them in a
+    single config write.
+    """
+
+    def __init__(self, osnInstance, sensorRegistry, mappings, finishedCallback, maxParallel = 8, defaultLicense = "ODC-PDDL"):
+        Thread.__init__(self)
+        self.daemon = True
+        self.logger = logging.getLogger(__name__)
+        self.osnInstance = osnInstance
+        self.sensorRegistry = sensorRegistry
+        self.mappings = mappings
+        self.finishedCallback = finishedCallback
+        self.maxParallel = max(1, maxParallel)
+        self.defaultLicense = defaultLicense
+        self.lock = Lock()
+        self.numCreated = 0
+        self.numFailed = 0
+        self.stopped = False
+
+    def run(self):
+        self.logger.info("creating %s sensors on the platform" % len(self.mappings))
+        resolvedParams = {} # (measurand, unit, license) -> catalog ids or None
+        jobs = Queue.Queue()
+        numUnsupported = 0
+        for mapping in self.mappings:
+            if self.stopped:
+                break
+            catalogKey = (mapping.get("measurand", ""), mapping.get("unit", ""), mapping.get("license", self.defaultLicense))
+            if catalogKey not in resolvedParams:
+                resolvedParams[catalogKey] = self.osnInstance.resolveSensorParams(*catalogKey)
+            if resolvedParams[catalogKey] is None:
+                numUnsupported += 1
+                continue
+            jobs.put((mapping["local_id"], resolvedParams[catalogKey]))
+
+        workers = []
+        for i in range(min(self.maxParallel, jobs.qsize())):
+            worker = Thread(target = self.createSensors, args = (jobs,))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+
+        self.logger.info("created %s sensors on the platform, %s failed, %s not supported by the platform%s" % \
+            (self.numCreated, self.numFailed, numUnsupported, " (stopped early)" if self.stopped else ""))
+        self.finishedCallback(self.numCreated)
+
+    def createSensors(self, jobs):
+        """Worker loop creating sensors until no job is left or provisioning is stopped."""
+        while not self.stopped:
+            try:
+                localId, params = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            remoteId = None
+            try:
+                remoteId = self.osnInstance.addRemoteSensor(params)
+            except BaseException as e:
+                self.logger.warning("Could not create sensor for local ID %s. Exception message: %s" % (localId, e))
+            with self.lock:
+                if remoteId:
+                    self.sensorRegistry.setRemoteId(localId, "%s" % remoteId)
+                    self.numCreated += 1
+                else:
+                    self.numFailed += 1
+
+    def stop(self, timeout = None):
+        """
+        Stops creating further sensors and waits until the creations in
+        progress are done and finishedCallback was called.
+        """
+        self.stopped = True
+        if self.is_alive():
+            self.join(timeout)
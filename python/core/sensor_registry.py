@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+
+This file is part of **opensense** project https://github.com/opensense-network/.
+    :platform: Unix, Windows, MacOS X
+    :sinopsis: opensense
+
+.. moduleauthor:: Frank Pallas <frank.pallas@tu-berlin.de>
+
+License : GPL(v3)
+
+**opensense** is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+**opensense** is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with opensense. If not, see http://www.gnu.org/licenses.
+
+"""
+from threading import Lock
+
+class SensorRegistry:
+    """
+    Indexed access to an agent's sensor mappings.
+
+    The registry wraps the list stored as "sensor_mappings" in an agent's
+    config data and keeps dict indexes by local ID, by remote ID and by
+    measurand, so that looking up a sensor for every single value does not
+    require traversing all mappings. The wrapped list itself remains the
+    authoritative data that is serialized to the config file - it must thus
+    only be changed through the registry (or be followed by reload()).
+
+    Like the linear lookups it replaces, the registry uses the first mapping
+    in case a local ID is configured more than once.
+
+    Mappings with the remote ID "create" are placeholders for sensors yet to
+    be created on the platform - they are neither active nor indexed by
+    remote ID until the actual remote ID is set.
+    """
+
+    createRemoteId = "create"
+
+    def __init__(self, mappings):
+        self.lock = Lock()
+        self.reload(mappings)
+
+    def reload(self, mappings):
+        """(Re)builds all indexes from the given list of sensor mappings."""
+        with self.lock:
+            self.mappings = mappings
+            self.byLocalId = {}
+            self.byRemoteId = {}
+            self.byMeasurand = {}
+            for mapping in self.mappings:
+                self.indexMapping(mapping)
+
+    def indexMapping(self, mapping):
+        if "local_id" not in mapping or mapping["local_id"] in self.byLocalId:
+            return
+        self.byLocalId[mapping["local_id"]] = mapping
+        remoteId = mapping.get("remote_id", "")
+        if remoteId not in ("", self.createRemoteId):
+            self.byRemoteId.setdefault(remoteId, mapping)
+        self.byMeasurand.setdefault(mapping.get("measurand", ""), []).append(mapping)
+
+    def unindexMapping(self, mapping):
+        localId = mapping["local_id"]
+        if self.byLocalId.get(localId) is not mapping:
+            return
+        del self.byLocalId[localId]
+        remoteId = mapping.get("remote_id", "")
+        if self.byRemoteId.get(remoteId) is mapping:
+            del self.byRemoteId[remoteId]
+        measurandMappings = self.byMeasurand.get(mapping.get("measurand", ""), [])
+        if mapping in measurandMappings:
+            measurandMappings.remove(mapping)
+            if not measurandMappings:
+                del self.byMeasurand[mapping.get("measurand", "")]
+        # a duplicate mapping for the same local ID now takes over
+        for otherMapping in self.mappings:
+            if otherMapping is not mapping and otherMapping.get("local_id") == localId:
+                self.indexMapping(otherMapping)
+                break
+
+    def add(self, mapping):
+        """Appends a new mapping. Returns False if the local ID is already configured."""
+        with self.lock:
+            if mapping["local_id"] in self.byLocalId:
+                return False
+            self.mappings.append(mapping)
+            self.indexMapping(mapping)
+            return True
+
+    def remove(self, localSensorId):
+        """Removes the mapping for the given local ID. Returns the removed mapping or None."""
+        with self.lock:
+            mapping = self.byLocalId.get(localSensorId)
+            if mapping is None:
+                return None
+            self.mappings.remove(mapping)
+            self.unindexMapping(mapping)
+            return mapping
+
+    def setRemoteId(self, localSensorId, remoteSensorId):
+        """Changes the remote ID of a configured sensor while keeping the remote ID index consistent."""
+        with self.lock:
+            mapping = self.byLocalId.get(localSensorId)
+            if mapping is None:
+                return False
+            oldRemoteId = mapping.get("remote_id", "")
+            if self.byRemoteId.get(oldRemoteId) is mapping:
+                del self.byRemoteId[oldRemoteId]
+            mapping["remote_id"] = remoteSensorId
+            if remoteSensorId not in ("", self.createRemoteId):
+                self.byRemoteId.setdefault(remoteSensorId, mapping)
+            return True
+
+    def get(self, localSensorId):
+        """Returns the mapping for the given local ID or None if not configured."""
+        return self.byLocalId.get(localSensorId)
+
+    def getByRemoteId(self, remoteSensorId):
+        return self.byRemoteId.get(remoteSensorId)
+
+    def getByMeasurand(self, measurandString):
+        return list(self.byMeasurand.get(measurandString, []))
+
+    def remoteId(self, localSensorId, default = None):
+        mapping = self.byLocalId.get(localSensorId)
+        if mapping is None:
+            return default
+        return mapping.get("remote_id", "")
+
+    def pendingCreation(self):
+        """Returns the mappings of sensors marked for creation on the platform."""
+        with self.lock:
+            return [mapping for mapping in self.mappings if "local_id" in mapping and mapping.get("remote_id") == self.createRemoteId]
+
+    def isConfigured(self, localSensorId):
+        return localSensorId in self.byLocalId
+
+    def isActive(self, localSensorId):
+        """A sensor is active if it is configured and has a remote ID (other than "create")."""
+        mapping = self.byLocalId.get(localSensorId)
+        return mapping is not None and mapping.get("remote_id", "") not in ("", self.createRemoteId)
+
+    def __len__(self):
+        return len(self.byLocalId)
+
+    def __iter__(self):
+        return iter(list(self.mappings))
@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+"""
+
+This file is part of **opensense** project https://github.com/opensense-network/.
+    :platform: Unix, Windows, MacOS X
+    :sinopsis: opensense
+
+.. moduleauthor:: Frank Pallas <frank.pallas@tu-berlin.de>
+
+License : GPL(v3)
+
+**opensense** is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+**opensense** is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with opensense. If not, see http://www.gnu.org/licenses.
+
+"""
+import json
+import time
+import os
+import logging
+import collections
+from threading import Thread, Lock, Condition
+
+# eliminate Queue incompatibility between Python v2 and v3
+try:
+    # For Python 3.0 and later
+    from queue import Empty
+except ImportError:
+    # Fall back to Python 2's Queue
+    from Queue import Empty
+
+from .config_store import replaceFile
+
+class SpooledSendingQueue:
+    """
+    A crash-safe, disk-backed replacement for the in-memory sending queue.
+
+    Every message put to this queue is appended to a segmented spool on disk
+    (one JSON line per message) before it is handed out to sender threads.
+    Only a bounded number of messages is kept in memory at a time - the rest
+    stays on disk and is read lazily once the sender threads catch up. Writes
+    are fsynced in batches (by count or by time), and the position of the
+    oldest yet unacknowledged message is checkpointed so that on restart only
+    messages that were not confirmed by the platform are replayed. Delivery
+    is thus "at least once": messages in flight during a crash are re-sent.
+
+    The interface mimics Queue.Queue (put, get, task_done, qsize, join) so
+    that the sender threads don't have to care where messages come from.
+    task_done takes the handled message object as optional argument, which
+    is required for advancing the checkpoint.
+    """
+
+    checkpointFileName = "checkpoint.json"
+    segmentSuffix = ".seg"
+
+    def __init__(self, spoolDir, messageFactory, segmentBytes = 4194304, fsyncBatch = 100, fsyncIntervalMsec = 1000, memoryMessages = 1000):
+        self.logger = logging.getLogger(__name__)
+        self.spoolDir = spoolDir
+        self.messageFactory = messageFactory # called as messageFactory(postUri, jsonData) when reading from disk
+        self.segmentBytes = segmentBytes
+        self.fsyncBatch = fsyncBatch
+        self.fsyncInterval = fsyncIntervalMsec / 1000.0
+        self.memoryMessages = memoryMessages
+
+        self.lock = Lock()
+        self.notEmpty = Condition(self.lock)
+        self.allTasksDone = Condition(self.lock)
+        self.notFull = Condition(self.lock)
+        self.closing = Condition(self.lock)
+        self.memoryBuffer = collections.deque() # (position, nextPosition, messageObject) not yet handed out
+        self.pendingRecords = collections.OrderedDict() # position -> [nextPosition, acked] for handed out messages, in spool order
+        self.numQueued = 0
+        self.unfinishedTasks = 0
+        self.closed = False
+        self.blockingReleased = False # set on shutdown, waitForLength doesn't block anymore then
+
+        self.writeHandle = None
+        self.writeSegment = 0
+        self.writeOffset = 0
+        self.unsyncedRecords = 0
+        self.lastSync = time.time()
+        self.readHandle = None
+        self.readHandleSegment = None
+        self.readPosition = (0, 0)
+        self.checkpoint = (0, 0)
+        self.acksSinceCheckpoint = 0
+        self.lastCheckpoint = time.time()
+
+        self.recover()
+
+        syncer = Thread(target = self.periodicSync)
+        syncer.daemon = True
+        syncer.start()
+
+    def segmentPath(self, segment):
+        return os.path.join(self.spoolDir, "%012d%s" % (segment, self.segmentSuffix))
+
+    def existingSegments(self):
+        segments = []
+        for fileName in os.listdir(self.spoolDir):
+            if fileName.endswith(self.segmentSuffix):
+                try:
+                    segments.append(int(fileName[:-len(self.segmentSuffix)]))
+                except ValueError:
+                    self.logger.warning("Ignoring unexpected file %s in spool directory" % fileName)
+        return sorted(segments)
+
+    def recover(self):
+        """
+        Restores the spool state from disk: reads the checkpoint, drops fully
+        acknowledged segments, cuts off a partially written last record and
+        counts the messages still to be sent. Messages themselves are not
+        loaded here but streamed lazily by get().
+        """
+        if not os.path.isdir(self.spoolDir):
+            os.makedirs(self.spoolDir)
+        checkpointFile = os.path.join(self.spoolDir, self.checkpointFileName)
+        if os.path.isfile(checkpointFile):
+            try:
+                with open(checkpointFile) as checkpointHandle:
+                    checkpointData = json.load(checkpointHandle)
+                self.checkpoint = (int(checkpointData["segment"]), int(checkpointData["offset"]))
+            except BaseException as e:
+                self.logger.warning("Could not read spool checkpoint, replaying whole spool. Exception message: %s" % e)
+
+        segments = self.existingSegments()
+        for segment in segments:
+            if segment < self.checkpoint[0]:
+                os.remove(self.segmentPath(segment))
+        segments = [segment for segment in segments if segment >= self.checkpoint[0]]
+        if segments and segments[0] > self.checkpoint[0]:
+            # the checkpointed segment is gone - start at the oldest one still there
+            self.checkpoint = (segments[0], 0)
+
+        if segments:
+            self.writeSegment = segments[-1]
+            self.truncatePartialRecord(self.segmentPath(self.writeSegment))
+        else:
+            # nothing left to replay - start over with a fresh segment
+            self.checkpoint = (self.checkpoint[0] + 1, 0)
+            self.writeSegment = self.checkpoint[0]
+        self.writeHandle = open(self.segmentPath(self.writeSegment), "ab")
+        self.writeOffset = self.writeHandle.tell()
+        if self.checkpoint > (self.writeSegment, self.writeOffset):
+            # records behind the checkpoint got lost before they were synced
+            self.checkpoint = (self.writeSegment, self.writeOffset)
+        self.readPosition = self.checkpoint
+
+        for segment in segments:
+            startOffset = 0
+            if segment == self.checkpoint[0]:
+                startOffset = self.checkpoint[1]
+            self.numQueued += self.countRecords(self.segmentPath(segment), startOffset)
+        self.unfinishedTasks = self.numQueued
+        if self.numQueued > 0:
+            self.logger.info("spool at %s contains %s yet unsent messages" % (self.spoolDir, self.numQueued))
+
+    def truncatePartialRecord(self, path):
+        with open(path, "rb+") as segmentHandle:
+            content = segmentHandle.read()
+            if content and not content.endswith(b"\n"):
+                validLength = content.rfind(b"\n") + 1
+                self.logger.warning("Cutting off partially written record in %s" % path)
+                segmentHandle.truncate(validLength)
+
+    def countRecords(self, path, startOffset):
+        count = 0
+        with open(path, "rb") as segmentHandle:
+            segmentHandle.seek(startOffset)
+            while True:
+                chunk = segmentHandle.read(1048576)
+                if not chunk:
+                    break
+                count += chunk.count(b"\n")
+        return count
+
+    def put(self, messageObject, block = True, timeout = None):
+        """
+        Appends a message to the spool. block and timeout are only accepted
+        for compatibility with Queue.Queue - the spool is unbounded.
+        """
+        record = json.dumps({"postUri":messageObject.getPostUri(), "jsonData":messageObject.getJsonData()}, separators=(",", ":")) + "\n"
+        record = record.encode("utf-8")
+        with self.lock:
+            if self.closed:
+                # the message is either already in the spool (re-put after a failed attempt) or
+                # comes in after shutdown. In both cases, there is nothing we can do about it here.
+                self.logger.debug("spool already closed - not accepting further messages")
+                return
+            if self.writeOffset >= self.segmentBytes:
+                self.rotateSegment()
+            position = (self.writeSegment, self.writeOffset)
+            self.writeHandle.write(record)
+            self.writeHandle.flush()
+            self.writeOffset += len(record)
+            nextPosition = (self.writeSegment, self.writeOffset)
+            self.unsyncedRecords += 1
+            if self.unsyncedRecords >= self.fsyncBatch:
+                self.sync()
+            self.numQueued += 1
+            self.unfinishedTasks += 1
+            if self.readPosition == position and len(self.memoryBuffer) < self.memoryMessages:
+                # reader is up to date - hand over directly instead of reading back from disk
+                messageObject.spoolPosition = position
+                self.memoryBuffer.append((position, nextPosition, messageObject))
+                self.readPosition = nextPosition
+            self.notEmpty.notify()
+
+    def get(self, block = True, timeout = None):
+        """
+        Hands out the next message. Returns None once the spool is closed, so
+        that senders blocked here wake up on shutdown.
+        """
+        with self.lock:
+            deadline = None
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self.memoryBuffer or self.closed:
+                if self.closed:
+                    return None
+                self.fillMemoryBuffer()
+                if self.memoryBuffer:
+                    break
+                if not block:
+                    raise Empty
+                if deadline is None:
+                    self.notEmpty.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Empty
+                    self.notEmpty.wait(remaining)
+            position, nextPosition, messageObject = self.memoryBuffer.popleft()
+            self.pendingRecords[position] = [nextPosition, False]
+            self.numQueued -= 1
+            self.notFull.notify_all()
+            return messageObject
+
+    def fillMemoryBuffer(self):
+        """Streams messages from disk into memory. Must be called with lock held."""
+        while len(self.memoryBuffer) < self.memoryMessages and self.readPosition < (self.writeSegment, self.writeOffset):
+            segment, offset = self.readPosition
+            if self.readHandleSegment != segment:
+                if self.readHandle:
+                    self.readHandle.close()
+                self.readHandle = None
+                self.readHandleSegment = None
+                if not os.path.isfile(self.segmentPath(segment)):
+                    self.readPosition = (segment + 1, 0)
+                    continue
+                self.readHandle = open(self.segmentPath(segment), "rb")
+                self.readHandleSegment = segment
+            if self.readHandle.tell() != offset:
+                self.readHandle.seek(offset)
+            line = self.readHandle.readline()
+            if not line:
+                # end of this segment reached - continue with next one
+                self.readPosition = (segment + 1, 0)
+                continue
+            nextPosition = (segment, offset + len(line))
+            position = self.readPosition
+            self.readPosition = nextPosition
+            try:
+                record = json.loads(line.decode("utf-8"))
+                messageObject = self.messageFactory(record["postUri"], record["jsonData"])
+            except BaseException as e:
+                self.logger.warning("Skipping unreadable spool record at %s. Exception message: %s" % (position, e))
+                self.numQueued -= 1
+                self.unfinishedTasks -= 1
+                continue
+            messageObject.spoolPosition = position
+            self.memoryBuffer.append((position, nextPosition, messageObject))
+
+    def task_done(self, messageObject = None):
+        """
+        Marks a message handed out by get() as handled, i.e. it was either sent
+        or put to the queue again. Only handled messages are skipped on replay.
+        """
+        with self.lock:
+            if self.closed:
+                # too late - the message is replayed on next startup
+                return
+            self.unfinishedTasks -= 1
+            position = getattr(messageObject, "spoolPosition", None)
+            if position in self.pendingRecords:
+                self.pendingRecords[position][1] = True
+                self.advanceCheckpoint()
+            if self.unfinishedTasks <= 0:
+                self.allTasksDone.notify_all()
+
+    def abandon(self, messageObject):
+        """
+        Gives up a message handed out by get() without acknowledging it, e.g.
+        one that failed during shutdown. It is replayed on next startup.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.unfinishedTasks -= 1
+            if self.unfinishedTasks <= 0:
+                self.allTasksDone.notify_all()
+
+    def advanceCheckpoint(self):
+        """
+        Moves the checkpoint to the oldest record not yet acknowledged - a
+        handed out one, else one waiting in memory, else the next one to be
+        read from disk. Must be called with lock held.
+        """
+        while self.pendingRecords:
+            position = next(iter(self.pendingRecords))
+            if not self.pendingRecords[position][1]:
+                break
+            del self.pendingRecords[position]
+        if self.pendingRecords:
+            newCheckpoint = next(iter(self.pendingRecords))
+        elif self.memoryBuffer:
+            newCheckpoint = self.memoryBuffer[0][0]
+        else:
+            newCheckpoint = self.readPosition
+        if newCheckpoint != self.checkpoint:
+            self.checkpoint = newCheckpoint
+            self.acksSinceCheckpoint += 1
+            if self.acksSinceCheckpoint >= self.fsyncBatch:
+                self.writeCheckpoint()
+
+    def writeCheckpoint(self):
+        """Atomically persists the checkpoint and removes fully handled segments. Must be called with lock held."""
+        self.sync()
+        checkpointFile = os.path.join(self.spoolDir, self.checkpointFileName)
+        tempFile = checkpointFile + ".tmp"
+        with open(tempFile, "w") as checkpointHandle:
+            json.dump({"segment":self.checkpoint[0], "offset":self.checkpoint[1]}, checkpointHandle)
+            checkpointHandle.flush()
+            os.fsync(checkpointHandle.fileno())
+        replaceFile(tempFile, checkpointFile)
+        self.acksSinceCheckpoint = 0
+        self.lastCheckpoint = time.time()
+        for segment in self.existingSegments():
+            if segment < self.checkpoint[0] and segment != self.writeSegment:
+                if self.readHandleSegment == segment:
+                    self.readHandle.close()
+                    self.readHandle = None
+                    self.readHandleSegment = None
+                os.remove(self.segmentPath(segment))
+
+    def rotateSegment(self):
+        """Starts a new segment file. Must be called with lock held."""
+        self.sync()
+        self.writeHandle.close()
+        if self.readPosition == (self.writeSegment, self.writeOffset):
+            self.readPosition = (self.writeSegment + 1, 0)
+        self.writeSegment += 1
+        self.writeHandle = open(self.segmentPath(self.writeSegment), "ab")
+        self.writeOffset = 0
+
+    def sync(self):
+        """Forces written records to disk. Must be called with lock held."""
+        if self.unsyncedRecords > 0:
+            self.writeHandle.flush()
+            os.fsync(self.writeHandle.fileno())
+            self.unsyncedRecords = 0
+        self.lastSync = time.time()
+
+    def periodicSync(self):
+        """Runs in a background thread so that records and checkpoint also reach the disk when traffic is low."""
+        with self.lock:
+            while not self.closed:
+                self.closing.wait(self.fsyncInterval)
+                if self.closed:
+                    break
+                if self.unsyncedRecords > 0:
+                    self.sync()
+                if self.acksSinceCheckpoint > 0:
+                    self.writeCheckpoint()
+
+    def waitForLength(self, targetLength, timeout = None):
+        """
+        Blocks until at most targetLength messages are queued or timeout (in seconds) passed.
+        Returns True if the queue is short enough, False on timeout.
+        """
+        with self.lock:
+            deadline = None
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while self.numQueued > targetLength and not self.closed and not self.blockingReleased:
+                if deadline is None:
+                    self.notFull.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.notFull.wait(remaining)
+            return True
+
+    def releaseBlocked(self):
+        """Wakes up all callers waiting in waitForLength and makes it return right away from then on."""
+        with self.lock:
+            self.blockingReleased = True
+            self.notFull.notify_all()
+
+    def qsize(self):
+        """Returns the number of messages not yet handed out, no matter if in memory or on disk."""
+        return self.numQueued
+
+    def memorySize(self):
+        """Returns the number of messages currently held in memory."""
+        return len(self.memoryBuffer)
+
+    def empty(self):
+        return self.numQueued == 0
+
+    def join(self, timeout = None):
+        """
+        Blocks until all messages were handled (or timeout in seconds passed).
+        Returns True if so, False on timeout or if the spool got closed.
+        """
+        with self.lock:
+            deadline = None
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while self.unfinishedTasks > 0 and not self.closed:
+                if deadline is None:
+                    self.allTasksDone.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.allTasksDone.wait(remaining)
+            return self.unfinishedTasks <= 0
+
+    def close(self):
+        """
+        Syncs all records and the checkpoint to disk and closes the spool.
+        Messages not yet acknowledged by then are replayed on next startup.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.sync()
+            self.writeCheckpoint()
+            self.writeHandle.close()
+            if self.readHandle:
+                self.readHandle.close()
+                self.readHandle = None
+                self.readHandleSegment = None
+            self.closed = True
+            self.notFull.notify_all()
+            self.notEmpty.notify_all() # senders waiting in get() receive None
+            self.allTasksDone.notify_all()
+            self.closing.notify_all()
+            numInFlight = len([record for record in self.pendingRecords.values() if not record[1]])
+            self.logger.info("closed spool with %s yet unsent messages" % (self.numQueued + numInFlight))
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+
+This file is part of **opensense** project https://github.com/opensense-network/.
+    :platform: Unix, Windows, MacOS X
+    :sinopsis: opensense
+
+.. moduleauthor:: Frank Pallas <frank.pallas@tu-berlin.de>
+
+License : GPL(v3)
+
+**opensense** is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+**opensense** is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with opensense. If not, see http://www.gnu.org/licenses.
+
+"""
+import time
+import logging
+from threading import Thread, Condition
+
+class TokenManager(Thread):
+    """
+    Manages the api token, doing exactly one login at a time in a thread of
+    its own.
+
+    Senders whose request was rejected with 401 call unauthorized() with the
+    token they used and a callback. If that token has been replaced meanwhile,
+    the callback is called right away, otherwise it is called once the next
+    login succeeded - no sender thread ever waits for a login. Logins are
+    done at most once every minLoginIntervalSec. If the platform tells the
+    token's ttl, the token is refreshed in the background before it expires.
+    """
+
+    def __init__(self, loginFunction, token = "", minLoginIntervalSec = 60, refreshShare = 0.8):
+        Thread.__init__(self)
+        self.daemon = True
+        self.logger = logging.getLogger(__name__)
+        self.loginFunction = loginFunction # returns (token, ttl in seconds or None), or None if login failed
+        self.minLoginInterval = minLoginIntervalSec
+        self.refreshShare = refreshShare # share of the ttl after which the token is refreshed
+        self.condition = Condition()
+        self.currentToken = token
+        self.refreshAt = None
+        self.loginRequested = False
+        self.lastLoginAttempt = 0
+        self.numLoginAttempts = 0
+        self.waiting = [] # callbacks to be called after the next successful login
+        self.stopped = False
+
+    def token(self):
+        return self.currentToken
+
+    def requestLogin(self, wait = False, timeout = None):
+        """
+        Requests a login. With wait set, blocks till it was attempted (or
+        timeout passed) and returns whether a token is available.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.condition:
+            attempts = self.numLoginAttempts
+            self.loginRequested = True
+            self.condition.notify_all()
+            while wait and self.numLoginAttempts == attempts and not self.stopped:
+                if deadline is None:
+                    self.condition.wait()
+                elif time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+                else:
+                    break
+            return self.currentToken != ""
+
+    def waitForToken(self, timeout = None):
+        """Blocks until a token is available (or timeout passed, or stopped). Returns whether there is one."""
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.condition:
+            while self.currentToken == "" and not self.stopped:
+                if deadline is None:
+                    self.condition.wait()
+                elif time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+                else:
+                    break
+            return self.currentToken != ""
+
+    def unauthorized(self, rejectedToken, callback):
+        """Called for a request rejected with rejectedToken. callback is called as soon as a new token is available."""
+        with self.condition:
+            renewed = rejectedToken != self.currentToken
+            if not renewed:
+                self.waiting.append(callback)
+                if not self.loginRequested:
+                    self.logger.info("Token was rejected - logging in again.")
+                    self.loginRequested = True
+                    self.condition.notify_all()
+        if renewed:
+            callback()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and not self.loginRequested and (self.refreshAt is None or time.time() < self.refreshAt):
+                    if self.refreshAt is None:
+                        self.condition.wait()
+                    else:
+                        self.condition.wait(self.refreshAt - time.time())
+                # logins shall not happen more often than once every minLoginInterval
+                while not self.stopped and time.time() - self.lastLoginAttempt < self.minLoginInterval:
+                    self.logger.info("repeated login - postponing for %.1f sec" % (self.minLoginInterval - (time.time() - self.lastLoginAttempt)))
+                    self.condition.wait(self.minLoginInterval - (time.time() - self.lastLoginAttempt))
+                if self.stopped:
+                    break
+                self.loginRequested = False
+                self.lastLoginAttempt = time.time()
+            try:
+                result = self.loginFunction()
+            except BaseException as e:
+                self.logger.warning("Login failed. Exception message: %s" % e)
+                result = None
+            callbacks = []
+            with self.condition:
+                self.numLoginAttempts += 1
+                if result is None:
+                    self.loginRequested = True # try again once the min login interval passed
+                else:
+                    self.currentToken, ttl = result
+                    self.refreshAt = None
+                    if ttl:
+                        self.refreshAt = time.time() + ttl * self.refreshShare
+                    callbacks = self.waiting
+                    self.waiting = []
+                self.condition.notify_all()
+            for callback in callbacks:
+                try:
+                    callback()
+                except BaseException as e:
+                    self.logger.warning("Callback after login failed. Exception message: %s" % e)
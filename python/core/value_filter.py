@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+
+This file is part of **opensense** project https://github.com/opensense-network/.
+    :platform: Unix, Windows, MacOS X
+    :sinopsis: opensense
+
+.. moduleauthor:: Frank Pallas <frank.pallas@tu-berlin.de>
+
+License : GPL(v3)
+
+**opensense** is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+**opensense** is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with opensense. If not, see http://www.gnu.org/licenses.
+
+"""
+import time
+
+class ValueFilter:
+    """
+    Decides per sensor whether a new value is worth sending at all.
+
+    Configured via the following optional keys of a sensor mapping:
+
+    - deadband_absolute: only send if the value changed by more than this
+    - deadband_relative: only send if the value changed by more than this
+      share of the last sent value (e.g. 0.01 for 1%)
+    - min_interval_msec: never send more often than this
+    - max_suppression_msec: never drop values for longer than this; the
+      first value arriving after this time is sent even if it did not change.
+      This is no heartbeat: the filter only runs when the sensor delivers a
+      value, so nothing is sent while the sensor is silent.
+      (Formerly called max_interval_msec, which is still understood.)
+
+    If both deadbands are configured, a change must exceed both. Values
+    that are not numbers are compared for equality instead.
+    """
+
+    configKeys = ("deadband_absolute", "deadband_relative", "min_interval_msec", "max_suppression_msec")
+    # old key name -> current one
+    deprecatedKeys = {"max_interval_msec": "max_suppression_msec"}
+
+    def __init__(self, deadbandAbsolute = None, deadbandRelative = None, minIntervalMsec = None, maxSuppressionMsec = None):
+        self.deadbandAbsolute = deadbandAbsolute
+        self.deadbandRelative = deadbandRelative
+        self.minInterval = None
+        if minIntervalMsec:
+            self.minInterval = minIntervalMsec / 1000.0
+        self.maxSuppression = None
+        if maxSuppressionMsec:
+            self.maxSuppression = maxSuppressionMsec / 1000.0
+        self.lastValue = None
+        self.lastTime = 0
+
+    @classmethod
+    def fromMapping(cls, mapping, defaults = None):
+        """
+        Creates a filter from a sensor mapping, falling back to the given defaults
+        for keys not set in the mapping. Returns None if nothing is configured.
+        """
+        settings = {}
+        for source in (defaults or {}, mapping):
+            for key in cls.deprecatedKeys:
+                if key in source:
+                    settings[cls.deprecatedKeys[key]] = source[key]
+            for key in cls.configKeys:
+                if key in source:
+                    settings[key] = source[key]
+        if not any(settings.get(key) is not None for key in cls.configKeys):
+            return None
+        return cls(settings.get("deadband_absolute"), settings.get("deadband_relative"), \
+            settings.get("min_interval_msec"), settings.get("max_suppression_msec"))
+
+    def accept(self, value, now = None):
+        """Returns True if value is to be sent, and remembers it as last sent value in that case."""
+        if now is None:
+            now = time.time()
+        if self.lastValue is not None and not self.significant(value, now):
+            return False
+        self.lastValue = value
+        self.lastTime = now
+        return True
+
+    def significant(self, value, now):
+        elapsed = now - self.lastTime
+        if self.minInterval is not None and elapsed < self.minInterval:
+            return False
+        if self.maxSuppression is not None and elapsed >= self.maxSuppression:
+            return True
+        if self.deadbandAbsolute is None and self.deadbandRelative is None:
+            return True
+        try:
+            change = abs(float(value) - float(self.lastValue))
+        except (TypeError, ValueError):
+            return value != self.lastValue
+        if self.deadbandAbsolute is not None and change <= self.deadbandAbsolute:
+            return False
+        if self.deadbandRelative is not None and change <= self.deadbandRelative * abs(float(self.lastValue)):
+            return False
+        return True
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+
+This file is part of **opensense** project https://github.com/opensense-network/.
+    :platform: Unix, Windows, MacOS X
+    :sinopsis: opensense
+
+.. moduleauthor:: Frank Pallas <frank.pallas@tu-berlin.de>
+
+License : GPL(v3)
+
+**opensense** is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+**opensense** is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with opensense. If not, see http://www.gnu.org/licenses.
+
+"""
+import time
+import math
+import calendar
+from array import array
+
+class TimestampFormatter:
+    """
+    Formats epoch milliseconds as ISO-8601 UTC timestamps as expected by the
+    platform (e.g. 2017-03-01T12:00:00.042Z). As consecutive values mostly
+    fall into the same second, the formatted date and time part of the last
+    second is cached and only the milliseconds are appended.
+    """
+
+    def __init__(self):
+        self.cachedSecond = (None, "") # replaced as a whole, so safe to be read from many threads
+
+    def format(self, timestampMs):
+        seconds, millis = divmod(int(timestampMs), 1000)
+        cachedSecond = self.cachedSecond
+        if cachedSecond[0] != seconds:
+            cachedSecond = (seconds, time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds)))
+            self.cachedSecond = cachedSecond
+        return "%s.%03dZ" % (cachedSecond[1], millis)
+
+timestampFormatter = TimestampFormatter()
+
+def timestampMsFromUtcTime(utcTime = None):
+    """Converts a naive UTC datetime (or None for now) to epoch milliseconds."""
+    if utcTime is None:
+        return int(time.time() * 1000)
+    return calendar.timegm(utcTime.utctimetuple()) * 1000 + utcTime.microsecond // 1000
+
+class ValueRecord(object):
+    """
+    A single reading of a sensor. Uses __slots__ to keep per-value memory
+    small - the json representation is only built when a request is made up.
+    """
+    __slots__ = ("sensorId", "value", "timestampMs")
+
+    def __init__(self, sensorId, value, timestampMs):
+        self.sensorId = sensorId
+        self.value = value
+        self.timestampMs = timestampMs
+
+    def toJson(self, withSensorId = True):
+        # note: we always assume a number value here - string values are not supported by API yet but might be added somewhen later
+        jsonData = {"numberValue":self.value, "timestamp":timestampFormatter.format(self.timestampMs)}
+        if withSensorId:
+            jsonData["sensorId"] = self.sensorId
+        return jsonData
+
+class ValueArray:
+    """
+    The values of a single sensor collected for bulk sending, stored in two
+    flat arrays of doubles instead of one dict per value.
+    """
+
+    def __init__(self, sensorId):
+        self.sensorId = sensorId
+        self.values = array("d")
+        self.timestamps = array("d") # epoch milliseconds are exact in a double
+
+    def append(self, value, timestampMs):
+        self.values.append(value)
+        self.timestamps.append(timestampMs)
+
+    def __len__(self):
+        return len(self.values)
+
+    def toJson(self):
+        return [{"numberValue":value, "timestamp":timestampFormatter.format(timestampMs)} for value, timestampMs in zip(self.values, self.timestamps)]
+
+def numericValue(value):
+    """Returns value as float, or None if it is not a (finite) number."""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(value) or math.isinf(value):
+        return None
+    return value
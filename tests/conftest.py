@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures: a stub OpenSense API running in-process and throw-away root
+dirs with a config pointing to it.
+"""
+import os
+import sys
+import json
+import time
+import pytest
+
+repoRootDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(repoRootDir, "tools", "benchmark"))
+
+from stub_api_server import StubApiServer
+
+@pytest.fixture
+def stubApi():
+    stub = StubApiServer(recordValues = True).start()
+    yield stub
+    stub.stop()
+
+@pytest.fixture
+def makeRootDir(tmp_path, stubApi):
+    """Returns a function creating a root dir with the given OpenSenseNet config settings on top of the defaults for the stub."""
+    def makeRootDir(**configData):
+        rootDir = str(tmp_path / "root")
+        if not os.path.isdir(rootDir):
+            os.makedirs(os.path.join(rootDir, "config"))
+            os.makedirs(os.path.join(rootDir, "log"))
+        settings = {
+            "username": "test",
+            "password": "test",
+            "osn_api_endpoint": "127.0.0.1:%s" % stubApi.port,
+            "encrypt_traffic": False,
+            "max_sending_threads": 4,
+            "min_login_interval_sec": 0,
+        }
+        settings.update(configData)
+        with open(os.path.join(rootDir, "config", "opensensenet.config.json"), "w") as configFile:
+            json.dump(settings, configFile)
+        return rootDir
+    return makeRootDir
+
+def waitUntil(condition, timeoutSec = 10):
+    """Polls condition until it returns True or timeoutSec passed. Returns the last result."""
+    deadline = time.time() + timeoutSec
+    while not condition() and time.time() < deadline:
+        time.sleep(0.02)
+    return condition()
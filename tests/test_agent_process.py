@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that agent worker processes are stopped by the runner only, so that
+the values they batched are handed over before they exit.
+"""
+import os
+import json
+import time
+import signal
+import pytest
+from python.core.abstract_agent import AbstractAgent
+from python.core.agent_process import AgentProcessSupervisor
+from python.core.opensense import OpenSenseNetInstance
+from tests.conftest import waitUntil
+
+class ValueSendingAgent(AbstractAgent):
+    """Sends a few values once started and leaves a marker file in the config dir afterwards."""
+
+    def run(self):
+        self.isRunning = True
+        for i in range(5):
+            self.sendValue("sensor", i)
+        open(os.path.join(self.configDir, "values.sent"), "w").close()
+
+@pytest.mark.skipif(not hasattr(signal, "SIGKILL"), reason = "needs POSIX signals")
+def test_sigterm_leaves_stopping_a_worker_to_the_runner(makeRootDir, stubApi):
+    rootDir = makeRootDir()
+    configDir = os.path.join(rootDir, "config")
+    with open(os.path.join(configDir, "valuesendingagent.config.json"), "w") as configFile:
+        json.dump({"sensor_mappings": [{"local_id":"sensor", "remote_id":"7"}]}, configFile)
+    osn = OpenSenseNetInstance(rootDir)
+    # values stay in the worker's batch until it is stopped
+    supervisor = AgentProcessSupervisor(osn, configDir, [[("tests.test_agent_process", "ValueSendingAgent")]], lingerMsec = 60000)
+    supervisor.start()
+    try:
+        assert waitUntil(lambda: os.path.exists(os.path.join(configDir, "values.sent")), 30)
+        worker = supervisor.workers[0]
+        os.kill(worker.process.pid, signal.SIGTERM)
+        time.sleep(0.5)
+        assert worker.alive()
+        assert stubApi.receivedValues == []
+        supervisor.stop(10)
+        assert worker.finished
+        assert waitUntil(lambda: sorted(stubApi.receivedValues) == [0.0, 1.0, 2.0, 3.0, 4.0])
+    finally:
+        osn.stop()
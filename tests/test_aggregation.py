@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that tumbling windows emit each window's aggregate exactly once and on
+time, and how late readings and readings after flush() are handled.
+"""
+import time
+import datetime
+from python.core.aggregation import WindowAggregator
+from tests.conftest import waitUntil
+
+minuteMs = 60000
+
+def makeAggregator(function = "mean", windowMsec = minuteMs):
+    emitted = []
+    aggregator = WindowAggregator(lambda localSensorId, value, utcTime: emitted.append((localSensorId, value, utcTime)))
+    aggregator.configure("sensor", function, windowMsec)
+    return aggregator, emitted
+
+def utcTime(timestampMs):
+    return datetime.datetime.utcfromtimestamp(timestampMs / 1000.0)
+
+def futureWindowStart():
+    # windows in the future aren't closed by the background thread during the test
+    return (int(time.time() * 1000) // minuteMs + 10) * minuteMs
+
+def test_window_is_emitted_once_next_window_starts():
+    aggregator, emitted = makeAggregator()
+    start = futureWindowStart()
+    aggregator.add("sensor", 1, start)
+    aggregator.add("sensor", 2, start + 10)
+    aggregator.add("sensor", 6, start + 20)
+    assert emitted == []
+    aggregator.add("sensor", 10, start + minuteMs)
+    assert emitted == [("sensor", 3.0, utcTime(start + minuteMs))]
+    aggregator.flush()
+    assert len(emitted) == 2
+    assert emitted[1][1] == 10
+
+def test_functions():
+    for function, expected in [("min", 1), ("max", 6), ("last", 2), ("count", 3)]:
+        aggregator, emitted = makeAggregator(function)
+        start = futureWindowStart()
+        for offset, value in enumerate([1, 6, 2]):
+            aggregator.add("sensor", value, start + offset)
+        aggregator.add("sensor", 0, start + minuteMs)
+        assert emitted[0][1] == expected
+        aggregator.flush()
+
+def test_reading_older_than_open_window_is_dropped():
+    aggregator, emitted = makeAggregator()
+    start = futureWindowStart()
+    aggregator.add("sensor", 1, start)
+    aggregator.add("sensor", 100, start - 10) # late - belongs to the window before
+    assert emitted == []
+    assert aggregator.numLateReadings == 1
+    aggregator.add("sensor", 3, start + 10)
+    aggregator.add("sensor", 0, start + minuteMs)
+    # the open window was neither closed early nor did the late reading distort it
+    assert emitted == [("sensor", 2.0, utcTime(start + minuteMs))]
+    aggregator.flush()
+
+def test_reading_for_emitted_window_is_dropped():
+    aggregator, emitted = makeAggregator()
+    start = futureWindowStart()
+    aggregator.add("sensor", 1, start)
+    aggregator.add("sensor", 2, start + minuteMs) # emits the first window
+    aggregator.add("sensor", 3, start + 2 * minuteMs) # emits the second one
+    aggregator.add("sensor", 4, start + 10) # no window open before the current one, but the first was emitted already
+    assert aggregator.numLateReadings == 1
+    assert [entry[1] for entry in emitted] == [1.0, 2.0]
+    aggregator.flush()
+    assert [entry[1] for entry in emitted] == [1.0, 2.0, 3.0]
+
+def test_window_is_closed_on_time_without_further_readings():
+    aggregator, emitted = makeAggregator(windowMsec = 100)
+    nowMs = int(time.time() * 1000)
+    aggregator.add("sensor", 1, nowMs)
+    aggregator.add("sensor", 3, nowMs)
+    assert waitUntil(lambda: len(emitted) == 1, 2)
+    assert emitted[0][1] == 2.0
+    assert emitted[0][2] == utcTime((nowMs // 100 + 1) * 100)
+    # a reading for the window just closed on time is late, too
+    aggregator.add("sensor", 5, nowMs)
+    assert aggregator.numLateReadings == 1
+    time.sleep(0.2)
+    assert len(emitted) == 1
+    aggregator.flush()
+
+def test_flush_emits_open_windows_and_later_readings_directly():
+    aggregator, emitted = makeAggregator()
+    start = futureWindowStart()
+    aggregator.add("sensor", 1, start)
+    aggregator.add("sensor", 3, start + 10)
+    aggregator.flush()
+    assert emitted == [("sensor", 2.0, utcTime(start + minuteMs))]
+    aggregator.add("sensor", 7, start + 20)
+    assert emitted[1] == ("sensor", 7, utcTime(start + 20))
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that the asyncio sender delivers values and finishes the requests in
+flight when shut down.
+"""
+import gc
+import time
+import logging
+import threading
+import pytest
+from python.core.opensense import OpenSenseNetInstance
+from tests.conftest import waitUntil
+
+pytest.importorskip("aiohttp")
+from python.core.async_sender import AsyncSender
+
+def asyncSenders():
+    return [thread for thread in threading.enumerate() if isinstance(thread, AsyncSender)]
+
+def test_values_arrive(makeRootDir, stubApi):
+    osn = OpenSenseNetInstance(makeRootDir(sender_mode = "asyncio"))
+    try:
+        for i in range(200):
+            osn.sendValue(1, i)
+        assert waitUntil(lambda: stubApi.numValues == 200)
+    finally:
+        osn.stop()
+
+def stopAndCollectAsyncioWarnings(osn, caplog):
+    senders = asyncSenders()
+    assert senders
+    with caplog.at_level(logging.WARNING, logger = "asyncio"):
+        osn.stop()
+        for sender in senders:
+            sender.join(5)
+            assert not sender.is_alive()
+        gc.collect()
+    return [record.getMessage() for record in caplog.records if record.name == "asyncio"]
+
+def test_requests_in_flight_finish_on_shutdown(makeRootDir, stubApi, caplog):
+    stubApi.latency = 0.3
+    osn = OpenSenseNetInstance(makeRootDir(sender_mode = "asyncio", async_max_connections = 10, shutdown_timeout_msec = 100))
+    assert osn.tokenManager.waitForToken(5)
+    for i in range(10):
+        osn.sendValue(1, i)
+    assert waitUntil(lambda: osn.threadedSendingQueue.qsize() == 0) # all requests are in flight now
+    assert stopAndCollectAsyncioWarnings(osn, caplog) == []
+    # the requests in flight at the deadline were still answered
+    assert stubApi.numValues == 10
+
+def test_requests_still_in_flight_are_cancelled(makeRootDir, stubApi, caplog):
+    stubApi.latency = 4
+    rootDir = makeRootDir(sender_mode = "asyncio", async_max_connections = 10, shutdown_timeout_msec = 100)
+    osn = OpenSenseNetInstance(rootDir)
+    assert osn.tokenManager.waitForToken(5)
+    for i in range(10):
+        osn.sendValue(1, i)
+    assert waitUntil(lambda: osn.threadedSendingQueue.qsize() == 0)
+    start = time.time()
+    assert stopAndCollectAsyncioWarnings(osn, caplog) == []
+    assert time.time() - start < 3.5
+    assert stubApi.numValues == 0
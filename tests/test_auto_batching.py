@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Checks auto batching of values passed to sendValue, and that a caller
+blocked by backpressure does not hold up other callers.
+"""
+import time
+from threading import Thread
+from python.core.opensense import OpenSenseNetInstance
+from tests.conftest import waitUntil
+
+def test_values_are_sent_in_batches(makeRootDir, stubApi):
+    osn = OpenSenseNetInstance(makeRootDir(auto_batching = True, auto_batch_size = 10, auto_batch_linger_msec = 50))
+    try:
+        for i in range(25):
+            osn.sendValue(i % 3, i)
+        # two full batches right away, the rest once it lingered long enough
+        assert waitUntil(lambda: stubApi.numValues == 25)
+        assert stubApi.numRequests == 3
+        assert sorted(stubApi.receivedValues) == [float(i) for i in range(25)]
+    finally:
+        osn.stop()
+
+def test_blocked_flush_does_not_hold_up_other_callers(makeRootDir, stubApi):
+    stubApi.latency = 0.5
+    osn = OpenSenseNetInstance(makeRootDir(auto_batching = True, auto_batch_size = 2, auto_batch_linger_msec = 60000, \
+        max_sending_threads = 1, max_queue_length = 2, backpressure_policy = "block", shutdown_timeout_msec = 100))
+    assert osn.tokenManager.waitForToken(5)
+    blockedSince = []
+
+    def producer():
+        for i in range(20):
+            blockedSince[:] = [time.time()]
+            osn.sendValue(1, i)
+        blockedSince[:] = []
+
+    producerThread = Thread(target = producer)
+    producerThread.daemon = True
+    producerThread.start()
+    try:
+        # wait till the producer's flush got stuck on the full queue
+        assert waitUntil(lambda: blockedSince and time.time() - blockedSince[0] > 0.3, 5)
+        start = time.time()
+        osn.sendValue(2, 0) # only added to the batch
+        assert time.time() - start < 0.1
+    finally:
+        osn.stop()
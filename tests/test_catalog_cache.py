@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that the catalog cache survives a restart and expires entries.
+"""
+import os
+import time
+from python.core.catalog_cache import CatalogCache
+from python.core.config_store import configStore
+
+def test_entries_survive_restart(tmp_path):
+    cacheFile = str(tmp_path / "cache" / "catalog.cache.json")
+    cache = CatalogCache(cacheFile)
+    cache.store("measurand", "temperature", 1)
+    cache.store("measurand", "unknown", None)
+    cache.storeCatalog("license", {"ODC-PDDL":1})
+    configStore.flush()
+    assert os.listdir(str(tmp_path / "cache")) == ["catalog.cache.json"]
+    restarted = CatalogCache(cacheFile)
+    assert restarted.lookup("measurand", "temperature") == (True, 1)
+    assert restarted.lookup("measurand", "unknown") == (True, None)
+    assert restarted.lookup("measurand", "humidity") == (False, None)
+    # the license catalog is complete, so names not in it are known to be unsupported
+    assert restarted.lookup("license", "CC-BY") == (True, None)
+
+def test_entries_expire(tmp_path):
+    cache = CatalogCache(str(tmp_path / "catalog.cache.json"), ttlSec = 0.05, negativeTtlSec = 0.05)
+    cache.store("unit", "1|celsius", 1)
+    assert cache.lookup("unit", "1|celsius") == (True, 1)
+    time.sleep(0.06)
+    assert cache.lookup("unit", "1|celsius") == (False, None)
+    configStore.flush()
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the circuit breaker states, especially that the single half-open probe
+can't get lost, both on its own and in the sender threads.
+"""
+import time
+from python.core.retry import CircuitBreaker
+from python.core.opensense import OpenSenseNetInstance, postMessageObject
+from tests.conftest import waitUntil
+
+def openBreaker(probeTimeoutSec = 60):
+    breaker = CircuitBreaker(failureThreshold = 2, resetTimeoutSec = 0.05, probeTimeoutSec = probeTimeoutSec)
+    breaker.recordFailure()
+    breaker.recordFailure()
+    return breaker
+
+def test_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failureThreshold = 2, resetTimeoutSec = 60)
+    breaker.recordFailure()
+    assert breaker.allowRequest()
+    breaker.recordFailure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allowRequest()
+
+def test_success_resets_failure_count():
+    breaker = CircuitBreaker(failureThreshold = 2, resetTimeoutSec = 60)
+    breaker.recordFailure()
+    breaker.recordSuccess()
+    breaker.recordFailure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+def test_half_open_lets_exactly_one_probe_through():
+    breaker = openBreaker()
+    time.sleep(0.06)
+    assert breaker.allowRequest()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allowRequest()
+
+def test_successful_probe_closes():
+    breaker = openBreaker()
+    time.sleep(0.06)
+    assert breaker.allowRequest()
+    breaker.recordSuccess()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allowRequest()
+    assert breaker.allowRequest()
+
+def test_failed_probe_reopens():
+    breaker = openBreaker()
+    time.sleep(0.06)
+    assert breaker.allowRequest()
+    breaker.recordFailure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allowRequest()
+    time.sleep(0.06)
+    assert breaker.allowRequest()
+
+def test_released_probe_can_be_taken_again():
+    breaker = openBreaker()
+    time.sleep(0.06)
+    assert breaker.allowRequest()
+    breaker.releaseProbe()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allowRequest()
+    assert not breaker.allowRequest()
+
+def test_lost_probe_is_given_up_after_timeout():
+    breaker = openBreaker(probeTimeoutSec = 0.1)
+    time.sleep(0.06)
+    assert breaker.allowRequest()
+    assert not breaker.allowRequest()
+    time.sleep(0.11)
+    assert breaker.allowRequest()
+    assert not breaker.allowRequest()
+
+def test_wait_for_change_ends_when_lost_probe_times_out():
+    breaker = openBreaker(probeTimeoutSec = 0.1)
+    time.sleep(0.06)
+    assert breaker.allowRequest()
+    start = time.time()
+    breaker.waitForChange()
+    assert time.time() - start < 1
+
+def openSenderBreaker(makeRootDir, stubApi):
+    """Returns an instance with a single sender thread whose breaker was opened by a failed request."""
+    osn = OpenSenseNetInstance(makeRootDir(max_sending_threads = 1, circuit_failure_threshold = 1, circuit_reset_timeout_msec = 100, retry_base_delay_msec = 2000))
+    assert osn.tokenManager.waitForToken(5)
+    stubApi.failureRate = 1.0
+    osn.sendValue(1, -1)
+    assert waitUntil(lambda: osn.circuitBreaker.state == CircuitBreaker.OPEN)
+    stubApi.failureRate = 0.0
+    return osn
+
+def test_probe_answered_with_401_does_not_stall_senders(makeRootDir, stubApi):
+    osn = openSenderBreaker(makeRootDir, stubApi)
+    try:
+        stubApi.tokenGeneration += 1 # the probe is rejected with the current token
+        for i in range(20):
+            osn.sendValue(1, i)
+        assert waitUntil(lambda: stubApi.numValues >= 20)
+        assert stubApi.numUnauthorized >= 1
+        assert osn.circuitBreaker.state == CircuitBreaker.CLOSED
+    finally:
+        osn.stop()
+
+def test_probe_rejected_as_bad_request_does_not_stall_senders(makeRootDir, stubApi):
+    osn = openSenderBreaker(makeRootDir, stubApi)
+    try:
+        # the stub answers unknown paths with 404, which is the message's fault rather than the endpoint's.
+        # The value that opened the breaker still waits for its retry, so this message is the probe
+        osn.enqueueMessage(postMessageObject(osn.makeValueSendingURI("sensors/unknown"), {"sensorId":1, "value":0}))
+        for i in range(20):
+            osn.sendValue(1, i)
+        assert waitUntil(lambda: stubApi.numValues >= 20)
+        assert osn.circuitBreaker.state == CircuitBreaker.CLOSED
+    finally:
+        osn.stop()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that config files written concurrently by the write-behind store,
+flush() and writeNow() are never half-written.
+"""
+import os
+import json
+from threading import Thread
+from python.core.config_store import ConfigStore, writeJsonFile
+
+def test_concurrent_writes_never_leave_partial_files(tmp_path):
+    fileName = str(tmp_path / "agent.config.json")
+    writeJsonFile(fileName, {"sensor_mappings":[]})
+    errors = []
+    finished = []
+
+    def writer(number):
+        try:
+            for i in range(15):
+                writeJsonFile(fileName, {"writer":number, "sensor_mappings":[{"local_id":j, "remote_id":"%s" % j} for j in range(2000)]})
+        except BaseException as e:
+            errors.append(e)
+
+    def reader():
+        while not finished:
+            try:
+                with open(fileName) as fileHandle:
+                    json.load(fileHandle)
+            except BaseException as e:
+                errors.append(e)
+
+    readerThread = Thread(target = reader)
+    readerThread.start()
+    writers = [Thread(target = writer, args = (number,)) for number in range(4)]
+    for thread in writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    finished.append(True)
+    readerThread.join()
+    assert errors == []
+    assert os.listdir(str(tmp_path)) == ["agent.config.json"]
+
+def test_store_writes_latest_data(tmp_path):
+    store = ConfigStore(delaySec = 0.01)
+    fileName = str(tmp_path / "instance.config.json")
+    configData = {"value":0}
+    threads = []
+    for i in range(1, 21):
+        configData["value"] = i
+        store.write(fileName, configData)
+        thread = Thread(target = store.writeNow, args = (fileName, configData))
+        thread.start()
+        threads.append(thread)
+    store.flush()
+    for thread in threads:
+        thread.join()
+    with open(fileName) as fileHandle:
+        assert json.load(fileHandle) == {"value":20}
+    assert os.listdir(str(tmp_path)) == ["instance.config.json"]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that iterJsonArray yields the same elements as parsing the whole
+document, however the data is split into chunks.
+"""
+import json
+import pytest
+from python.core.json_stream import iterJsonArray
+
+document = json.dumps([
+    {"name":"Item1", "state":"21.5", "tags":["a", "b]", "{c"], "label":"say \"hi\"\\"},
+    12345,
+    -0.5e3,
+    "Temperatur °C – Küche",
+    [[], {}, [1, [2, [3]]]],
+    True, False, None,
+], ensure_ascii = False)
+
+def oneByteChunks(data):
+    return [data[i:i + 1] for i in range(len(data))]
+
+def test_one_byte_chunks():
+    assert list(iterJsonArray(oneByteChunks(document.encode("utf-8")))) == json.loads(document)
+
+def test_chunk_sizes():
+    data = document.encode("utf-8")
+    for size in (2, 3, 7, 64, len(data)):
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        assert list(iterJsonArray(chunks)) == json.loads(document)
+
+def test_number_split_across_chunks_is_not_yielded_early():
+    elements = iterJsonArray([b"[12", b"3", b"45, 6", b"]"])
+    assert next(elements) == 12345
+    assert list(elements) == [6]
+
+def test_empty_array():
+    assert list(iterJsonArray(oneByteChunks(b" [ ] "))) == []
+
+@pytest.mark.parametrize("data", [b"{}", b"[1, 2", b"[1,, 2]", b"[1, 2,]", b"[,1]", b"[1 2]", b"[1}]", b'["open]'])
+def test_malformed_arrays_are_rejected(data):
+    with pytest.raises(ValueError):
+        list(iterJsonArray(oneByteChunks(data)))
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that the OpenHAB agent's "events" update mode delivers item state
+changes from the event stream, reconnects to a dropped stream and syncs
+the states it might have missed meanwhile.
+"""
+import time
+import json
+from tests.conftest import waitUntil
+from tests.test_openhab_polling import makeAgent, stubOpenHAB
+
+def test_polling_is_the_default_update_mode(tmp_path, stubOpenHAB):
+    agent, osn = makeAgent(tmp_path, stubOpenHAB, update_mode = None)
+    assert agent.connections[0].settings["update_mode"] == "polling"
+
+def test_state_changes_arrive_via_event_stream(tmp_path, stubOpenHAB):
+    agent, osn = makeAgent(tmp_path, stubOpenHAB, update_mode = "events")
+    agent.run()
+    try:
+        # all items are synced once the stream is up
+        assert waitUntil(lambda: len(osn.values) == 40)
+        stubOpenHAB.setState("Item3", "42.5")
+        assert waitUntil(lambda: osn.valuesOf("103")[-1:] == ["42.5"])
+        assert stubOpenHAB.numEventStreams == 1
+    finally:
+        agent.stop()
+
+def test_missed_changes_are_synced_after_reconnect(tmp_path, stubOpenHAB):
+    agent, osn = makeAgent(tmp_path, stubOpenHAB, update_mode = "events")
+    agent.run()
+    try:
+        assert waitUntil(lambda: len(osn.values) == 40)
+        # a change whose event never arrives, e.g. while the stream was down
+        stubOpenHAB.setState("Item7", "-3.5", publish = False)
+        stubOpenHAB.dropEventStreams()
+        assert waitUntil(lambda: osn.valuesOf("107")[-1:] == ["-3.5"])
+        assert stubOpenHAB.numEventStreams == 2
+        # the new stream delivers changes again
+        stubOpenHAB.setState("Item8", "12.5")
+        assert waitUntil(lambda: osn.valuesOf("108")[-1:] == ["12.5"])
+    finally:
+        agent.stop()
+
+def makeEvent(topic, value):
+    return json.dumps({"topic":topic, "payload":json.dumps({"type":"Decimal", "value":value}), "type":"ItemStateChangedEvent"})
+
+def test_only_state_changes_of_active_items_are_sent(tmp_path, stubOpenHAB):
+    agent, osn = makeAgent(tmp_path, stubOpenHAB, update_mode = "events")
+    connection = agent.connections[0]
+    connection.handleEvent(makeEvent("smarthome/items/Item1/statechanged", "1.5"))
+    connection.handleEvent(makeEvent("openhab/items/Item2/statechanged", "2.5"))
+    # other kinds of events, unknown items and garbage are ignored
+    connection.handleEvent(makeEvent("openhab/items/Item1/state", "3.5"))
+    connection.handleEvent(makeEvent("openhab/things/Thing1/statuschanged", "ONLINE"))
+    connection.handleEvent(makeEvent("openhab/items/Unknown/statechanged", "4.5"))
+    connection.handleEvent("{not json")
+    connection.handleEvent(json.dumps({"topic":"openhab/items/Item4/statechanged", "payload":"{}"}))
+    assert osn.values == [("101", "1.5"), ("102", "2.5")]
+
+def test_stop_ends_a_pending_read_of_the_event_stream(tmp_path, stubOpenHAB):
+    agent, osn = makeAgent(tmp_path, stubOpenHAB, update_mode = "events")
+    connection = agent.connections[0]
+    agent.run()
+    assert waitUntil(lambda: len(osn.values) == 40 and connection.eventStream is not None)
+    start = time.time()
+    agent.stop()
+    assert time.time() - start < 1
+    connection.join(5)
+    assert not connection.is_alive()
+    assert connection.eventStream is None
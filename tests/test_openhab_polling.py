@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that batched polling of the OpenHAB agent delivers the initial state
+and every change of each item, whichever batch it is fetched in.
+"""
+import json
+import itertools
+import pytest
+from threading import Event
+from python.agents.openhab_agent.OpenHABAgent import OpenHABAgent
+from stub_openhab_server import StubOpenHABServer
+from tests.conftest import waitUntil
+
+class RecordingInstance:
+    """Stands in for the OpenSenseNetInstance, records the values sent and creates sensors once creationAllowed is set."""
+
+    def __init__(self):
+        self.configData = {"provisioning_max_parallel":1, "default_sensor_license":"ODC-PDDL"}
+        self.values = []
+        self.creationAllowed = Event()
+        self.creationAllowed.set()
+        self.remoteIds = itertools.count(500)
+
+    def sendValue(self, remoteSensorId, value, utcTime = None):
+        self.values.append((remoteSensorId, value))
+
+    def resolveSensorParams(self, measurandString, unitString, licenseString):
+        return {"measurandId":1, "unitId":1, "licenseId":1}
+
+    def addRemoteSensor(self, params, additional_params = None):
+        self.creationAllowed.wait(10)
+        return next(self.remoteIds)
+
+    def valuesOf(self, remoteSensorId):
+        return [value for sensorId, value in self.values if sensorId == remoteSensorId]
+
+@pytest.fixture
+def stubOpenHAB():
+    stub = StubOpenHABServer(numItems = 40, changesPerSec = 0).start()
+    yield stub
+    stub.stop()
+
+def makeAgent(tmp_path, stubOpenHAB, creationAllowed = None, **configData):
+    settings = {
+        "openhab_instance": "http://127.0.0.1:%s" % stubOpenHAB.port,
+        "update_mode": "polling",
+        "max_single_item_requests": 0,
+        "sensor_mappings": [{"local_id":"Item%s" % i, "remote_id":"%s" % (100 + i)} for i in range(40)],
+    }
+    settings.update(configData)
+    settings = dict((key, value) for key, value in settings.items() if value is not None)
+    with open(str(tmp_path / "openhabagent.config.json"), "w") as configFile:
+        json.dump(settings, configFile)
+    osn = RecordingInstance()
+    if creationAllowed is not None:
+        osn.creationAllowed = creationAllowed
+    agent = OpenHABAgent(str(tmp_path), osn)
+    agent.connections[0].schedulePolls()
+    return agent, osn
+
+def test_every_batch_gets_initial_states(tmp_path, stubOpenHAB):
+    agent, osn = makeAgent(tmp_path, stubOpenHAB)
+    connection = agent.connections[0]
+    batchA = ["Item%s" % i for i in range(20)]
+    batchB = ["Item%s" % i for i in range(20, 40)]
+    connection.pollItems(batchA)
+    connection.pollItems(batchB)
+    for i in range(40):
+        assert osn.valuesOf("%s" % (100 + i)) == [stubOpenHAB.states["Item%s" % i]]
+
+def test_change_is_delivered_by_the_batch_of_its_item(tmp_path, stubOpenHAB):
+    agent, osn = makeAgent(tmp_path, stubOpenHAB)
+    connection = agent.connections[0]
+    batchA = ["Item%s" % i for i in range(20)]
+    batchB = ["Item%s" % i for i in range(20, 40)]
+    connection.pollItems(batchA)
+    connection.pollItems(batchB)
+    stubOpenHAB.setState("Item20", "99.5")
+    # batch A sees the new item list first, which must not make batch B skip it
+    connection.pollItems(batchA)
+    connection.pollItems(batchB)
+    assert osn.valuesOf("120")[-1] == "99.5"
+    # nothing changed since - nothing is sent
+    del osn.values[:]
+    connection.pollItems(batchA)
+    connection.pollItems(batchB)
+    assert osn.values == []
+
+def test_sensors_created_in_background_are_polled(tmp_path, stubOpenHAB):
+    mappings = [{"local_id":"Item%s" % i, "remote_id":"%s" % (100 + i)} for i in range(10)]
+    mappings += [{"local_id":"Item%s" % i, "remote_id":"create", "measurand":"temperature", "unit":"celsius"} for i in range(10, 15)]
+    creationAllowed = Event()
+    # long poll interval - the created sensors must be polled right away rather than on some full refresh
+    agent, osn = makeAgent(tmp_path, stubOpenHAB, creationAllowed, sensor_mappings = mappings, update_interval_msec = 60000)
+    agent.run()
+    try:
+        assert waitUntil(lambda: len(set(sensorId for sensorId, value in osn.values)) == 10)
+        creationAllowed.set()
+        assert waitUntil(lambda: len(set(sensorId for sensorId, value in osn.values)) == 15)
+        for i in range(10, 15):
+            assert osn.valuesOf(agent.sensorRegistry.remoteId("Item%s" % i)) == [stubOpenHAB.states["Item%s" % i]]
+    finally:
+        agent.stop()
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that a shutdown running out of time keeps exactly the messages not
+sent yet, and that the next start sends them.
+"""
+import time
+from python.core.opensense import OpenSenseNetInstance
+from tests.conftest import waitUntil
+
+def test_next_start_sends_what_shutdown_left(makeRootDir, stubApi):
+    # a single slow sender can't send all values within the shutdown budget
+    rootDir = makeRootDir(max_sending_threads = 1, shutdown_timeout_msec = 300)
+    stubApi.latency = 0.03
+    osn = OpenSenseNetInstance(rootDir)
+    assert osn.tokenManager.waitForToken(5)
+    for i in range(100):
+        osn.sendValue(1, i)
+    osn.stop()
+    time.sleep(0.1) # the request in flight at the deadline arrives meanwhile, but is not acknowledged in the spool
+    sentBefore = list(stubApi.receivedValues)
+    assert 0 < len(sentBefore) < 100
+
+    stubApi.latency = 0
+    osn = OpenSenseNetInstance(rootDir)
+    try:
+        # only the request in flight at the deadline may be sent twice
+        assert 100 - len(sentBefore) <= osn.threadedSendingQueue.qsize() <= 100 - len(sentBefore) + 1
+        assert waitUntil(lambda: len(set(stubApi.receivedValues)) == 100)
+        sentAfter = stubApi.receivedValues[len(sentBefore):]
+        assert sorted(set(sentBefore + sentAfter)) == [float(i) for i in range(100)]
+        assert len(sentBefore) + len(sentAfter) - 100 <= 1
+        assert osn.threadedSendingQueue.qsize() == 0
+    finally:
+        osn.stop()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that the spool replays exactly the messages not acknowledged before a
+crash or a graceful close.
+"""
+from python.core.spool import SpooledSendingQueue
+from python.core.opensense import postMessageObject
+
+def openSpool(spoolDir, **kwargs):
+    # no periodic syncs during the test - checkpoints are written by acks and close() only
+    kwargs.setdefault("fsyncIntervalMsec", 3600000)
+    return SpooledSendingQueue(str(spoolDir), postMessageObject, **kwargs)
+
+def putMessages(spool, count, start = 0):
+    for i in range(start, start + count):
+        spool.put(postMessageObject("/values", {"sensorId":i, "value":i}))
+
+def drain(spool):
+    sensorIds = []
+    while not spool.empty():
+        messageObject = spool.get(timeout = 1)
+        sensorIds.append(messageObject.getJsonData()["sensorId"])
+        spool.task_done(messageObject)
+    return sensorIds
+
+def test_replays_everything_after_crash_without_acks(tmp_path):
+    spool = openSpool(tmp_path, fsyncBatch = 1)
+    putMessages(spool, 3)
+    # crash: the spool is not closed
+    replayed = openSpool(tmp_path)
+    assert replayed.qsize() == 3
+    assert drain(replayed) == [0, 1, 2]
+    replayed.close()
+
+def test_buffered_messages_survive_crash_after_ack(tmp_path):
+    spool = openSpool(tmp_path, fsyncBatch = 1)
+    putMessages(spool, 3)
+    messageObject = spool.get()
+    spool.task_done(messageObject)
+    # the other two messages sit in the memory buffer when the process dies
+    replayed = openSpool(tmp_path)
+    assert replayed.qsize() == 2
+    assert drain(replayed) == [1, 2]
+    replayed.close()
+
+def test_buffered_messages_survive_close_after_ack(tmp_path):
+    spool = openSpool(tmp_path)
+    putMessages(spool, 5)
+    spool.task_done(spool.get())
+    spool.close()
+    replayed = openSpool(tmp_path)
+    assert replayed.qsize() == 4
+    assert drain(replayed) == [1, 2, 3, 4]
+    replayed.close()
+
+def test_unacknowledged_message_in_flight_is_replayed(tmp_path):
+    spool = openSpool(tmp_path)
+    putMessages(spool, 4)
+    first = spool.get()
+    second = spool.get()
+    spool.task_done(second) # acknowledged out of order - first still in flight
+    spool.close()
+    replayed = openSpool(tmp_path)
+    # at least once: the acked second message is re-sent as it lies behind the unacked first
+    assert drain(replayed) == [0, 1, 2, 3]
+    replayed.close()
+
+def test_messages_read_back_from_disk_survive_close(tmp_path):
+    # a small memory buffer forces most messages to be streamed from disk
+    spool = openSpool(tmp_path, memoryMessages = 2)
+    putMessages(spool, 6)
+    spool.task_done(spool.get())
+    spool.task_done(spool.get())
+    spool.close()
+    replayed = openSpool(tmp_path, memoryMessages = 2)
+    assert replayed.qsize() == 4
+    assert drain(replayed) == [2, 3, 4, 5]
+    replayed.close()
+
+def test_replay_across_segments(tmp_path):
+    spool = openSpool(tmp_path, segmentBytes = 100, memoryMessages = 3)
+    putMessages(spool, 10)
+    handled = [spool.get() for i in range(4)]
+    for messageObject in handled:
+        spool.task_done(messageObject)
+    spool.close()
+    replayed = openSpool(tmp_path, segmentBytes = 100, memoryMessages = 3)
+    assert drain(replayed) == [4, 5, 6, 7, 8, 9]
+    replayed.close()
+    # fully acknowledged spool starts empty
+    empty = openSpool(tmp_path)
+    assert empty.qsize() == 0
+    empty.close()
+
+def test_unreadable_record_is_skipped_without_losing_others(tmp_path):
+    spool = openSpool(tmp_path)
+    putMessages(spool, 4)
+    spool.close()
+    segmentPath = tmp_path / [path.name for path in tmp_path.iterdir() if path.suffix == ".seg"][0]
+    lines = segmentPath.read_bytes().splitlines(True)
+    lines[1] = b"garbage\n"
+    segmentPath.write_bytes(b"".join(lines))
+
+    spool = openSpool(tmp_path, fsyncBatch = 1)
+    spool.task_done(spool.get())
+    # crash while messages 2 and 3 are still in the memory buffer
+    replayed = openSpool(tmp_path)
+    assert drain(replayed) == [2, 3]
+    replayed.close()
+
+def test_get_returns_none_once_closed(tmp_path):
+    spool = openSpool(tmp_path)
+    spool.close()
+    assert spool.get() is None
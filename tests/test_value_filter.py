@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the deadband and interval settings of ValueFilter.
+"""
+from python.core.value_filter import ValueFilter
+
+def test_unchanged_value_is_sent_after_max_suppression():
+    valueFilter = ValueFilter.fromMapping({"deadband_absolute": 0, "max_suppression_msec": 1000})
+    assert valueFilter.accept(20.0, now = 0)
+    assert not valueFilter.accept(20.0, now = 0.5)
+    assert valueFilter.accept(20.0, now = 1.0)
+    assert not valueFilter.accept(20.0, now = 1.5)
+
+def test_max_interval_msec_is_still_understood():
+    valueFilter = ValueFilter.fromMapping({"deadband_absolute": 0}, {"max_interval_msec": 1000})
+    assert valueFilter.maxSuppression == 1.0
+    valueFilter = ValueFilter.fromMapping({"max_interval_msec": 500}, {"max_suppression_msec": 1000})
+    assert valueFilter.maxSuppression == 0.5
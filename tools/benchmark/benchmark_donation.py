@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+This file is part of **opensense** project https://github.com/opensense-network/.
+    :platform: Unix, Windows, MacOS X
+    :sinopsis: opensense
+
+.. moduleauthor:: Frank Pallas <frank.pallas@tu-berlin.de>
+
+License : GPL(v3)
+
+**opensense** is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+**opensense** is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with opensense. If not, see http://www.gnu.org/licenses.
+
+"""
+import os, sys, time, json, random, socket, shutil, tempfile, logging, argparse, subprocess, resource
+
+# eliminate urllib2 incopatibility between Python v2 and v3
+try:
+    # For Python 3.0 and later
+    from urllib import request
+except ImportError:
+    # Fall back to Python 2's urllib2
+    import urllib2 as request
+
+benchmarkDir = os.path.dirname(os.path.abspath(__file__))
+repoRootDir = os.path.dirname(os.path.dirname(benchmarkDir))
+sys.path.insert(0, repoRootDir)
+
+from python.core.opensense import OpenSenseNetInstance
+
+def freePort():
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+def startStub(port, latencyMsec, failureRate, expireTokenEvery = 0):
+    """Starts the stub API in a process of its own so that it doesn't distort CPU and memory figures."""
+    stub = subprocess.Popen([sys.executable, os.path.join(benchmarkDir, "stub_api_server.py"), \
+        "--port", str(port), "--latency-msec", str(latencyMsec), "--failure-rate", str(failureRate), \
+        "--expire-token-every", str(expireTokenEvery)], stdout = subprocess.PIPE)
+    stub.stdout.readline() # wait till listening
+    return stub
+
+def stubStats(port):
+    return json.loads(request.urlopen("http://127.0.0.1:%s/stats" % port).read().decode("utf-8"))
+
+def currentRssKb():
+    try:
+        with open("/proc/self/status") as statusFile:
+            for line in statusFile:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+def makeRootDir(args, port):
+    """Creates a throw-away root dir with an OpenSenseNet config pointing to the stub."""
+    rootDir = tempfile.mkdtemp(prefix = "osn-benchmark-")
+    os.makedirs(os.path.join(rootDir, "config"))
+    os.makedirs(os.path.join(rootDir, "log"))
+    configData = {
+        "username": "benchmark",
+        "password": "benchmark",
+        "osn_api_endpoint": "127.0.0.1:%s" % port,
+        "encrypt_traffic": False,
+        "max_sending_threads": args.threads,
+        "max_queue_length": args.max_queue_length,
+        "max_bulk_sending_array_length": args.batch_size,
+        "max_bulk_sending_arrays": args.sensors,
+        "sender_mode": args.sender_mode,
+        "auto_batching": args.auto_batching,
+        "auto_batch_size": args.batch_size,
+        "auto_batch_linger_msec": args.linger_msec,
+        "min_login_interval_sec": args.min_login_interval_sec,
+    }
+    with open(os.path.join(rootDir, "config", "opensensenet.config.json"), "w") as configFile:
+        json.dump(configData, configFile, indent = 4)
+    return rootDir
+
+def runBenchmark(args):
+    port = freePort()
+    stub = startStub(port, args.latency_msec, args.failure_rate, args.expire_token_every)
+    rootDir = makeRootDir(args, port)
+    # configure logging before the instance does, so that debug logging doesn't dominate the measurement
+    logging.basicConfig(filename = os.path.join(rootDir, "log", "opensense.log"), level = getattr(logging, args.log_level))
+    try:
+        startupStart = time.time()
+        osnInstance = OpenSenseNetInstance(rootDir)
+        startupTime = time.time() - startupStart
+        putValue = {"sendValue":osnInstance.sendValue, "bulk":osnInstance.putValueToBulkSending, "collapsed":osnInstance.putValueToCollapsedSending}[args.api]
+
+        cpuStart = time.process_time() if hasattr(time, "process_time") else time.clock()
+        start = time.time()
+        numOffered = 0
+        while time.time() - start < args.duration:
+            putValue(numOffered % args.sensors, random.uniform(0, 30))
+            numOffered += 1
+            if args.rate > 0:
+                ahead = start + numOffered / float(args.rate) - time.time()
+                if ahead > 0:
+                    time.sleep(ahead)
+        offerTime = time.time() - start
+        osnInstance.flushAllBulkSendingArrays()
+
+        # wait till everything arrived at the stub (or the drain timeout passed)
+        numArrived = 0
+        drainDeadline = time.time() + args.drain_timeout
+        while time.time() < drainDeadline:
+            numArrived = stubStats(port)["values"]
+            if numArrived >= numOffered:
+                break
+            time.sleep(0.05)
+        totalTime = time.time() - start
+        cpuTime = (time.process_time() if hasattr(time, "process_time") else time.clock()) - cpuStart
+
+        latencies = osnInstance.endToEndLatency.percentiles([0.5, 0.9, 0.99, 0.999])
+        report = {
+            "api": args.api,
+            "sender_mode": args.sender_mode,
+            "threads": args.threads,
+            "sensors": args.sensors,
+            "batch_size": args.batch_size,
+            "latency_msec": args.latency_msec,
+            "startup_sec": round(startupTime, 3),
+            "offered_values": numOffered,
+            "offered_values_per_sec": round(numOffered / offerTime, 1),
+            "arrived_values": numArrived,
+            "throughput_values_per_sec": round(numArrived / totalTime, 1),
+            "requests": stubStats(port)["requests"],
+            "unauthorized_requests": stubStats(port)["unauthorized"],
+            "logins": stubStats(port)["logins"],
+            "latency_p50_msec": round(latencies[0.5] * 1000, 2),
+            "latency_p90_msec": round(latencies[0.9] * 1000, 2),
+            "latency_p99_msec": round(latencies[0.99] * 1000, 2),
+            "latency_p999_msec": round(latencies[0.999] * 1000, 2),
+            "cpu_sec": round(cpuTime, 2),
+            "cpu_utilization": round(cpuTime / totalTime, 2),
+            "rss_kb": currentRssKb(),
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+        osnInstance.stop()
+        return report
+    finally:
+        stub.terminate()
+        if not args.keep_root_dir:
+            shutil.rmtree(rootDir, ignore_errors = True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "End-to-end throughput benchmark of the donation pipeline against a local stub API")
+    parser.add_argument("--api", choices = ["sendValue", "bulk", "collapsed"], default = "sendValue", help = "OpenSenseNetInstance method values are passed to")
+    parser.add_argument("--duration", type = float, default = 10, help = "seconds values are offered")
+    parser.add_argument("--rate", type = float, default = 0, help = "offered values per second, 0 for as fast as possible")
+    parser.add_argument("--sensors", type = int, default = 10, help = "number of distinct remote sensor ids")
+    parser.add_argument("--threads", type = int, default = 20, help = "max_sending_threads")
+    parser.add_argument("--sender-mode", choices = ["threaded", "asyncio"], default = "threaded")
+    parser.add_argument("--batch-size", type = int, default = 100, help = "max_bulk_sending_array_length and auto_batch_size")
+    parser.add_argument("--auto-batching", action = "store_true")
+    parser.add_argument("--linger-msec", type = int, default = 500)
+    parser.add_argument("--max-queue-length", type = int, default = 150)
+    parser.add_argument("--latency-msec", type = float, default = 20, help = "response latency of the stub API")
+    parser.add_argument("--failure-rate", type = float, default = 0.0, help = "share of value requests the stub answers with 503")
+    parser.add_argument("--expire-token-every", type = int, default = 0, help = "let the stub's token expire after this many value requests")
+    parser.add_argument("--min-login-interval-sec", type = float, default = 1, help = "min_login_interval_sec")
+    parser.add_argument("--drain-timeout", type = float, default = 30, help = "max seconds to wait for queued values after offering stopped")
+    parser.add_argument("--log-level", default = "WARNING")
+    parser.add_argument("--keep-root-dir", action = "store_true", help = "don't delete the temporary root dir (config, spool, log)")
+    parser.add_argument("--json", action = "store_true", help = "print report as json")
+    args = parser.parse_args()
+
+    report = runBenchmark(args)
+    if args.json:
+        print(json.dumps(report, sort_keys = True))
+    else:
+        for key in sorted(report):
+            print("%-28s %s" % (key, report[key]))
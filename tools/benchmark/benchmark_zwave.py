@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+This file is part of **opensense** project https://github.com/opensense-network/.
+    :platform: Unix, Windows, MacOS X
+    :sinopsis: opensense
+
+.. moduleauthor:: Frank Pallas <frank.pallas@tu-berlin.de>
+
+License : GPL(v3)
+
+**opensense** is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+**opensense** is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with opensense. If not, see http://www.gnu.org/licenses.
+
+"""
+import os, sys, time, json, shutil, tempfile, logging, argparse, resource
+
+benchmarkDir = os.path.dirname(os.path.abspath(__file__))
+repoRootDir = os.path.dirname(os.path.dirname(benchmarkDir))
+sys.path.insert(0, repoRootDir)
+sys.path.insert(0, benchmarkDir)
+
+from benchmark_donation import freePort, startStub, stubStats, currentRssKb
+from python.core.opensense import OpenSenseNetInstance
+from python.core.config_store import configStore
+from python.agents.zwave_agent.ZWaveAgent import ZWaveAgent
+
+def makeRootDir(args, port):
+    """Creates a throw-away root dir with configs for OpenSenseNet (pointing to the stub) and a simulated Z-Wave network."""
+    rootDir = tempfile.mkdtemp(prefix = "osn-zwave-benchmark-")
+    os.makedirs(os.path.join(rootDir, "config"))
+    os.makedirs(os.path.join(rootDir, "log"))
+    osnConfig = {
+        "username": "benchmark",
+        "password": "benchmark",
+        "osn_api_endpoint": "127.0.0.1:%s" % port,
+        "encrypt_traffic": False,
+        "max_sending_threads": args.threads,
+        "auto_batching": args.auto_batching,
+    }
+    with open(os.path.join(rootDir, "config", "opensensenet.config.json"), "w") as configFile:
+        json.dump(osnConfig, configFile, indent = 4)
+    agentConfig = {
+        "zwave_backend": "simulated",
+        "simulated_nodes": args.nodes,
+        "simulated_values_per_node": args.values_per_node,
+        "simulated_config_values_per_node": args.config_values_per_node,
+        "simulated_products": args.products,
+        "simulated_updates_per_sec": args.updates_per_sec,
+        "value_buffer_size": args.buffer_size,
+        "sensor_mappings": [],
+    }
+    with open(agentConfigFile(rootDir), "w") as configFile:
+        json.dump(agentConfig, configFile, indent = 4)
+    return rootDir
+
+def agentConfigFile(rootDir):
+    return os.path.join(rootDir, "config", "zwaveagent.config.json")
+
+def waitFor(condition, timeout):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+def runDiscovery(rootDir, osnInstance):
+    """Runs the agent in discovery mode and afterwards maps all discovered sensors to remote ids."""
+    start = time.time()
+    agent = ZWaveAgent(os.path.join(rootDir, "config"), osnInstance)
+    agent.discoverSensors()
+    waitFor(lambda: not agent.running(), 60)
+    agent.stop()
+    configStore.flush() # the agent config is written in the background otherwise
+    discoveryTime = time.time() - start
+    with open(agentConfigFile(rootDir)) as configFile:
+        agentConfig = json.load(configFile)
+    for number, sensor in enumerate(agentConfig["sensor_mappings"]):
+        sensor["remote_id"] = "%s" % (number + 1)
+    with open(agentConfigFile(rootDir), "w") as configFile:
+        json.dump(agentConfig, configFile, indent = 4)
+    return discoveryTime, len(agentConfig["sensor_mappings"])
+
+def startAgent(rootDir, osnInstance):
+    """Starts the agent and waits till network ready was processed. Returns agent and the time that took."""
+    start = time.time()
+    agent = ZWaveAgent(os.path.join(rootDir, "config"), osnInstance)
+    agent.start()
+    waitFor(lambda: agent.valueConsumer is not None, 60)
+    return agent, time.time() - start
+
+def runBenchmark(args):
+    port = freePort()
+    stub = startStub(port, args.latency_msec, 0.0)
+    rootDir = makeRootDir(args, port)
+    logging.basicConfig(filename = os.path.join(rootDir, "log", "opensense.log"), level = getattr(logging, args.log_level))
+    try:
+        osnInstance = OpenSenseNetInstance(rootDir)
+        discoveryTime, numSensors = runDiscovery(rootDir, osnInstance)
+        # the first start configures all nodes, the second one should find them unchanged
+        agent, firstStartTime = startAgent(rootDir, osnInstance)
+        agent.stop()
+        agent, secondStartTime = startAgent(rootDir, osnInstance)
+
+        cpuStart = time.process_time() if hasattr(time, "process_time") else time.clock()
+        start = time.time()
+        time.sleep(args.duration)
+        numEmitted = agent.network.numUpdates
+        agent.stop()
+        agent.valueConsumer.join(args.drain_timeout)
+        osnInstance.flushAllBulkSendingArrays()
+        numArrived = 0
+        drainDeadline = time.time() + args.drain_timeout
+        while time.time() < drainDeadline:
+            numArrived = stubStats(port)["values"]
+            if numArrived >= numEmitted - agent.droppedValues.value():
+                break
+            time.sleep(0.05)
+        totalTime = time.time() - start
+        cpuTime = (time.process_time() if hasattr(time, "process_time") else time.clock()) - cpuStart
+
+        report = {
+            "nodes": args.nodes,
+            "sensors": numSensors,
+            "discovery_sec": round(discoveryTime, 3),
+            "first_start_sec": round(firstStartTime, 3),
+            "second_start_sec": round(secondStartTime, 3),
+            "emitted_values": numEmitted,
+            "emitted_values_per_sec": round(numEmitted / args.duration, 1),
+            "dropped_values": agent.droppedValues.value(),
+            "arrived_values": numArrived,
+            "throughput_values_per_sec": round(numArrived / totalTime, 1),
+            "cpu_sec": round(cpuTime, 2),
+            "cpu_utilization": round(cpuTime / totalTime, 2),
+            "rss_kb": currentRssKb(),
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+        osnInstance.stop()
+        return report
+    finally:
+        stub.terminate()
+        if not args.keep_root_dir:
+            shutil.rmtree(rootDir, ignore_errors = True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Load test of ZWaveAgent on a simulated Z-Wave network against a local stub API")
+    parser.add_argument("--nodes", type = int, default = 100)
+    parser.add_argument("--values-per-node", type = int, default = 4, help = "sensor values per node")
+    parser.add_argument("--config-values-per-node", type = int, default = 20, help = "configuration parameters per node")
+    parser.add_argument("--products", type = int, default = 5, help = "number of distinct simulated products")
+    parser.add_argument("--updates-per-sec", type = float, default = 1000, help = "value updates the simulated network emits per second")
+    parser.add_argument("--buffer-size", type = int, default = 10000, help = "value_buffer_size of the agent")
+    parser.add_argument("--duration", type = float, default = 10, help = "seconds values are emitted")
+    parser.add_argument("--threads", type = int, default = 20, help = "max_sending_threads")
+    parser.add_argument("--auto-batching", action = "store_true")
+    parser.add_argument("--latency-msec", type = float, default = 20, help = "response latency of the stub API")
+    parser.add_argument("--drain-timeout", type = float, default = 30, help = "max seconds to wait for queued values after the network was stopped")
+    parser.add_argument("--log-level", default = "WARNING")
+    parser.add_argument("--keep-root-dir", action = "store_true", help = "don't delete the temporary root dir (configs, cache, spool, log)")
+    parser.add_argument("--json", action = "store_true", help = "print report as json")
+    args = parser.parse_args()
+
+    report = runBenchmark(args)
+    if args.json:
+        print(json.dumps(report, sort_keys = True))
+    else:
+        for key in sorted(report):
+            print("%-28s %s" % (key, report[key]))
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+This file is part of **opensense** project https://github.com/opensense-network/.
+    :platform: Unix, Windows, MacOS X
+    :sinopsis: opensense
+
+.. moduleauthor:: Frank Pallas <frank.pallas@tu-berlin.de>
+
+License : GPL(v3)
+
+**opensense** is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+**opensense** is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with opensense. If not, see http://www.gnu.org/licenses.
+
+"""
+import sys
+import json
+import time
+import random
+import argparse
+from threading import Thread, Lock
+
+# eliminate incompatibilities between Python v2 and v3
+try:
+    # For Python 3.0 and later
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    # Fall back to Python 2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class StubApiServer:
+    """
+    A minimal local stand-in for the OpenSense platform API.
+
+    Implements users/login, sensors/addSensor, sensors/addValue and
+    sensors/addMultipleValues as well as a small catalog of measurands,
+    units and licenses (answering other GETs with empty lists), delays every response by a
+    configurable latency and optionally fails a share of the requests. It
+    counts the requests and values received, so that a benchmark can
+    determine how many values actually arrived - these counts are also
+    available as json via GET /stats. Optionally, the token handed out on
+    login expires after a given number of value requests, after which
+    requests with it are answered with 401. With recordValues set, the
+    values received are kept in receivedValues, in order of arrival.
+    """
+
+    def __init__(self, port = 0, latencyMsec = 0, failureRate = 0.0, host = "127.0.0.1", expireTokenEvery = 0, recordValues = False):
+        self.latency = latencyMsec / 1000.0
+        self.failureRate = failureRate
+        self.expireTokenEvery = expireTokenEvery
+        self.lock = Lock()
+        self.numRequests = 0
+        self.numValues = 0
+        self.numFailed = 0
+        self.numUnauthorized = 0
+        self.numLogins = 0
+        self.numSensors = 0
+        self.tokenGeneration = 0
+        self.receivedValues = [] if recordValues else None
+        self.server = ThreadingHTTPServer((host, port), self.makeHandler())
+        self.port = self.server.server_address[1]
+
+    def makeHandler(self):
+        stub = self
+        class StubHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # keep-alive, as the real platform
+            disable_nagle_algorithm = True # headers and body are written separately - don't let them wait for delayed acks
+
+            def do_GET(self):
+                if self.path.endswith("/stats"):
+                    with stub.lock:
+                        self.respond(200, {"requests":stub.numRequests, "values":stub.numValues, "failed":stub.numFailed, \
+                            "unauthorized":stub.numUnauthorized, "logins":stub.numLogins, "sensors":stub.numSensors})
+                else:
+                    path = urlparse(self.path).path.rstrip("/")
+                    query = dict((key, values[0]) for key, values in parse_qs(urlparse(self.path).query).items())
+                    catalog = stub.catalog.get(path.split("/")[-1], [])
+                    self.respond(200, [entry for entry in catalog if all(str(entry.get(key)) == value for key, value in query.items())])
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length).decode("utf-8") or "{}")
+                if stub.latency > 0:
+                    time.sleep(stub.latency)
+                if self.path.endswith("/users/login"):
+                    with stub.lock:
+                        stub.numLogins += 1
+                        token = "stub-token-%s" % stub.tokenGeneration
+                    self.respond(200, {"id":token})
+                    return
+                if not stub.authorized(self.headers.get("Authorization")):
+                    self.respond(401, {})
+                    return
+                if stub.failureRate > 0 and random.random() < stub.failureRate:
+                    with stub.lock:
+                        stub.numFailed += 1
+                    self.respond(503, {})
+                    return
+                if self.path.endswith("/sensors/addSensor"):
+                    with stub.lock:
+                        stub.numSensors += 1
+                        sensorId = 1000 + stub.numSensors
+                    self.respond(200, {"id":sensorId})
+                elif self.path.endswith("/sensors/addValue"):
+                    stub.countValues([body])
+                    self.respond(200, {})
+                elif self.path.endswith("/sensors/addMultipleValues"):
+                    stub.countValues(body.get("values", body.get("collapsedMessages", [])))
+                    self.respond(200, {})
+                else:
+                    self.respond(404, {})
+
+            def respond(self, status, jsonData):
+                payload = json.dumps(jsonData).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+        return StubHandler
+
+    catalog = {
+        "measurands": [{"id":1, "name":"temperature"}, {"id":2, "name":"humidity"}, {"id":3, "name":"noise"}],
+        "units": [{"id":1, "measurandId":1, "name":"celsius"}, {"id":2, "measurandId":2, "name":"percent"}, {"id":3, "measurandId":3, "name":"decibel"}],
+        "licenses": [{"id":1, "shortName":"ODC-PDDL"}],
+    }
+
+    def authorized(self, token):
+        with self.lock:
+            if token != "stub-token-%s" % self.tokenGeneration:
+                self.numUnauthorized += 1
+                return False
+            if self.expireTokenEvery > 0 and (self.numRequests + 1) % self.expireTokenEvery == 0:
+                self.tokenGeneration += 1 # this request still passes, later ones with this token don't
+            return True
+
+    def countValues(self, values):
+        with self.lock:
+            self.numRequests += 1
+            self.numValues += len(values)
+            if self.receivedValues is not None:
+                self.receivedValues.extend(value.get("numberValue") for value in values)
+
+    def start(self):
+        serverThread = Thread(target = self.server.serve_forever)
+        serverThread.daemon = True
+        serverThread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Stub OpenSense API server for benchmarking")
+    parser.add_argument("--port", type = int, default = 8099)
+    parser.add_argument("--latency-msec", type = float, default = 0)
+    parser.add_argument("--failure-rate", type = float, default = 0.0)
+    parser.add_argument("--expire-token-every", type = int, default = 0, help = "let the token expire after this many value requests, 0 for never")
+    args = parser.parse_args()
+    stub = StubApiServer(args.port, args.latency_msec, args.failure_rate, expireTokenEvery = args.expire_token_every)
+    print("stub OpenSense API listening on 127.0.0.1:%s" % stub.port)
+    sys.stdout.flush()
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+This file is part of **opensense** project https://github.com/opensense-network/.
+    :platform: Unix, Windows, MacOS X
+    :sinopsis: opensense
+
+.. moduleauthor:: Frank Pallas <frank.pallas@tu-berlin.de>
+
+License : GPL(v3)
+
+**opensense** is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+**opensense** is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with opensense. If not, see http://www.gnu.org/licenses.
+
+"""
+import sys
+import json
+import time
+import random
+import argparse
+from threading import Thread, Lock, Condition
+
+# eliminate incompatibilities between Python v2 and v3
+try:
+    # For Python 3.0 and later
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, unquote
+except ImportError:
+    # Fall back to Python 2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class StubOpenHABServer:
+    """
+    A minimal local stand-in for an OpenHAB REST API.
+
+    Serves a configurable number of Number items via GET /rest/items
+    (supporting the fields parameter and ETags) and /rest/items/<name>/state and
+    changes the state of random items at a configurable rate. The changes
+    are published as ItemStateChangedEvents via the server-sent events
+    stream at GET /rest/events, which can be disabled to exercise the
+    polling fallback of the OpenHAB agent, or dropped to make the agent
+    reconnect. GET /stats returns request counts as json.
+    """
+
+    def __init__(self, port = 0, numItems = 100, changesPerSec = 10.0, eventsEnabled = True, host = "127.0.0.1"):
+        self.eventsEnabled = eventsEnabled
+        self.changesPerSec = changesPerSec
+        self.lock = Lock()
+        self.changed = Condition(self.lock)
+        self.states = dict(("Item%s" % i, "%.1f" % random.uniform(0, 30)) for i in range(numItems))
+        self.events = [] # last published events, as (sequence number, json)
+        self.numEvents = 0
+        self.numChanges = 0 # including unpublished ones, makes up the ETag
+        self.numItemRequests = 0
+        self.numEventStreams = 0
+        self.streamGeneration = 0 # event streams of older generations are closed
+        self.server = ThreadingHTTPServer((host, port), self.makeHandler())
+        self.port = self.server.server_address[1]
+
+    def makeHandler(self):
+        stub = self
+        class StubHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                path = self.path.split("?")[0].rstrip("/")
+                query = parse_qs(urlparse(self.path).query)
+                if path == "/rest/items":
+                    with stub.lock:
+                        stub.numItemRequests += 1
+                        etag = '"%s"' % stub.numChanges
+                        items = [{"name":name, "type":"Number", "state":state, "label":name, "tags":[], "groupNames":[]} for name, state in stub.states.items()]
+                    if self.headers.get("If-None-Match") == etag:
+                        self.respond(304, None, {"ETag":etag})
+                        return
+                    if "fields" in query:
+                        fields = query["fields"][0].split(",")
+                        items = [dict((key, item[key]) for key in fields if key in item) for item in items]
+                    self.respond(200, items, {"ETag":etag})
+                elif path.startswith("/rest/items/") and path.endswith("/state"):
+                    with stub.lock:
+                        stub.numItemRequests += 1
+                        state = stub.states.get(unquote(path.split("/")[3]))
+                    if state is None:
+                        self.respond(404, {})
+                    else:
+                        self.respond(200, state)
+                elif path == "/rest/events" and stub.eventsEnabled:
+                    self.streamEvents()
+                elif path == "/stats":
+                    with stub.lock:
+                        self.respond(200, {"item_requests":stub.numItemRequests, "event_streams":stub.numEventStreams, "events":stub.numEvents})
+                else:
+                    self.respond(404, {})
+
+            def streamEvents(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                with stub.lock:
+                    stub.numEventStreams += 1
+                    sequence = stub.numEvents
+                    generation = stub.streamGeneration
+                try:
+                    while True:
+                        with stub.lock:
+                            while stub.numEvents == sequence and stub.streamGeneration == generation:
+                                stub.changed.wait()
+                            if stub.streamGeneration != generation:
+                                break
+                            pending = [event for number, event in stub.events if number >= sequence]
+                            sequence = stub.numEvents
+                        for event in pending:
+                            self.wfile.write(("event: message\ndata: %s\n\n" % event).encode("utf-8"))
+                        self.wfile.flush()
+                except (IOError, OSError):
+                    pass # client went away
+                self.close_connection = True
+
+            def respond(self, status, data, headers = None):
+                if data is None:
+                    payload = b""
+                elif isinstance(data, str):
+                    payload = data.encode("utf-8")
+                else:
+                    payload = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "text/plain" if isinstance(data, str) else "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+        return StubHandler
+
+    def changeStates(self):
+        names = list(self.states)
+        while self.changesPerSec > 0:
+            time.sleep(1.0 / self.changesPerSec)
+            self.setState(random.choice(names), "%.1f" % random.uniform(0, 30))
+
+    def setState(self, name, state, publish = True):
+        """Changes the state of an item and publishes the change, unless publish is False."""
+        with self.lock:
+            self.numChanges += 1
+            if not publish:
+                self.states[name] = state
+                return
+            payload = json.dumps({"type":"Decimal", "value":state, "oldType":"Decimal", "oldValue":self.states[name]})
+            event = json.dumps({"topic":"smarthome/items/%s/statechanged" % name, "payload":payload, "type":"ItemStateChangedEvent"})
+            self.states[name] = state
+            self.events.append((self.numEvents, event))
+            del self.events[:-1000]
+            self.numEvents += 1
+            self.changed.notify_all()
+
+    def dropEventStreams(self):
+        """Closes all open event streams, as a restarting OpenHAB or a network outage would."""
+        with self.lock:
+            self.streamGeneration += 1
+            self.changed.notify_all()
+
+    def start(self):
+        for target in (self.server.serve_forever, self.changeStates):
+            thread = Thread(target = target)
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def stop(self):
+        self.changesPerSec = 0
+        self.server.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Stub OpenHAB REST API with item state change events")
+    parser.add_argument("--port", type = int, default = 8080)
+    parser.add_argument("--items", type = int, default = 100)
+    parser.add_argument("--changes-per-sec", type = float, default = 10.0)
+    parser.add_argument("--no-events", action = "store_true", help = "answer /rest/events with 404 to exercise polling fallback")
+    args = parser.parse_args()
+    stub = StubOpenHABServer(args.port, args.items, args.changes_per_sec, not args.no_events).start()
+    print("stub OpenHAB listening on 127.0.0.1:%s" % stub.port)
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sys.exit(0)